@@ -0,0 +1,206 @@
+'''
+Exports a region of a channel from the Boss to a TIFF stack or a .npy array on disk
+Slabs one block deep (on the ingest's block grid) are fetched a block per thread, and each slab is written while the
+next one is fetched, so at most two slabs are held in memory. Finished slabs are journaled, --resume skips them
+'''
+
+import argparse
+import os
+from argparse import Namespace
+from multiprocessing.dummy import Pool as ThreadPool
+
+import numpy as np
+from PIL import Image
+
+try:
+    from src.ingest.boss_resources import BossResParams
+    from src.ingest.cuboid_grid import CuboidGrid
+    from src.ingest.ingest_job import IngestJob, validate_block_shape
+    from src.ingest.journal import BlockJournal
+    from ingest_large_vol import download_cutout, get_formatted_datetime
+except ImportError:
+    from .src.ingest.boss_resources import BossResParams
+    from .src.ingest.cuboid_grid import CuboidGrid
+    from .src.ingest.ingest_job import IngestJob, validate_block_shape
+    from .src.ingest.journal import BlockJournal
+    from .ingest_large_vol import download_cutout, get_formatted_datetime
+
+
+class TiffStackWriter:
+    # one TIFF per z slice (named by its z in the Boss), each written under a temporary name and renamed
+    # so an interrupted export leaves no partial images
+    def __init__(self, output_dir, prefix):
+        self.output_dir = output_dir
+        self.prefix = prefix
+
+    def get_fname(self, z_slice):
+        return os.path.join(self.output_dir, '{}_{:04d}.tif'.format(self.prefix, z_slice))
+
+    def write(self, z_rng, slab):
+        for idx, z_slice in enumerate(range(z_rng[0], z_rng[1])):
+            fname = self.get_fname(z_slice)
+            Image.fromarray(slab[idx]).save(fname + '.part', format='TIFF')
+            os.replace(fname + '.part', fname)
+
+    def close(self):
+        pass
+
+
+class NpyWriter:
+    # (z, y, x) array of the whole region in a .npy file, each slab is written into a memory map of the file
+    def __init__(self, path, shape, dtype, z_start, resume=False):
+        self.z_start = z_start
+        if resume and os.path.isfile(path):
+            self.array = np.load(path, mmap_mode='r+')
+            if self.array.shape != tuple(shape) or self.array.dtype != np.dtype(dtype):
+                raise ValueError('{} holds a {} {} array, not {} {} to resume'.format(
+                    path, self.array.shape, self.array.dtype, tuple(shape), np.dtype(dtype)))
+        else:
+            self.array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+
+    def write(self, z_rng, slab):
+        self.array[z_rng[0] - self.z_start:z_rng[1] - self.z_start] = slab
+        self.array.flush()
+
+    def close(self):
+        self.array.flush()
+        del self.array
+
+
+def get_export_journal_fname(output_dir, ingest_job):
+    return os.path.join(output_dir, '_'.join(
+        ('export_journal', ingest_job.coll_name, ingest_job.exp_name, ingest_job.ch_name)) + '.txt')
+
+
+def fetch_slab(pool, boss_res_params, ingest_job, grid, z_bucket, attempts=3):
+    # GETs the blocks of a slab concurrently, returns the slab and the number of blocks that couldn't be fetched
+    z_rng = grid.z[z_bucket]
+    x_extent, y_extent = ingest_job.x_extent, ingest_job.y_extent
+    slab = np.zeros((len(z_rng), y_extent[1] - y_extent[0], x_extent[1] - x_extent[0]),
+                    dtype=ingest_job.datatype)
+
+    def get_block(block_rngs):
+        return block_rngs, download_cutout(boss_res_params, ingest_job, *block_rngs, attempts=attempts)
+
+    failures = 0
+    for (x_rng, y_rng, _), cutout in pool.imap_unordered(get_block, grid.slab_blocks(z_bucket)):
+        if cutout is None:
+            failures += 1
+            continue
+        slab[:, y_rng[0] - y_extent[0]:y_rng[1] - y_extent[0],
+             x_rng[0] - x_extent[0]:x_rng[1] - x_extent[0]] = cutout
+    return slab, failures
+
+
+def write_slab(writer, journal, ingest_job, z_rng, slab, failures):
+    # slabs missing blocks are written (with zeros) but journaled as failed, so a resume fetches them again
+    writer.write(z_rng, slab)
+    journal.record('failed' if failures else 'done', ingest_job.x_extent, ingest_job.y_extent, z_rng)
+    ingest_job.send_msg('{} Exported z range {}:{}{}'.format(
+        get_formatted_datetime(), z_rng[0], z_rng[1],
+        ', {} blocks failed'.format(failures) if failures else ''))
+
+
+def export_region(boss_res_params, ingest_job, writer, journal, threads=8, block_shape=(1024, 1024, 16),
+                  attempts=3):
+    # exports x_extent, y_extent and z_range of the ingest job slab by slab, returns the number of failed blocks
+    grid = CuboidGrid(ingest_job.x_extent, ingest_job.y_extent, ingest_job.z_range, block_shape)
+    num_failures = 0
+    pending = None
+    with ThreadPool(threads) as pool, ThreadPool(1) as write_pool:
+        for z_bucket in grid.z:
+            z_rng = grid.z[z_bucket]
+            z_rng = [z_rng.start, z_rng.stop]
+            if journal.is_finished(ingest_job.x_extent, ingest_job.y_extent, z_rng):
+                continue
+            slab, failures = fetch_slab(pool, boss_res_params, ingest_job, grid, z_bucket, attempts)
+            num_failures += failures
+
+            # the previous slab is written while this one was fetched
+            if pending is not None:
+                pending.get()
+            pending = write_pool.apply_async(write_slab, (writer, journal, ingest_job, z_rng, slab, failures))
+        if pending is not None:
+            pending.get()
+    return num_failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export a region of a channel from the Boss to a TIFF stack or a .npy array')
+    parser.add_argument('--collection', type=str, required=True,
+                        help='Collection')
+    parser.add_argument('--experiment', type=str, required=True,
+                        help='Experiment')
+    parser.add_argument('--channel', type=str, required=True,
+                        help='Channel')
+    parser.add_argument('--x_extent', type=int, nargs=2, required=True,
+                        help='x range to export, in the Boss (start stop)')
+    parser.add_argument('--y_extent', type=int, nargs=2, required=True,
+                        help='y range to export, in the Boss (start stop)')
+    parser.add_argument('--z_range', type=int, nargs=2, required=True,
+                        help='z range to export, in the Boss (start stop)')
+    parser.add_argument('--res', type=int, default=0,
+                        help='Resolution to export (default = 0)')
+    parser.add_argument('--boss_config_file', type=str, default='neurodata.cfg',
+                        help='Path and filename for Boss config (config file w/ server and API Key)')
+    parser.add_argument('--output_dir', type=str, required=True,
+                        help='Directory to write the export (and its journal) to')
+    parser.add_argument('--format', type=str, default='tif', choices=['tif', 'npy'],
+                        help='One TIFF per z slice (<channel>_<z:4>.tif), or a single (z, y, x) <channel>.npy array (default = tif)')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Number of blocks GET from the Boss at a time (default = 8)')
+    parser.add_argument('--block_shape', type=int, nargs=3, default=[1024, 1024, 16], metavar=('X', 'Y', 'Z'),
+                        help='Shape of the blocks GET from the Boss, a multiple of its 512 512 16 cuboid. Slabs are one block deep (default = 1024 1024 16)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume an interrupted export, skipping the slabs its journal has as done')
+    parser.add_argument('--slack_token_file', type=str,
+                        help='Path & filename for slack token (key only)')
+    parser.add_argument('--slack_usr', type=str,
+                        help='User to send slack message to (e.g. USERNAME)')
+    args = parser.parse_args()
+
+    validate_block_shape(args.block_shape)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # the region is given in the Boss, so it is taken as is (no offsets)
+    ingest_job = IngestJob(Namespace(datasource='local', collection=args.collection, experiment=args.experiment,
+                                     channel=args.channel, x_extent=args.x_extent, y_extent=args.y_extent,
+                                     z_extent=args.z_range, z_range=args.z_range, res=args.res,
+                                     boss_config_file=args.boss_config_file, slack_token_file=args.slack_token_file,
+                                     slack_usr=args.slack_usr))
+    boss_res_params = BossResParams(ingest_job, get_only=True)
+    # the channel sets the datatype (and its base resolution), export the resolution asked for
+    ingest_job.res = args.res
+
+    shape = (args.z_range[1] - args.z_range[0], args.y_extent[1] - args.y_extent[0],
+             args.x_extent[1] - args.x_extent[0])
+    if args.format == 'tif':
+        if ingest_job.datatype not in ('uint8', 'uint16'):
+            raise ValueError('{} channels can only be exported as npy'.format(ingest_job.datatype))
+        writer = TiffStackWriter(args.output_dir, args.channel)
+    else:
+        writer = NpyWriter(os.path.join(args.output_dir, args.channel + '.npy'), shape, ingest_job.datatype,
+                           args.z_range[0], args.resume)
+
+    journal_fname = get_export_journal_fname(args.output_dir, ingest_job)
+    if not args.resume:
+        open(journal_fname, 'w').close()
+    journal = BlockJournal(journal_fname, args.resume)
+
+    ingest_job.send_msg('{} Exporting Collection: {}, Experiment: {}, Channel: {}, x: {}, y: {}, z: {} to {}'.format(
+        get_formatted_datetime(), args.collection, args.experiment, args.channel, args.x_extent, args.y_extent,
+        args.z_range, args.output_dir))
+    try:
+        num_failures = export_region(boss_res_params, ingest_job, writer, journal, args.threads,
+                                     args.block_shape)
+    finally:
+        writer.close()
+        journal.close()
+    ingest_job.send_msg('{} Finished export with {} failed blocks{}'.format(
+        get_formatted_datetime(), num_failures, ', run again with --resume to fetch them' if num_failures else ''),
+        send_slack=True)
+
+
+if __name__ == '__main__':
+    main()
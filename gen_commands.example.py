@@ -2,6 +2,7 @@
 
 import os
 import shlex
+import sys
 from subprocess import list2cmdline
 
 """ Script to generate ingest commands for ingest program """
@@ -17,6 +18,12 @@ source_type = 's3'  # either 'local', 's3', or 'render'
 # only used for 's3' source_type
 s3_bucket_name = "BUCKET_NAME"
 aws_profile = "default"
+# MB of images of the next slab fetched from S3 while the current one is ingested (0 turns it off)
+# the images are held in memory on top of the slabs
+s3_prefetch_mb = 512
+# images larger than s3_range_mb (e.g. single BigTIFF sections) are downloaded in ranges, s3_range_threads at a time
+s3_range_mb = 64
+s3_range_threads = 8
 
 # only used for 'render' source_type
 render_owner = 'OWNER_NAME'
@@ -134,14 +141,101 @@ limit_z = None
 # limit_z = [ZLIMLOW, ZLIMHIGH]
 
 
-# Number of workers to use
+# Number of worker processes to use
 # each worker loads additional 16 image files so watch out for out of memory errors
 # ignored if zrange is None
 workers = 1
 
+# shape (x, y, z) of the blocks POSTed to the Boss, a multiple of its 512 x 512 x 16 cuboid
+# of at most 1024 * 1024 * 64 voxels (blocks are POSTed whole)
+# slabs are one block deep, so deeper blocks (32 or 64 slices) add to memory usage
+block_shape = [1024, 1024, 16]
+
+# try several block shapes on a sample of the volume and ingest with the fastest
+tune_blocks = False
+
+# edges of the ingest that don't fall on Boss cuboid boundaries are logged ('warn'), or the blocks at the
+# edges of the data are padded with zeros to whole cuboids within the coordinate frame ('pad')
+edge_cuboids = 'warn'
+
+# fraction of the POSTed blocks GET back from the Boss and checked while the ingest goes on (0 for none)
+verify_fraction = 0.01
+verify_threads = 1
+
+# record every block with a hash of its voxels, to check the whole volume later with verify_ingest.py
+# the commands for every z range append to the channel's manifest
+manifest = True
+
+# number of slabs in each z shard handed out to a worker
+# workers that finish early pick up the remaining shards
+shard_slabs = 4
+
+# number of slabs each worker reads ahead while POSTing (0 disables read ahead)
+# each slab read ahead adds to memory usage per worker
+prefetch_slabs = 1
+
+# number of threads POSTing blocks (shared by all channels)
+threads = 8
+
+# adapt the number of POSTs in flight (up to threads) to the latency and errors from the Boss
+# (not with the process executor)
+adaptive_threads = False
+
+# number of channels from channels_list_file to ingest at the same time
+# requires executor = 'thread' and workers = 1
+concurrent_channels = 1
+
+# limit on memory used by slabs across all channels in GB, None for no limit
+max_memory_gb = None
+
+# 'row' or 'block' - block stores each slab block by block, so blocks are POSTed without copying them out of the slab
+slab_layout = 'row'
+
+# 'memory' or 'mmap:<directory>' - mmap backs the slabs with files in directory (e.g. mmap:/scratch on local NVMe),
+# so sections larger than RAM can be ingested (slabs then use disk space in directory instead of memory)
+slab_backing = 'memory'
+
+# number of threads each worker uses to decode the images of a slab
+read_threads = 4
+
+# 'thread' or 'process' - process runs decode and POST workers in separate processes
+# (sharing each slab through shared memory) so they aren't limited by the GIL
+# process requires workers = 1
+executor = 'thread'
+
+# resume an interrupted ingest, skipping the blocks its journal (ingest_journal_<coll>_<exp>_<ch>_z<start>-<stop>.txt) has as finished
+# without it, the ingest starts a new journal for its z range
+resume = False
+
+# number of threads compressing blocks before they are POSTed (shared by all channels)
+compress_threads = 4
+
+# blosc compression per datatype as 'datatype:compressor:level:shuffle'
+# compressor: blosclz, lz4, lz4hc, zlib or zstd; shuffle: noshuffle, shuffle or bitshuffle
+# datatypes not listed use blosclz level 9 with shuffle
+compression = []
+# compression = ['uint16:lz4:5:bitshuffle', 'uint64:zstd:3:shuffle']
+
+# limits on upload bandwidth (MB/sec) and POSTs/sec to the Boss, None for no limit
+# split evenly between workers
+max_mb_per_sec = None
+max_posts_per_sec = None
+
+# optional file overriding the limits while the ingest runs, e.g.:
+# [Limits]
+# mb_per_sec = 50
+# posts_per_sec = 20
+# edits are picked up within seconds (or right away on SIGHUP)
+limits_file = None
+# limits_file = 'limits.cfg'
+
 
 """ Code to generate the commands """
 
+# the block grid comes from the ingest's package, next to script
+sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+from src.ingest.cuboid_grid import CuboidGrid  # noqa: E402
+
 
 def gen_comm(zstart, zend):
     cmd = "python {}".format(script)
@@ -158,6 +252,37 @@ def gen_comm(zstart, zend):
         cmd += ' --y_extent {d[0]} {d[1]}'.format(d=y_extent)
         cmd += ' --z_step {}'.format(z_step)
         cmd += ' --warn_missing_files'
+    cmd += ' --executor {}'.format(executor)
+    cmd += ' --threads {}'.format(threads)
+    if adaptive_threads:
+        cmd += ' --adaptive_threads'
+    if channel is None:
+        cmd += ' --concurrent_channels {}'.format(concurrent_channels)
+    if max_memory_gb is not None:
+        cmd += ' --max_memory_gb {}'.format(max_memory_gb)
+    cmd += ' --read_threads {}'.format(read_threads)
+    cmd += ' --slab_layout {}'.format(slab_layout)
+    cmd += ' --slab_backing {}'.format(slab_backing)
+    cmd += ' --prefetch_slabs {}'.format(prefetch_slabs)
+    cmd += ' --block_shape {b[0]} {b[1]} {b[2]}'.format(b=block_shape)
+    if tune_blocks:
+        cmd += ' --tune_blocks'
+    cmd += ' --edge_cuboids {}'.format(edge_cuboids)
+    if manifest:
+        cmd += ' --manifest'
+    if verify_fraction:
+        cmd += ' --verify_fraction {} --verify_threads {}'.format(verify_fraction, verify_threads)
+    if resume:
+        cmd += ' --resume'
+    cmd += ' --compress_threads {}'.format(compress_threads)
+    for codec in compression:
+        cmd += ' --compression {}'.format(codec)
+    if max_mb_per_sec is not None:
+        cmd += ' --max_mb_per_sec {}'.format(max_mb_per_sec)
+    if max_posts_per_sec is not None:
+        cmd += ' --max_posts_per_sec {}'.format(max_posts_per_sec)
+    if limits_file is not None:
+        cmd += ' --limits_file {}'.format(limits_file)
 
     if limit_x is not None:
         cmd += ' --limit_x {d[0]} {d[1]}'.format(d=limit_x)
@@ -196,6 +321,8 @@ def gen_comm(zstart, zend):
     if source_type == 's3':
         cmd += " --s3_bucket_name {}".format(s3_bucket_name)
         cmd += ' --aws_profile {}'.format(aws_profile)
+        cmd += ' --s3_prefetch_mb {}'.format(s3_prefetch_mb)
+        cmd += ' --s3_range_mb {} --s3_range_threads {}'.format(s3_range_mb, s3_range_threads)
 
     if source_type == 'render':
         cmd += ' --render_owner {}'.format(render_owner)
@@ -230,33 +357,47 @@ def gen_comm(zstart, zend):
 
 if zrange:
     # generate command with zrange
-    range_per_worker = (zrange[1] - zrange[0]) // workers
-
-    print("# Range per worker: ", range_per_worker)
-
-    if range_per_worker % 16:  # supercuboids are 16 z slices
-        range_per_worker = ((range_per_worker // 16) + 1) * 16
-
-    print("# Range per worker (rounded up): ", range_per_worker)
+    # the ingest splits zrange into shards of shard_slabs slabs (one block deep) and hands them out to its workers
+    print("# Z slices per shard: ", shard_slabs * block_shape[2])
 
     try:
         if x_extent:
+            # number of blocks POSTed (blocks are aligned to multiples of block_shape in the Boss, after any offsets)
+            # the offsets are computed as the ingest does (IngestJob.calc_offsets)
+            if forced_offsets:
+                offsets = forced_offsets
+            elif offset_extents:
+                offsets = [-min(extent[0], 0) for extent in (x_extent, y_extent, z_extent)]
+            else:
+                offsets = [0, 0, 0]
+            origin = [-offset for offset in offsets]
+            grid = CuboidGrid(x_extent, y_extent, zrange, block_shape, origin)
+            print('# Blocks POSTed: {} ({} per slab)'.format(
+                len(grid), len(grid.x) * len(grid.y)))
+
             # amount of memory per worker
             ddim_xy = [x_extent[1] - x_extent[0], y_extent[1] - y_extent[0]]
             if data_type == 'uint8':
                 mult = 1
             elif data_type == 'uint16':
                 mult = 2
-            elif data_type == 'uint64' or data_type == 'uint32':
+            elif data_type == 'uint32':
+                mult = 4
+            elif data_type == 'uint64':
                 mult = 8
+            # slabs are kept in data_type (annotations are cast to uint64 block by block)
+            # slab being POSTed + slabs read ahead + slab being read
+            slabs_per_w = prefetch_slabs + 2 if prefetch_slabs > 0 else 1
             mem_per_w = ddim_xy[0] * ddim_xy[1] * \
-                mult * 16 / 1024 / 1024 / 1024
+                mult * block_shape[2] * slabs_per_w / 1024 / 1024 / 1024
+            # file backed slabs use scratch disk space instead of memory
+            usage = 'scratch disk' if slab_backing.startswith('mmap') else 'memory'
             print(
-                '# Expected memory usage per worker {:.1f} GB'.format(mem_per_w))
+                '# Expected {} usage per worker {:.1f} GB'.format(usage, mem_per_w))
 
             # amount of memory total
             mem_tot = mem_per_w * workers
-            print('# Expected total memory usage: {:.1f} GB'.format(mem_tot))
+            print('# Expected total {} usage: {:.1f} GB'.format(usage, mem_tot))
     except NameError:
         if source_type == 'render':
             pass
@@ -267,21 +408,11 @@ if zrange:
     cmd += ' --create_resources'
     print('\n' + cmd + '\n')
 
-    for worker in range(workers):
-        start_z = max((worker * range_per_worker +
-                       zrange[0]) // 16 * 16, zrange[0])
-        if start_z < zrange[0]:
-            start_z = zrange[0]
-        if start_z > zrange[1]:
-            # No point start a useless thread
-            continue
-
-        next_z = ((worker + 1) * range_per_worker + zrange[0]) // 16 * 16
-        end_z = min(zrange[1], next_z)
-
-        cmd = gen_comm(start_z, end_z)
-        cmd += " &"
-        print(cmd + '\n')
+    cmd = gen_comm(zrange[0], zrange[1])
+    cmd += ' --workers {}'.format(workers)
+    cmd += ' --shard_slabs {}'.format(shard_slabs)
+    cmd += " &"
+    print(cmd + '\n')
 
 else:
     # generate a single command without zrange
@@ -4,12 +4,17 @@ Parses arguments and manages the ingest process
 '''
 
 import argparse
+import os
 import platform
+import queue
+import signal
 import sys
+import threading
 import time
 from collections import defaultdict
 from datetime import datetime
 from functools import partial
+from multiprocessing import Pool as ProcessPool
 from multiprocessing.dummy import Pool as ThreadPool
 
 import numpy as np
@@ -17,15 +22,40 @@ from PIL import Image
 
 try:
     # for command line usage
+    from src.ingest.block_verifier import BlockVerifier, sample_block
     from src.ingest.boss_resources import BossResParams
-    from src.ingest.ingest_job import IngestJob
+    from src.ingest.compression import CompressedBlock, SlabCompression, compress_block, init_compress_threads
+    from src.ingest.cuboid_grid import CuboidGrid, GridAxis
+    from src.ingest.ingest_job import BOSS_CUBOID, IngestJob, validate_block_shape
+    from src.ingest.journal import BlockJournal, count_statuses
+    from src.ingest.manifest import BlockManifest
+    from src.ingest.post_controller import AIMDController
+    from src.ingest.rate_limiter import create_rate_limiter, set_reload_signal, set_supervisor_reload_signal
+    from src.ingest.slabs import (BlockSlab, MemoryBudget, MmapSlab, SharedSlab, SlabPool, block_slab_view,
+                                  get_block_nonzero_map, get_slab_nbytes, start_resource_tracker)
 except ImportError:
     # for imports from tests
+    from .src.ingest.block_verifier import BlockVerifier, sample_block
     from .src.ingest.boss_resources import BossResParams
-    from .src.ingest.ingest_job import IngestJob
+    from .src.ingest.compression import CompressedBlock, SlabCompression, compress_block, init_compress_threads
+    from .src.ingest.cuboid_grid import CuboidGrid, GridAxis
+    from .src.ingest.ingest_job import BOSS_CUBOID, IngestJob, validate_block_shape
+    from .src.ingest.journal import BlockJournal, count_statuses
+    from .src.ingest.manifest import BlockManifest
+    from .src.ingest.post_controller import AIMDController
+    from .src.ingest.rate_limiter import create_rate_limiter, set_reload_signal, set_supervisor_reload_signal
+    from .src.ingest.slabs import (BlockSlab, MemoryBudget, MmapSlab, SharedSlab, SlabPool, block_slab_view,
+                                   get_block_nonzero_map, get_slab_nbytes, start_resource_tracker)
 
 Image.MAX_IMAGE_PIXELS = None
 
+# per process state for the process executor (set by init_process_worker)
+worker_ingest_job = None
+worker_boss_res_params = None
+# POST and compress pools of a worker ingesting shards (set by get_worker_pools)
+worker_post_pool = None
+worker_compress_pool = None
+
 
 def read_channel_names(channels_path):
     try:
@@ -42,23 +72,51 @@ def post_cutout(boss_res_params, ingest_job, x_rng, y_rng, z_rng, data, attempts
     ch = ingest_job.ch_name
     cutout_msg = 'Coll: {}, Exp: {}, Ch: {}, x: {}, y: {}, z: {}'.format(
         ingest_job.coll_name, ingest_job.exp_name, ch, x_rng, y_rng, z_rng)
+    # adaptive limit on POSTs in flight (if any)
+    post_controller = getattr(ingest_job, 'post_controller', None)
+    # limits on upload bandwidth and POST rate (if any)
+    rate_limiter = getattr(ingest_job, 'rate_limiter', None)
+    # checkpoint journal (if any)
+    journal = getattr(ingest_job, 'journal', None)
+    # sampled verification of the POSTed blocks (if any)
+    verifier = getattr(ingest_job, 'verifier', None)
+    # digest manifest (if any), of the blocks compressed with their digest
+    manifest = getattr(ingest_job, 'manifest', None)
     # POST cutout
     for attempt in range(attempts):
+        if rate_limiter is not None:
+            rate_limiter.acquire(data.nbytes)
+        if post_controller is not None:
+            post_controller.acquire()
+        start_time = time.time()
         try:
-            start_time = time.time()
-            boss_res_params.rmt.create_cutout(boss_res_params.ch_resource, ingest_job.res,
-                                              x_rng, y_rng, z_rng, data)
-            end_time = time.time()
-            post_time = end_time - start_time
-            msg = '{} POST succeeded in {:.2f} sec. {}'.format(
-                get_formatted_datetime(), post_time, cutout_msg)
-            ingest_job.send_msg(msg)
+            if isinstance(data, CompressedBlock):
+                boss_res_params.sessions.create_compressed_cutout(boss_res_params.ch_resource, ingest_job.res,
+                                                                  data.x_rng, data.y_rng, data.z_rng, data.payload)
+            else:
+                boss_res_params.sessions.create_cutout(boss_res_params.ch_resource, ingest_job.res,
+                                                       x_rng, y_rng, z_rng, data)
         except Exception as e:
             # attempt failed
+            if post_controller is not None:
+                post_controller.release(time.time() - start_time, e)
             ingest_job.send_msg(str(e))
             if attempt != attempts - 1:
                 time.sleep(2**(attempt + 1))
         else:
+            end_time = time.time()
+            post_time = end_time - start_time
+            if post_controller is not None:
+                post_controller.release(post_time)
+            msg = '{} POST succeeded in {:.2f} sec. {}'.format(
+                get_formatted_datetime(), post_time, cutout_msg)
+            ingest_job.send_msg(msg)
+            if journal is not None:
+                journal.record('done', x_rng, y_rng, z_rng)
+            if verifier is not None and isinstance(data, CompressedBlock):
+                verifier.submit(data)
+            if manifest is not None and isinstance(data, CompressedBlock) and data.digest is not None:
+                manifest.record('done', data.x_rng, data.y_rng, data.z_rng, data.digest, data.nonzero)
             break
     else:
         # we failed all the attempts - deal with the consequences.
@@ -66,45 +124,54 @@ def post_cutout(boss_res_params, ingest_job, x_rng, y_rng, z_rng, data, attempts
             get_formatted_datetime(), cutout_msg)
         ingest_job.send_msg(msg, send_slack=True)
         ingest_job.num_POST_failures += 1
+        if journal is not None:
+            journal.record('failed', x_rng, y_rng, z_rng)
         return 1
     return 0
 
 
+def create_verifier(boss_res_params, ingest_job):
+    # GETs a sample of the POSTed blocks back from the Boss in its own pool of verify_threads threads
+    def get_cutout(x_rng, y_rng, z_rng):
+        return boss_res_params.rmt.get_cutout(boss_res_params.ch_resource, ingest_job.res, x_rng, y_rng, z_rng)
+
+    return BlockVerifier(get_cutout, ingest_job.verify_fraction, ingest_job.verify_threads,
+                         log=ingest_job.send_msg)
+
+
+def download_cutout(boss_res_params, ingest_job, x_rng, y_rng, z_rng, attempts=3):
+    # GETs a cutout from the Boss, returns None if all the attempts failed
+    rmt = boss_res_params.rmt
+    for attempt in range(attempts):
+        try:
+            return rmt.get_cutout(boss_res_params.ch_resource, ingest_job.res, x_rng, y_rng, z_rng)
+        except Exception as e:
+            # attempt failed
+            ingest_job.send_msg(str(e))
+            if attempt != attempts - 1:
+                time.sleep(2**(attempt + 1))
+
+    # we failed all the attempts - deal with the consequences.
+    msg = '{} Error: download cutout failed after multiple attempts. x: {}, y: {}, z: {}'.format(
+        get_formatted_datetime(), x_rng, y_rng, z_rng)
+    ingest_job.send_msg(msg, send_slack=True)
+    return None
+
+
 def download_boss_slice(boss_res_params, ingest_job, z_slice, attempts=3):
     im_array_boss = np.zeros([1, ingest_job.img_size[1], ingest_job.img_size[0]],
                              dtype=ingest_job.datatype)
 
-    rmt = boss_res_params.rmt
     stride = 2048
 
     x_buckets = get_supercube_lims(ingest_job.x_extent, stride=stride)
     y_buckets = get_supercube_lims(ingest_job.y_extent, stride=stride)
-    for _, y_slices in y_buckets.items():
-        y_rng = [y_slices[0],
-                 y_slices[-1]+1]
-        for _, x_slices in x_buckets.items():
-            x_rng = [x_slices[0],
-                     x_slices[-1]+1]
-            for attempt in range(attempts):
-                try:
-                    im_array_boss[0, y_rng[0]-ingest_job.y_extent[0]:y_rng[1]-ingest_job.y_extent[0],
-                                  x_rng[0]-ingest_job.x_extent[0]:x_rng[-1]-ingest_job.x_extent[0]] = rmt.get_cutout(
-                        boss_res_params.ch_resource,
-                        ingest_job.res,
-                        x_rng, y_rng, [z_slice, z_slice + 1]
-                    )
-                except Exception as e:
-                    # attempt failed
-                    ingest_job.send_msg(str(e))
-                    if attempt != attempts - 1:
-                        time.sleep(2**(attempt + 1))
-                else:
-                    break
-            else:
-                # we failed all the attempts - deal with the consequences.
-                msg = '{} Error: download cutout failed after multiple attempts'.format(
-                    get_formatted_datetime())
-                ingest_job.send_msg(msg, send_slack=True)
+    for y_rng in y_buckets.ranges():
+        for x_rng in x_buckets.ranges():
+            cutout = download_cutout(boss_res_params, ingest_job, x_rng, y_rng, [z_slice, z_slice + 1], attempts)
+            if cutout is not None:
+                im_array_boss[0, y_rng[0]-ingest_job.y_extent[0]:y_rng[1]-ingest_job.y_extent[0],
+                              x_rng[0]-ingest_job.x_extent[0]:x_rng[-1]-ingest_job.x_extent[0]] = cutout
     return im_array_boss
 
 
@@ -120,7 +187,7 @@ def assert_equal(boss_res_params, ingest_job, z_rng):
     ingest_job.send_msg(msg)
 
     im_array_boss = download_boss_slice(
-        boss_res_params, ingest_job, rand_slice + ingest_job.offsets[2])
+        boss_res_params, ingest_job, ingest_job.get_boss_z(rand_slice))
 
     msg = '{} Z slice from BOSS downloaded'.format(
         get_formatted_datetime())
@@ -140,45 +207,825 @@ def assert_equal(boss_res_params, ingest_job, z_rng):
         return False
 
 
-def get_supercube_lims(rng, stride=16):
+def get_supercube_lims(rng, stride=16, origin=0):
     # stride = height of super cuboid
+    # {bucket: range of coordinates} of the stride aligned buckets of rng, see GridAxis
+    return GridAxis(rng, stride, origin)
+
 
-    first = rng[0]    # inclusive
-    last = rng[1]     # exclusive
+def get_z_origin(ingest_job):
+    # image slice at Boss z = 0, so z buckets of image slices start and stop on Boss cuboid boundaries
+    return -ingest_job.offsets[2]
 
-    buckets = defaultdict(list)
-    for z in range(first, last):
-        buckets[(z // stride)].append(z)
 
-    return buckets
+def get_partial_cuboid_edges(ingest_job, z_range):
+    # (axis, coordinate) of the edges of the ingest in the Boss that aren't on cuboid boundaries
+    boss_z_range = [ingest_job.get_boss_z(z_range[0]), ingest_job.get_boss_z(z_range[1])]
+    rngs = [('x', ingest_job.x_extent), ('y', ingest_job.y_extent), ('z', boss_z_range)]
+    return [(axis, edge) for (axis, rng), cuboid in zip(rngs, BOSS_CUBOID)
+            for edge in rng if edge % cuboid]
+
+
+def warn_partial_cuboids(ingest_job, z_range):
+    # the Boss reads, merges and writes back the cuboids a POST only partly fills
+    edges = get_partial_cuboid_edges(ingest_job, z_range)
+    if not edges:
+        return
+    if ingest_job.edge_cuboids == 'pad':
+        action = 'padding them with zeros at the edges of the data (within the coordinate frame)'
+    else:
+        action = '--edge_cuboids pad pads them with zeros at the edges of the data'
+    ingest_job.send_msg('{} Ingest edges {} are not on Boss cuboid boundaries {}, blocks along them POST partial cuboids: {}'.format(
+        get_formatted_datetime(), ', '.join('{} = {}'.format(axis, edge) for axis, edge in edges),
+        BOSS_CUBOID, action))
+
+
+def get_padded_rngs(ingest_job, x_rng, y_rng, z_rng):
+    # block ranges grown out to whole Boss cuboids where they are at the edges of the data (the extents),
+    # clipped to the coordinate frame
+    extents = [ingest_job.x_extent, ingest_job.y_extent, ingest_job.z_extent]
+    frames = [ingest_job.coord_frame_x_extent, ingest_job.coord_frame_y_extent, ingest_job.coord_frame_z_extent]
+    padded_rngs = []
+    for rng, extent, frame, cuboid in zip([x_rng, y_rng, z_rng], extents, frames, BOSS_CUBOID):
+        start, stop = rng
+        if start == extent[0]:
+            start = max(frame[0], start // cuboid * cuboid)
+        if stop == extent[1]:
+            stop = min(frame[1], -(-stop // cuboid) * cuboid)
+        padded_rngs.append([start, stop])
+    return padded_rngs
+
+
+def pad_block(data, rngs, padded_rngs, dtype):
+    # copies the (z, y, x) block at rngs into zeros covering padded_rngs
+    (x_rng, y_rng, z_rng), (pad_x, pad_y, pad_z) = rngs, padded_rngs
+    padded = np.zeros((pad_z[1] - pad_z[0], pad_y[1] - pad_y[0], pad_x[1] - pad_x[0]), dtype=dtype)
+    padded[z_rng[0] - pad_z[0]:z_rng[1] - pad_z[0],
+           y_rng[0] - pad_y[0]:y_rng[1] - pad_y[0],
+           x_rng[0] - pad_x[0]:x_rng[1] - pad_x[0]] = data
+    return padded
 
 
 def get_formatted_datetime():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
+def with_next_slab(z_buckets):
+    # (z_slices, z_slices of the next slab, None for the last one) for each z bucket
+    prev_z_slices = None
+    for z_slices in z_buckets.values():
+        if prev_z_slices is not None:
+            yield prev_z_slices, z_slices
+        prev_z_slices = z_slices
+    if prev_z_slices is not None:
+        yield prev_z_slices, None
+
+
+def read_slabs(ingest_job, z_buckets, prefetch=1, read_stack=None, memory_budget=None):
+    # yields (z_slices, im_array) for each z bucket
+    # a background thread reads up to `prefetch` slabs ahead so the disks keep working while we POST
+    # with a memory budget, room for each slab is acquired before it is read,
+    # the consumer releases it (get_slab_nbytes) once the slab's blocks are done
+    if read_stack is None:
+        read_stack = ingest_job.read_img_stack
+
+    def read(z_slices, next_z_slices):
+        # the images of the next slab are fetched (from S3) while this one is read, decoded and POSTed
+        if next_z_slices is not None:
+            ingest_job.prefetch_slices(next_z_slices)
+        if memory_budget is None:
+            return read_stack(z_slices)
+
+        nbytes = get_slab_nbytes(
+            len(z_slices), ingest_job.img_size, ingest_job.datatype)
+        memory_budget.acquire(nbytes)
+        try:
+            return read_stack(z_slices)
+        except Exception:
+            memory_budget.release(nbytes)
+            raise
+
+    if prefetch < 1:
+        for z_slices, next_z_slices in with_next_slab(z_buckets):
+            yield z_slices, read(z_slices, next_z_slices)
+        return
+
+    slab_queue = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def reader():
+        try:
+            for z_slices, next_z_slices in with_next_slab(z_buckets):
+                if stop.is_set():
+                    return
+                slab_queue.put((z_slices, read(z_slices, next_z_slices)))
+        except Exception as e:
+            # hand the error to the consumer so it is raised in the main thread
+            slab_queue.put(e)
+        else:
+            slab_queue.put(None)
+
+    read_thread = threading.Thread(target=reader, daemon=True)
+    read_thread.start()
+    try:
+        while True:
+            item = slab_queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # unblock the reader if we stopped early
+        stop.set()
+        while read_thread.is_alive() or not slab_queue.empty():
+            try:
+                item = slab_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if not isinstance(item, tuple):
+                continue
+            if isinstance(item[1], (SharedSlab, MmapSlab)):
+                item[1].release()
+            if memory_budget is not None:
+                memory_budget.release(get_slab_nbytes(
+                    len(item[0]), ingest_job.img_size, ingest_job.datatype))
+
+
 def ingest_block(x_slice_key, x_buckets, boss_res_params, ingest_job, y_rng, z_rng, im_array):
     # created for multithreading
     x_slices = x_buckets[x_slice_key]
 
     x_rng = [x_slices[0], x_slices[-1] + 1]
 
-    data = im_array[:, y_rng[0]-ingest_job.y_extent[0]:y_rng[1]-ingest_job.y_extent[0],
+    return post_block(boss_res_params, ingest_job, x_rng, y_rng, z_rng, im_array)
+
+
+def get_slab_block(ingest_job, x_rng, y_rng, im_array):
+    # block-major slabs hold each block contiguously, otherwise the block is a (strided) view of the slab
+    if isinstance(im_array, BlockSlab):
+        return im_array.get_block(y_rng[0]-ingest_job.y_extent[0], x_rng[0]-ingest_job.x_extent[0])
+    return im_array[:, y_rng[0]-ingest_job.y_extent[0]:y_rng[1]-ingest_job.y_extent[0],
                     x_rng[0]-ingest_job.x_extent[0]:x_rng[1]-ingest_job.x_extent[0]]
-    data = np.asarray(data, order='C')
 
-    if np.sum(data) == 0:
-        ingest_job.send_msg('{} Block empty for Collection: {}, Experiment: {}, Channel: {} x/y/z: {}/{}/{}, skipping'.format(
-            get_formatted_datetime(),
-            ingest_job.coll_name, ingest_job.exp_name, ingest_job.ch_name, x_rng, y_rng, z_rng))
-        return
+
+def get_block_starts(ingest_job, x_buckets, y_buckets):
+    # (y_starts, x_starts) of the blocks, as offsets into a slab
+    y_starts = [y_slices[0] - ingest_job.y_extent[0]
+                for y_slices in y_buckets.values()]
+    x_starts = [x_slices[0] - ingest_job.x_extent[0]
+                for x_slices in x_buckets.values()]
+    return y_starts, x_starts
+
+
+def skip_empty_block(ingest_job, x_rng, y_rng, z_rng):
+    ingest_job.send_msg('{} Block empty for Collection: {}, Experiment: {}, Channel: {} x/y/z: {}/{}/{}, skipping'.format(
+        get_formatted_datetime(),
+        ingest_job.coll_name, ingest_job.exp_name, ingest_job.ch_name, x_rng, y_rng, z_rng))
+    if ingest_job.journal is not None:
+        ingest_job.journal.record('empty', x_rng, y_rng, z_rng)
+    if ingest_job.manifest is not None:
+        ingest_job.manifest.record('empty', x_rng, y_rng, z_rng)
+
+
+def get_slab_block_starts(ingest_job, x_buckets, y_buckets):
+    # block starts for reading block-major slabs, None for the row layout
+    if ingest_job.slab_layout == 'block':
+        return get_block_starts(ingest_job, x_buckets, y_buckets)
+    return None
+
+
+def get_nonempty_blocks(ingest_job, x_buckets, y_buckets, z_rng, block_rngs, im_array):
+    # the blocks of block_rngs with any data, from an emptiness map of the whole slab
+    # empty blocks are skipped here so they never reach the compression and POST workers
+    y_starts, x_starts = get_block_starts(ingest_job, x_buckets, y_buckets)
+    if isinstance(im_array, BlockSlab):
+        nonzero_map = im_array.nonzero_map()
+    else:
+        nonzero_map = get_block_nonzero_map(im_array, y_starts, x_starts)
+    x_idxs = {x_start: idx for idx, x_start in enumerate(x_starts)}
+    y_idxs = {y_start: idx for idx, y_start in enumerate(y_starts)}
+
+    nonempty_rngs = []
+    for x_rng, y_rng in block_rngs:
+        if nonzero_map[y_idxs[y_rng[0] - ingest_job.y_extent[0]], x_idxs[x_rng[0] - ingest_job.x_extent[0]]]:
+            nonempty_rngs.append((x_rng, y_rng))
+        else:
+            skip_empty_block(ingest_job, x_rng, y_rng, z_rng)
+    return nonempty_rngs
+
+
+def compress_slab_block(ingest_job, x_rng, y_rng, z_rng, im_array):
+    # slices a block out of the slab and compresses it with the channel's codec
+    # annotations are cast to uint64 here, one block at a time, while the slab keeps the images' datatype
+    # with --edge_cuboids pad, blocks at the edges of the data are POSTed padded to whole cuboids
+    # (and journaled at their own ranges)
+    # blocks are hashed for the manifest (if any) as they are compressed
+    data = get_slab_block(ingest_job, x_rng, y_rng, im_array)
+    dtype = ingest_job.get_post_datatype()
+    digest = ingest_job.manifest is not None
+    if ingest_job.edge_cuboids == 'pad':
+        rngs = [list(x_rng), list(y_rng), list(z_rng)]
+        padded_rngs = get_padded_rngs(ingest_job, *rngs)
+        if padded_rngs != rngs:
+            block = compress_block(ingest_job.codec, *padded_rngs,
+                                   pad_block(data, rngs, padded_rngs, dtype), digest=digest)
+            block.block_rngs = (x_rng, y_rng, z_rng)
+            return block
+    return compress_block(ingest_job.codec, x_rng, y_rng, z_rng, data, dtype, digest)
+
+
+def post_block(boss_res_params, ingest_job, x_rng, y_rng, z_rng, im_array):
+    if not get_slab_block(ingest_job, x_rng, y_rng, im_array).any():
+        skip_empty_block(ingest_job, x_rng, y_rng, z_rng)
+        return 0
+    block = compress_slab_block(ingest_job, x_rng, y_rng, z_rng, im_array)
 
     # POST each block to the BOSS
-    post_cutout(boss_res_params, ingest_job,
-                x_rng, y_rng, z_rng, data, attempts=3)
+    return post_cutout(boss_res_params, ingest_job,
+                       x_rng, y_rng, z_rng, block, attempts=3)
+
+
+def post_compressed_block(boss_res_params, ingest_job, block):
+    return post_cutout(boss_res_params, ingest_job, *block.block_rngs, block, attempts=3)
+
+
+def create_compress_pool(compress_threads):
+    init_compress_threads()
+    return ThreadPool(compress_threads)
+
+
+def create_slab_pool(prefetch_slabs, channels=1):
+    # keeps the buffers of each channel's slabs in flight: being read, read ahead and being POSTed
+    return SlabPool((prefetch_slabs + 2) * channels)
+
+
+def init_process_worker(args, with_boss, processes=1):
+    # each worker process builds its own ingest job (and Boss remote) once, instead of pickling them per task
+    global worker_ingest_job, worker_boss_res_params
+    worker_ingest_job = IngestJob(args)
+    if with_boss:
+        worker_boss_res_params = BossResParams(worker_ingest_job, get_only=True)
+        # the upload limits are split evenly between the POSTing processes
+        worker_ingest_job.rate_limiter = create_rate_limiter(
+            worker_ingest_job, share=1 / processes, log=worker_ingest_job.send_msg)
+        set_reload_signal(worker_ingest_job.rate_limiter)
+        # the supervisor started the journal, workers append to it
+        worker_ingest_job.journal = BlockJournal(
+            worker_ingest_job.get_journal_fname(), worker_ingest_job.resume)
+        if worker_ingest_job.write_manifest:
+            worker_ingest_job.manifest = BlockManifest(
+                worker_ingest_job.get_manifest_fname())
+        # the worker's shards reuse its slab buffers
+        worker_ingest_job.slab_pool = create_slab_pool(
+            worker_ingest_job.prefetch_slabs)
+    elif worker_ingest_job.limits_file is not None and hasattr(signal, 'SIGHUP'):
+        # the supervisor forwards SIGHUP to all its workers, those without a rate limiter ignore it
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+
+def create_process_pool(processes, args, with_boss):
+    # worker processes have to share our resource tracker, see start_resource_tracker
+    start_resource_tracker()
+    return ProcessPool(processes, initializer=init_process_worker,
+                       initargs=(args, with_boss, processes))
+
+
+def new_shared_slab(ingest_job, shape, dtype):
+    # slab shared with the worker processes, in shared memory or a file in the scratch directory
+    if ingest_job.slab_backing == 'mmap':
+        return MmapSlab(shape, dtype, directory=ingest_job.slab_dir)
+    return SharedSlab(shape, dtype)
+
+
+def create_shared_slab(ingest_job, shape, dtype):
+    # shared slab from the slab pool if there is one (a reused slab isn't zeroed)
+    if ingest_job.slab_pool is None:
+        return new_shared_slab(ingest_job, shape, dtype)
+    return ingest_job.slab_pool.acquire(('shared',) + ingest_job.get_slab_key(shape, dtype),
+                                        partial(new_shared_slab, ingest_job, shape, dtype))
+
+
+def release_shared_slab(ingest_job, slab):
+    # hands the slab back to the slab pool, which unlinks it once it isn't kept for reuse
+    if ingest_job.slab_pool is None:
+        slab.release()
+        return
+    ingest_job.slab_pool.release(('shared',) + ingest_job.get_slab_key(slab.shape, slab.dtype), slab,
+                                 discard=type(slab).release)
+
+
+def attach_shared_slab(ingest_job, name, shape, dtype):
+    if ingest_job.slab_backing == 'mmap':
+        return MmapSlab.attach(name, shape, dtype)
+    return SharedSlab.attach(name, shape, dtype)
+
+
+def read_shared_slice(slab_name, shape, dtype, idx, z_slice, block_starts=None):
+    # decodes one image straight into its row of a shared slab, returns the number of read failures
+    # a missing image is zeroed, as the slab may be reused from an earlier slab
+    read_failures = worker_ingest_job.num_READ_failures
+    img = worker_ingest_job.load_img(z_slice)
+    if img is None:
+        img = 0
+    slab = attach_shared_slab(worker_ingest_job, slab_name, shape, dtype)
+    try:
+        block_slab_view(slab.array, block_starts)[idx] = img
+    finally:
+        slab.close()
+    return worker_ingest_job.num_READ_failures - read_failures
+
+
+def ingest_shared_block(slab_name, shape, dtype, x_rng, y_rng, z_rng, block_starts=None):
+    # compresses a block sliced out of a shared slab and POSTs it
+    # returns 1 if the POST failed (0 otherwise), the raw bytes, compressed bytes and time of the compression,
+    # and the block if it was sampled for verification (checked by the supervisor, whose verifier outlives the workers)
+    slab = attach_shared_slab(worker_ingest_job, slab_name, shape, dtype)
+    try:
+        block = compress_slab_block(worker_ingest_job, x_rng, y_rng, z_rng,
+                                    block_slab_view(slab.array, block_starts))
+    finally:
+        slab.close()
+
+    post_failures = post_compressed_block(
+        worker_boss_res_params, worker_ingest_job, block)
+    verify_block = None
+    if not post_failures and sample_block(worker_ingest_job.verify_fraction):
+        verify_block = block
+    return post_failures, (block.raw_nbytes, block.nbytes, block.compress_time), verify_block
+
+
+def read_shared_img_stack(pool, ingest_job, z_slices, block_starts=None):
+    # process executor version of IngestJob.read_img_stack, decoding into a shared slab
+    ingest_job.send_msg('{} Reading image data (z range: {}:{})'.format(
+        get_formatted_datetime(), z_slices[0], z_slices[-1] + 1))
+
+    start_time = time.time()
+    # the slab keeps the images' datatype, annotation blocks are cast to uint64 as they are compressed
+    shape = (len(z_slices), ingest_job.img_size[1], ingest_job.img_size[0])
+    slab = create_shared_slab(ingest_job, shape, ingest_job.datatype)
+
+    try:
+        read_failures = pool.starmap(
+            read_shared_slice,
+            [(slab.name, shape, slab.dtype.str, idx, z_slice, block_starts)
+             for idx, z_slice in enumerate(z_slices)],
+            chunksize=1)
+    except Exception:
+        release_shared_slab(ingest_job, slab)
+        raise
+    ingest_job.num_READ_failures += sum(read_failures)
+
+    read_time = time.time() - start_time
+    ingest_job.send_msg('{} Finished reading image data (z range: {}:{}) in {:.2f} sec'.format(
+        get_formatted_datetime(), z_slices[0], z_slices[-1] + 1, read_time))
+    return slab
+
+
+class BlockQueue:
+    # bounded queue of blocks feeding a pool of POST workers
+    # blocks of every row (and of the next slab) are queued together so a slow POST
+    # doesn't leave the rest of the pool waiting on a barrier
+    def __init__(self, pool, max_queued):
+        self.pool = pool
+        self.max_queued = max_queued
+        self.slots = threading.Semaphore(max_queued)
+        self.errors = []
+
+    def submit(self, func, args, on_done=None):
+        # blocks while the queue is full
+        # on_done(result) is called when the block finishes (result is None if it raised)
+        self.slots.acquire()
+
+        def callback(result):
+            try:
+                if on_done is not None:
+                    on_done(result)
+            finally:
+                self.slots.release()
+
+        def error_callback(err):
+            self.errors.append(err)
+            callback(None)
+
+        self.pool.apply_async(func, args, callback=callback,
+                              error_callback=error_callback)
+
+    def join(self):
+        # waits for every queued block to finish
+        for _ in range(self.max_queued):
+            self.slots.acquire()
+        for _ in range(self.max_queued):
+            self.slots.release()
+        if self.errors:
+            raise self.errors[0]
+
+
+class SlabBlocks:
+    # counts down the blocks of a slab as they finish, calling on_slab_done after the last one
+    def __init__(self, num_blocks, on_slab_done, on_block_done=None):
+        self.remaining = num_blocks
+        self.on_slab_done = on_slab_done
+        self.on_block_done = on_block_done
+        self.lock = threading.Lock()
+        if num_blocks == 0:
+            on_slab_done()
+
+    def block_done(self, result):
+        if self.on_block_done is not None:
+            self.on_block_done(result)
+        with self.lock:
+            self.remaining -= 1
+            finished = self.remaining == 0
+        if finished:
+            self.on_slab_done()
+
+
+def get_block_rngs(x_buckets, y_buckets):
+    # (x_rng, y_rng) of every block in a slab
+    return [(x_rng, y_rng) for y_rng in y_buckets.ranges() for x_rng in x_buckets.ranges()]
+
+
+def get_slab_z_rng(ingest_job, z_slices):
+    # z range of a slab in the Boss
+    return [ingest_job.get_boss_z(z_slices[0]), ingest_job.get_boss_z(z_slices[-1]) + 1]
+
+
+def get_pending_blocks(ingest_job, z_buckets, block_rngs):
+    # leaves out the blocks the journal has as finished (when resuming), and slabs with no blocks left
+    # returns the remaining z buckets and {first z slice: block ranges} of each slab
+    journal = ingest_job.journal
+    pending_buckets = {}
+    slab_block_rngs = {}
+    num_finished = 0
+    for key, z_slices in z_buckets.items():
+        z_rng = get_slab_z_rng(ingest_job, z_slices)
+        rngs = block_rngs
+        if journal is not None and journal.finished:
+            rngs = [(x_rng, y_rng) for x_rng, y_rng in block_rngs
+                    if not journal.is_finished(x_rng, y_rng, z_rng)]
+            num_finished += len(block_rngs) - len(rngs)
+        if rngs:
+            pending_buckets[key] = z_slices
+            slab_block_rngs[z_slices[0]] = rngs
+    if num_finished:
+        ingest_job.send_msg('{} Resuming: skipping {} blocks already finished in the journal'.format(
+            get_formatted_datetime(), num_finished))
+    return pending_buckets, slab_block_rngs
+
+
+def release_slab_memory(ingest_job, memory_budget, z_slices):
+    if memory_budget is not None:
+        memory_budget.release(get_slab_nbytes(
+            len(z_slices), ingest_job.img_size, ingest_job.datatype))
+
+
+def ingest_threads(boss_res_params, ingest_job, x_buckets, y_buckets, z_buckets, threads,
+                   post_pool=None, memory_budget=None, compress_pool=None):
+    # post_pool, compress_pool (and memory_budget) may be shared with other channels being ingested at the same time
+    # blocks are compressed by compress_pool then POSTed by post_pool, so the POST threads only wait on the network
+    z_buckets, slab_block_rngs = get_pending_blocks(
+        ingest_job, z_buckets, get_block_rngs(x_buckets, y_buckets))
+
+    pool = post_pool
+    if pool is None:
+        pool = ThreadPool(threads)
+    comp_pool = compress_pool
+    if comp_pool is None:
+        comp_pool = create_compress_pool(ingest_job.compress_threads)
+    compress_queue = BlockQueue(comp_pool, 2 * ingest_job.compress_threads)
+    post_queue = BlockQueue(pool, 2 * threads)
+
+    def post_block_done(slab_compression, block):
+        # runs as each block is compressed, blocking the compression stage while the POST queue is full
+        if block is None:
+            return
+        slab_compression.add(block.raw_nbytes, block.nbytes, block.compress_time)
+        post_queue.submit(post_compressed_block,
+                          (boss_res_params, ingest_job, block))
+
+    def slab_done(z_slices, im_array, slab_compression):
+        # the slab isn't needed once all its blocks are compressed
+        ingest_job.release_slab_buffer(im_array)
+        release_slab_memory(ingest_job, memory_budget, z_slices)
+        ingest_job.send_msg('{} {}'.format(
+            get_formatted_datetime(), slab_compression.status_msg()))
+
+    read_stack = partial(ingest_job.read_img_stack,
+                         block_starts=get_slab_block_starts(ingest_job, x_buckets, y_buckets))
+
+    # load images files in stacks one block deep at a time into numpy array
+    # the next slab(s) are read in the background while this one is POSTed
+    try:
+        for z_slices, im_array in read_slabs(ingest_job, z_buckets, ingest_job.prefetch_slabs,
+                                             read_stack, memory_budget):
+            z_rng = get_slab_z_rng(ingest_job, z_slices)
+            block_rngs = get_nonempty_blocks(ingest_job, x_buckets, y_buckets, z_rng,
+                                             slab_block_rngs[z_slices[0]], im_array)
+
+            slab_compression = SlabCompression(z_slices, ingest_job.codec)
+            slab_blocks = SlabBlocks(len(block_rngs), partial(slab_done, z_slices, im_array, slab_compression),
+                                     partial(post_block_done, slab_compression))
+
+            # slice into np array blocks
+            for x_rng, y_rng in block_rngs:
+                compress_queue.submit(compress_slab_block, (ingest_job, x_rng, y_rng, z_rng, im_array),
+                                      slab_blocks.block_done)
+        compress_queue.join()
+        post_queue.join()
+    finally:
+        if compress_pool is None:
+            comp_pool.close()
+            comp_pool.join()
+        if post_pool is None:
+            pool.close()
+            pool.join()
+
+
+def ingest_processes(args, ingest_job, x_buckets, y_buckets, z_buckets, threads, memory_budget=None):
+    # decode and POST in worker processes (no GIL contention), sharing each slab through shared memory
+    z_buckets, slab_block_rngs = get_pending_blocks(
+        ingest_job, z_buckets, get_block_rngs(x_buckets, y_buckets))
+
+    decode_pool = create_process_pool(ingest_job.read_threads, args, False)
+    post_pool = create_process_pool(threads, args, True)
+    block_queue = BlockQueue(post_pool, 2 * threads)
+
+    def count_block(slab_compression, result):
+        if result is None:
+            return
+        post_failures, compression, verify_block = result
+        ingest_job.num_POST_failures += post_failures
+        slab_compression.add(*compression)
+        if verify_block is not None and ingest_job.verifier is not None:
+            ingest_job.verifier.check(verify_block)
+
+    def release_slab(slab, z_slices, slab_compression):
+        # the shared slab is released once its last block is POSTed
+        release_shared_slab(ingest_job, slab)
+        release_slab_memory(ingest_job, memory_budget, z_slices)
+        ingest_job.send_msg('{} {}'.format(
+            get_formatted_datetime(), slab_compression.status_msg()))
+
+    block_starts = get_slab_block_starts(ingest_job, x_buckets, y_buckets)
+    read_stack = partial(read_shared_img_stack, decode_pool,
+                         ingest_job, block_starts=block_starts)
+    try:
+        for z_slices, slab in read_slabs(ingest_job, z_buckets, ingest_job.prefetch_slabs, read_stack,
+                                         memory_budget):
+            z_rng = get_slab_z_rng(ingest_job, z_slices)
+            block_rngs = get_nonempty_blocks(ingest_job, x_buckets, y_buckets, z_rng,
+                                             slab_block_rngs[z_slices[0]],
+                                             block_slab_view(slab.array, block_starts))
+
+            slab_compression = SlabCompression(z_slices, ingest_job.codec)
+            slab_blocks = SlabBlocks(len(block_rngs), partial(release_slab, slab, z_slices, slab_compression),
+                                     partial(count_block, slab_compression))
+            for x_rng, y_rng in block_rngs:
+                block_queue.submit(ingest_shared_block,
+                                   (slab.name, slab.shape, slab.dtype.str,
+                                    x_rng, y_rng, z_rng, block_starts),
+                                   slab_blocks.block_done)
+        block_queue.join()
+    finally:
+        for pool in (decode_pool, post_pool):
+            pool.close()
+            pool.join()
+
+
+def ingest_z_range(args, boss_res_params, ingest_job, z_range, threads,
+                   post_pool=None, memory_budget=None, compress_pool=None):
+    stride_x, stride_y, stride_z = ingest_job.block_shape
+    x_buckets = get_supercube_lims(ingest_job.x_extent, stride_x)
+    y_buckets = get_supercube_lims(ingest_job.y_extent, stride_y)
+    # slabs are bucketed in the Boss frame, so offset volumes still POST whole cuboids
+    z_buckets = get_supercube_lims(z_range, stride_z, get_z_origin(ingest_job))
+
+    if ingest_job.executor == 'process':
+        ingest_processes(args, ingest_job, x_buckets, y_buckets, z_buckets, threads,
+                         memory_budget)
+    else:
+        ingest_threads(boss_res_params, ingest_job, x_buckets, y_buckets, z_buckets, threads,
+                       post_pool, memory_budget, compress_pool)
 
 
-def per_channel_ingest(args, channel, threads=8):
+# block shapes (x, y, z) tried by --tune_blocks, along with the one given by --block_shape
+TUNE_BLOCK_SHAPES = [[512, 512, 16], [1024, 1024, 16], [2048, 2048, 16],
+                     [512, 512, 32], [1024, 1024, 32],
+                     [512, 512, 64], [1024, 1024, 64]]
+
+
+def get_tune_region(ingest_job, block_shapes):
+    # sample (x_rng, y_rng, z_rng of the images) at the start of the volume, as large as the largest block shape
+    size = [max(block_shape[dim] for block_shape in block_shapes)
+            for dim in range(3)]
+    starts = [ingest_job.x_extent[0], ingest_job.y_extent[0], ingest_job.z_range[0]]
+    stops = [ingest_job.x_extent[1], ingest_job.y_extent[1], ingest_job.z_range[1]]
+    return [[start, min(stop, start + dim_size)] for start, stop, dim_size in zip(starts, stops, size)]
+
+
+def get_tune_candidates(ingest_job):
+    # the block shapes to try: --block_shape and those of TUNE_BLOCK_SHAPES that can be compressed
+    # and aren't larger than the volume (rounded up to whole cuboids)
+    volume = [ingest_job.x_extent, ingest_job.y_extent, ingest_job.z_range]
+    candidates = [ingest_job.block_shape]
+    for block_shape in TUNE_BLOCK_SHAPES:
+        if block_shape in candidates:
+            continue
+        try:
+            validate_block_shape(block_shape, ingest_job.get_post_datatype())
+        except ValueError:
+            continue
+        if all(size <= -(-(rng[1] - rng[0]) // cuboid) * cuboid
+               for size, rng, cuboid in zip(block_shape, volume, BOSS_CUBOID)):
+            candidates.append(block_shape)
+    return candidates
+
+
+def read_tune_sample(ingest_job, region):
+    # decodes the sample region of each image, keeping one whole image at a time
+    x_rng, y_rng, z_rng = region
+    sample = np.zeros((z_rng[1] - z_rng[0], y_rng[1] - y_rng[0], x_rng[1] - x_rng[0]),
+                      dtype=ingest_job.datatype)
+    for idx, z_slice in enumerate(range(z_rng[0], z_rng[1])):
+        img = ingest_job.load_img(z_slice)
+        if img is not None:
+            sample[idx] = img[y_rng[0] - ingest_job.y_extent[0]:y_rng[1] - ingest_job.y_extent[0],
+                              x_rng[0] - ingest_job.x_extent[0]:x_rng[1] - ingest_job.x_extent[0]]
+    return sample
+
+
+def time_block_shape(boss_res_params, ingest_job, pool, sample, region, block_shape):
+    # compresses and POSTs the sample in blocks of block_shape, returns the time taken and the POST failures
+    x_rng, y_rng, z_rng = region
+    block_rngs = list(CuboidGrid(x_rng, y_rng, z_rng, block_shape,
+                                 (0, 0, get_z_origin(ingest_job))))
+
+    def post_sample_block(block_rng):
+        block_x_rng, block_y_rng, block_z_rng = block_rng
+        data = sample[block_z_rng[0] - z_rng[0]:block_z_rng[1] - z_rng[0],
+                      block_y_rng[0] - y_rng[0]:block_y_rng[1] - y_rng[0],
+                      block_x_rng[0] - x_rng[0]:block_x_rng[1] - x_rng[0]]
+        boss_z_rng = get_slab_z_rng(ingest_job, range(*block_z_rng))
+        block = compress_block(ingest_job.codec, block_x_rng, block_y_rng, boss_z_rng, data,
+                               ingest_job.get_post_datatype())
+        return post_cutout(boss_res_params, ingest_job, block_x_rng, block_y_rng, boss_z_rng, block)
+
+    start_time = time.time()
+    post_failures = sum(pool.map(post_sample_block, block_rngs, chunksize=1))
+    return time.time() - start_time, post_failures
+
+
+def tune_block_shape(boss_res_params, ingest_job, threads):
+    # POSTs a sample of the volume (data the ingest POSTs again) in each candidate block shape,
+    # returns the fastest shape (or the current one if there's nothing to choose from)
+    candidates = get_tune_candidates(ingest_job)
+    if len(candidates) < 2:
+        return ingest_job.block_shape
+
+    region = get_tune_region(ingest_job, candidates)
+    ingest_job.send_msg('{} Tuning block shape on x: {}, y: {}, z: {} with candidates {}'.format(
+        get_formatted_datetime(), region[0], region[1], region[2], candidates))
+    sample = read_tune_sample(ingest_job, region)
+    nbytes = sample.size * np.dtype(ingest_job.get_post_datatype()).itemsize
+
+    timings = []
+    with ThreadPool(threads) as pool:
+        # the first candidate is POSTed once untimed, so every candidate runs on open connections
+        time_block_shape(boss_res_params, ingest_job, pool, sample, region, candidates[0])
+        for block_shape in candidates:
+            post_time, post_failures = time_block_shape(
+                boss_res_params, ingest_job, pool, sample, region, block_shape)
+            ingest_job.send_msg('{} Block shape {}: {:.2f} sec ({:.1f} MB/sec), {} POST failures'.format(
+                get_formatted_datetime(), block_shape, post_time, nbytes / 1024**2 / max(post_time, 1e-6),
+                post_failures))
+            if post_failures == 0:
+                timings.append((post_time, block_shape))
+
+    if not timings:
+        ingest_job.send_msg('{} Every block shape had POST failures, keeping block shape {}'.format(
+            get_formatted_datetime(), ingest_job.block_shape))
+        return ingest_job.block_shape
+    block_shape = min(timings)[1]
+    ingest_job.send_msg('{} Tuned block shape: {}'.format(
+        get_formatted_datetime(), block_shape))
+    return block_shape
+
+
+def get_z_shards(z_range, shard_size, stride=16, origin=0):
+    # splits z_range into shards that start and stop on multiples of shard_size (itself a multiple of stride)
+    # from origin (the image slice at Boss z = 0)
+    shard_size = max(stride, shard_size // stride * stride)
+    return list(GridAxis(z_range, shard_size, origin).ranges())
+
+
+def get_worker_pools(threads):
+    # the worker's POST and compress pools, created for its first shard and reused by the others,
+    # so the POST threads (and their sessions and connections) live as long as the worker
+    global worker_post_pool, worker_compress_pool
+    if worker_post_pool is None:
+        worker_post_pool = ThreadPool(threads)
+        worker_compress_pool = create_compress_pool(
+            worker_ingest_job.compress_threads)
+    return worker_post_pool, worker_compress_pool
+
+
+def ingest_shard(z_range, threads=8):
+    # runs in a supervised worker process, reusing the worker's ingest job and Boss resources for every shard
+    ingest_job = worker_ingest_job
+    ingest_job.num_READ_failures = 0
+    ingest_job.num_POST_failures = 0
+    if ingest_job.adaptive_threads and ingest_job.post_controller is None:
+        ingest_job.post_controller = AIMDController(
+            threads, log=ingest_job.send_msg)
+    if ingest_job.verify_fraction and ingest_job.verifier is None:
+        ingest_job.verifier = create_verifier(worker_boss_res_params, ingest_job)
+
+    post_pool, compress_pool = get_worker_pools(threads)
+    start_time = time.time()
+    ingest_z_range(None, worker_boss_res_params, ingest_job, z_range, threads,
+                   post_pool=post_pool, compress_pool=compress_pool)
+    # the shard's sampled blocks are checked before it is reported as finished
+    verify_stats = {'verified': 0, 'mismatches': 0}
+    if ingest_job.verifier is not None:
+        ingest_job.verifier.join()
+        verify_stats = ingest_job.verifier.stats()
+
+    # the worker's POST threads (and their sessions) are kept across shards, so the counts are totals for the worker
+    session_stats = worker_boss_res_params.sessions.stats()
+    return {'worker': os.getpid(),
+            'z_range': z_range,
+            'read_failures': ingest_job.num_READ_failures,
+            'post_failures': ingest_job.num_POST_failures,
+            'time': time.time() - start_time,
+            'requests': session_stats['requests'],
+            'connections': session_stats['connections'],
+            'verified': verify_stats['verified'],
+            'mismatches': verify_stats['mismatches']}
+
+
+def ingest_shards(args, ingest_job, threads):
+    # supervisor: z_range is split into small block aligned shards handed out one at a time,
+    # so workers that finish early (e.g. sparse z ranges) pick up the remaining shards
+    block_z = ingest_job.block_shape[2]
+    shards = get_z_shards(ingest_job.z_range,
+                          ingest_job.shard_slabs * block_z, block_z, get_z_origin(ingest_job))
+    ingest_job.send_msg('{} Ingesting {} shards of z range {} with {} workers'.format(
+        get_formatted_datetime(), len(shards), ingest_job.z_range, ingest_job.workers))
+
+    worker_summaries = defaultdict(lambda: defaultdict(float))
+    with create_process_pool(ingest_job.workers, args, True) as pool:
+        for result in pool.imap_unordered(partial(ingest_shard, threads=threads), shards):
+            ingest_job.num_READ_failures += result['read_failures']
+            ingest_job.num_POST_failures += result['post_failures']
+
+            worker_summary = worker_summaries[result['worker']]
+            worker_summary['shards'] += 1
+            worker_summary['slices'] += result['z_range'][1] - \
+                result['z_range'][0]
+            worker_summary['read_failures'] += result['read_failures']
+            worker_summary['post_failures'] += result['post_failures']
+            worker_summary['time'] += result['time']
+            worker_summary['requests'] = max(
+                worker_summary['requests'], result['requests'])
+            worker_summary['connections'] = max(
+                worker_summary['connections'], result['connections'])
+            worker_summary['verified'] = max(
+                worker_summary['verified'], result['verified'])
+            worker_summary['mismatches'] = max(
+                worker_summary['mismatches'], result['mismatches'])
+
+            ingest_job.send_msg('{} Worker {} finished z range {} in {:.2f} sec'.format(
+                get_formatted_datetime(), result['worker'], result['z_range'], result['time']))
+
+    summary = ['{} Worker summary for z range {}:'.format(
+        get_formatted_datetime(), ingest_job.z_range)]
+    for worker, worker_summary in sorted(worker_summaries.items()):
+        summary.append('Worker {}: {:.0f} shards, {:.0f} slices, {:.0f} read failures, {:.0f} POST failures, {:.2f} sec, {:.0f} requests over {:.0f} connections, {:.0f} blocks verified ({:.0f} mismatches)'.format(
+            worker, worker_summary['shards'], worker_summary['slices'], worker_summary['read_failures'],
+            worker_summary['post_failures'], worker_summary['time'], worker_summary['requests'],
+            worker_summary['connections'], worker_summary['verified'], worker_summary['mismatches']))
+    ingest_job.send_msg('\n'.join(summary))
+    return worker_summaries
+
+
+def open_block_records(ingest_job):
+    # finished blocks are journaled so an interrupted ingest can resume, otherwise we start a new journal
+    # (each z range of a channel has its own journal, so runs on other z ranges keep theirs)
+    journal_fname = ingest_job.get_journal_fname()
+    if not ingest_job.resume:
+        open(journal_fname, 'w').close()
+    ingest_job.journal = BlockJournal(journal_fname, ingest_job.resume)
+
+    # every run on the channel appends to its manifest, whatever its z range (the last record of a block wins)
+    if ingest_job.write_manifest:
+        ingest_job.manifest = BlockManifest(ingest_job.get_manifest_fname())
+
+
+def per_channel_ingest(args, channel, threads=8, post_pool=None, memory_budget=None, post_controller=None,
+                       rate_limiter=None, compress_pool=None, slab_pool=None):
+    # post_pool, memory_budget, post_controller, rate_limiter, compress_pool and slab_pool can be shared by channels
+    # ingested at the same time
     args.channel = channel
     ingest_job = IngestJob(args)
 
@@ -212,31 +1059,62 @@ def per_channel_ingest(args, channel, threads=8):
         ingest_job.send_msg('{} Starting ingest for Collection: {}, Experiment: {}, Channel: {}, Z: {z[0]},{z[1]}'.format(
             get_formatted_datetime(), ingest_job.coll_name, ingest_job.exp_name, ingest_job.ch_name, z=ingest_job.z_range))
 
-    # we begin the ingest here:
-    stride_x = 1024
-    stride_y = 1024
-    stride_z = 16
-    x_buckets = get_supercube_lims(ingest_job.x_extent, stride_x)
-    y_buckets = get_supercube_lims(ingest_job.y_extent, stride_y)
-    z_buckets = get_supercube_lims(ingest_job.z_range, stride_z)
+    # with adaptive threads, the number of POSTs in flight follows latency and errors (up to threads)
+    if post_controller is None and ingest_job.adaptive_threads and ingest_job.workers == 1:
+        post_controller = AIMDController(threads)
+    if post_controller is not None and post_controller.log is None:
+        post_controller.log = ingest_job.send_msg
+    ingest_job.post_controller = post_controller
+
+    # worker processes set up their own share of the upload limits
+    if rate_limiter is None and ingest_job.workers == 1:
+        rate_limiter = create_rate_limiter(ingest_job)
+    if rate_limiter is not None:
+        if rate_limiter.log is None:
+            rate_limiter.log = ingest_job.send_msg
+        ingest_job.send_msg(rate_limiter.status_msg())
+    ingest_job.rate_limiter = rate_limiter
+
+    # the ingest (and its worker processes) use the block shape that was fastest on a sample of the volume
+    if ingest_job.tune_blocks:
+        if ingest_job.resume:
+            ingest_job.send_msg('Not tuning the block shape when resuming, the journal has blocks of shape {}'.format(
+                ingest_job.block_shape))
+        else:
+            ingest_job.block_shape = tune_block_shape(
+                boss_res_params, ingest_job, threads)
+            args.block_shape = ingest_job.block_shape
 
-    pool = ThreadPool(threads)
+    warn_partial_cuboids(ingest_job, ingest_job.z_range)
 
-    # load images files in stacks of 16 at a time into numpy array
-    for _, z_slices in z_buckets.items():
-        # read images into numpy array
-        im_array = ingest_job.read_img_stack(z_slices)
-        z_rng = [z_slices[0] - ingest_job.offsets[2],
-                 z_slices[-1] + 1 - ingest_job.offsets[2]]
+    open_block_records(ingest_job)
 
-        # slice into np array blocks
-        for _, y_slices in y_buckets.items():
-            y_rng = [y_slices[0], y_slices[-1] + 1]
+    # slab buffers are reused from slab to slab (and by the other channels sharing the pool)
+    own_slab_pool = slab_pool is None
+    if own_slab_pool:
+        slab_pool = create_slab_pool(ingest_job.prefetch_slabs)
+    ingest_job.slab_pool = slab_pool
 
-            ingest_block_partial = partial(
-                ingest_block, x_buckets=x_buckets, boss_res_params=boss_res_params, ingest_job=ingest_job,
-                y_rng=y_rng, z_rng=z_rng, im_array=im_array)
-            pool.map(ingest_block_partial, x_buckets.keys())
+    # a sample of the POSTed blocks is checked in the background (by each worker when ingesting shards)
+    if ingest_job.verify_fraction and ingest_job.workers == 1:
+        ingest_job.verifier = create_verifier(boss_res_params, ingest_job)
+
+    # we begin the ingest here:
+    try:
+        if ingest_job.workers > 1:
+            ingest_shards(args, ingest_job, threads)
+        else:
+            ingest_z_range(args, boss_res_params, ingest_job,
+                           ingest_job.z_range, threads, post_pool, memory_budget, compress_pool)
+    finally:
+        if own_slab_pool:
+            slab_pool.clear()
+        if ingest_job.verifier is not None:
+            ingest_job.verifier.close()
+            ingest_job.send_msg('{} {}'.format(
+                get_formatted_datetime(), ingest_job.verifier.status_msg()))
+        if ingest_job.s3_reader is not None:
+            ingest_job.s3_reader.close()
 
     # checking data posted correctly for an entire z slice
     assert_equal(boss_res_params, ingest_job, ingest_job.z_range)
@@ -248,10 +1126,76 @@ def per_channel_ingest(args, channel, threads=8):
         get_formatted_datetime(),
         ingest_job.z_range, ingest_job.coll_name, ingest_job.exp_name, ingest_job.ch_name,
         ingest_job.num_READ_failures, ingest_job.num_POST_failures, ch_link), send_slack=True)
+    if post_controller is not None:
+        ingest_job.send_msg(post_controller.status_msg())
+    if ingest_job.workers == 1 and ingest_job.executor == 'thread':
+        ingest_job.send_msg(boss_res_params.sessions.status_msg())
+    if ingest_job.workers == 1:
+        ingest_job.send_msg(slab_pool.status_msg())
+    if ingest_job.workers == 1 and ingest_job.s3_reader is not None:
+        ingest_job.send_msg(ingest_job.s3_reader.status_msg())
+    boss_res_params.sessions.close()
+
+    ingest_job.journal.close()
+    ingest_job.send_msg('Journal {}: {done} blocks done, {empty} empty, {failed} failed'.format(
+        ingest_job.journal.path, **count_statuses(ingest_job.journal.path)))
+    if ingest_job.manifest is not None:
+        ingest_job.manifest.close()
+        ingest_job.send_msg('Manifest {} written, check the Boss against it with verify_ingest.py'.format(
+            ingest_job.manifest.path))
 
     return 0
 
 
+def ingest_channels(args, channels):
+    # channels share one pool of POST threads (the global POST concurrency limit), one pool of
+    # compression threads, one memory budget and one pool of slab buffers
+    # each channel gets its own copy of args, as per_channel_ingest sets the channel on it
+    if args.concurrent_channels > 1 and (args.executor == 'process' or args.workers > 1):
+        raise ValueError(
+            'concurrent channels are only supported with the thread executor and a single worker')
+
+    memory_budget = None
+    if args.max_memory_gb is not None:
+        memory_budget = MemoryBudget(args.max_memory_gb * 1024**3)
+
+    post_controller = None
+    if args.adaptive_threads and args.workers == 1:
+        # logs to the log of the first channel using it
+        post_controller = AIMDController(args.threads)
+
+    # one limit on upload bandwidth and POST rate for the whole process
+    # (the worker processes of --workers have their own, SIGHUP is forwarded to them)
+    rate_limiter = None
+    if args.workers == 1:
+        rate_limiter = create_rate_limiter(args)
+    prev_handler = set_supervisor_reload_signal(args.limits_file, rate_limiter)
+
+    slab_pool = create_slab_pool(
+        args.prefetch_slabs, min(args.concurrent_channels, len(channels)))
+
+    try:
+        with ThreadPool(args.threads) as post_pool, create_compress_pool(args.compress_threads) as compress_pool:
+            ingest_channel = partial(per_channel_ingest_args, args, threads=args.threads,
+                                     post_pool=post_pool, memory_budget=memory_budget,
+                                     post_controller=post_controller, rate_limiter=rate_limiter,
+                                     compress_pool=compress_pool, slab_pool=slab_pool)
+            if args.concurrent_channels > 1 and len(channels) > 1:
+                with ThreadPool(min(args.concurrent_channels, len(channels))) as channel_pool:
+                    results = channel_pool.map(ingest_channel, channels, chunksize=1)
+            else:
+                results = [ingest_channel(channel) for channel in channels]
+    finally:
+        slab_pool.clear()
+        if prev_handler is not None:
+            signal.signal(signal.SIGHUP, prev_handler)
+    return results
+
+
+def per_channel_ingest_args(args, channel, **kwargs):
+    return per_channel_ingest(argparse.Namespace(**vars(args)), channel, **kwargs)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Copy image z stacks to Boss for a single channel')
@@ -307,11 +1251,63 @@ def main():
 
     parser.add_argument('--warn_missing_files', action='store_true',
                         help='Warn on missing files instead of failing')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Number of threads POSTing blocks, shared by all channels (default = 8)')
+    parser.add_argument('--adaptive_threads', action='store_true',
+                        help='Adapt the number of POSTs in flight (up to --threads) to the latency and errors from the Boss (thread executor only)')
+    parser.add_argument('--concurrent_channels', type=int, default=1,
+                        help='Number of channels (from --channels_list_file) to ingest at the same time (default = 1)')
+    parser.add_argument('--max_memory_gb', type=float,
+                        help='Limit on the memory used by slabs across all channels, in GB (default = no limit)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes ingesting z shards in parallel (default = 1). Each worker holds its own slabs in memory')
+    parser.add_argument('--shard_slabs', type=int, default=4,
+                        help='Number of slabs (one block deep) in each z shard handed to a worker (default = 4)')
+    parser.add_argument('--block_shape', type=int, nargs=3, default=[1024, 1024, 16], metavar=('X', 'Y', 'Z'),
+                        help='Shape of the blocks POSTed to the Boss, a multiple of its 512 512 16 cuboid of at most 1024*1024*64 voxels. Slabs are one block deep (default = 1024 1024 16)')
+    parser.add_argument('--edge_cuboids', type=str, default='warn', choices=['warn', 'pad'],
+                        help='Log the edges of the ingest that POST partial Boss cuboids, or pad the blocks at the edges of the data with zeros to whole cuboids within the coordinate frame (only when nothing else is ingested there) (default = warn)')
+    parser.add_argument('--tune_blocks', action='store_true',
+                        help='POST a sample of the volume in several block shapes (up to 64 slices deep) and ingest with the fastest. Resuming keeps --block_shape')
+    parser.add_argument('--executor', type=str, default='thread', choices=['thread', 'process'],
+                        help='Run decode and POST workers as threads or as processes sharing each slab through shared memory (default = thread)')
+    parser.add_argument('--read_threads', type=int, default=4,
+                        help='Number of threads decoding the images of a slab (default = 4)')
+    parser.add_argument('--slab_layout', type=str, default='row', choices=['row', 'block'],
+                        help='Store slabs row by row, or block by block so blocks are compressed and POSTed without copying them out of the slab (default = row)')
+    parser.add_argument('--slab_backing', type=str, default='memory',
+                        help='Hold slabs in memory, or back them with files in a scratch directory (mmap:<directory>, e.g. mmap:/scratch on local NVMe) to ingest sections larger than RAM (default = memory)')
+    parser.add_argument('--prefetch_slabs', type=int, default=1,
+                        help='Number of slabs to read ahead while POSTing (default = 1, 0 disables read ahead). Each slab adds to memory usage')
+    parser.add_argument('--compress_threads', type=int, default=4,
+                        help='Number of threads compressing blocks before they are POSTed, shared by all channels (default = 4)')
+    parser.add_argument('--compression', type=str, action='append',
+                        help='Blosc compression for a datatype as datatype:compressor:level:shuffle, e.g. uint16:lz4:5:bitshuffle. Can be repeated for each datatype (default = blosclz:9:shuffle)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume an interrupted ingest, skipping the blocks its journal (ingest_journal_<coll>_<exp>_<ch>_z<start>-<stop>.txt, one per z range) has as done or empty')
+    parser.add_argument('--manifest', action='store_true',
+                        help='Record every block with a hash of its voxels in a manifest (ingest_manifest_<coll>_<exp>_<ch>.txt, appended to by every run on the channel) for verify_ingest.py')
+    parser.add_argument('--verify_fraction', type=float, default=0,
+                        help='Fraction of the POSTed blocks to GET back from the Boss and compare against what was POSTed while the ingest goes on (default = 0, none)')
+    parser.add_argument('--verify_threads', type=int, default=1,
+                        help='Number of threads verifying the sampled blocks (default = 1). Blocks are left unchecked when the verifier falls behind')
+    parser.add_argument('--max_mb_per_sec', type=float,
+                        help='Limit on upload bandwidth to the Boss in MB/sec, split evenly between worker processes (default = no limit)')
+    parser.add_argument('--max_posts_per_sec', type=float,
+                        help='Limit on POSTs to the Boss per second, split evenly between worker processes (default = no limit)')
+    parser.add_argument('--limits_file', type=str,
+                        help='Path to a file with mb_per_sec and posts_per_sec under [Limits], overriding the limits while running. Re-read when it changes or on SIGHUP')
 
     parser.add_argument('--s3_bucket_name', type=str,
                         help='S3 bucket name')
     parser.add_argument('--aws_profile', type=str, default='default',
                         help='Name of profile in .aws/credentials file (default = default)')
+    parser.add_argument('--s3_prefetch_mb', type=float, default=512,
+                        help='MB of images of the next slab fetched from S3 while the current one is ingested, 0 to turn off (default = 512)')
+    parser.add_argument('--s3_range_mb', type=float, default=64,
+                        help='Images larger than this are downloaded from S3 in ranges of this size, 0 for a single GET per image (default = 64)')
+    parser.add_argument('--s3_range_threads', type=int, default=8,
+                        help='Number of ranges of a large image downloaded at a time (default = 8)')
 
     parser.add_argument('--boss_config_file', type=str, default='neurodata.cfg',
                         help='Path and filename for Boss config (config file w/ server and API Key)')
@@ -357,8 +1353,7 @@ def main():
     else:
         channels = [args.channel]
 
-    for channel in channels:
-        per_channel_ingest(args, channel)
+    ingest_channels(args, channels)
 
 
 if __name__ == '__main__':
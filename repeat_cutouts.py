@@ -131,7 +131,8 @@ def ingest_cuts(cutouts, ingest_job, boss_res_params):
             imgdata = ImgData(im_array, cut.z)
 
         data = imgdata.im_data[:, cut.y[0]:cut.y[1], cut.x[0]:cut.x[1]]
-        data = np.asarray(data, order='C')
+        data = np.asarray(
+            data, dtype=ingest_job.get_post_datatype(), order='C')
         ret_val = post_cutout(boss_res_params, ingest_job, cut.x,
                               cut.y, cut.z, data, attempts=2)
         if ret_val == 0:
@@ -17,8 +17,9 @@ from PIL import Image
 import sys
 sys.path.append("..")
 
-from ingest_large_vol import get_supercube_lims, post_cutout
+from ingest_large_vol import post_cutout
 from src.ingest.boss_resources import BossResParams
+from src.ingest.cuboid_grid import CuboidGrid
 from src.ingest.ingest_job import IngestJob
 
 # filenames on s3 (z/RES/y_x.png):
@@ -89,9 +90,10 @@ def main():
     s3 = boto3.client('s3', region_name='us-east-1')
 
     # iterate over blocks of 16
-    stride_size = 16
-    z_buckets = get_supercube_lims(ingest_job.z_range, stride=stride_size)
-    for _, slices in sorted(z_buckets.items()):
+    block_size = 1024  # evenly divisible into x/y widths
+    grid = CuboidGrid(ingest_job.x_extent, ingest_job.y_extent, ingest_job.z_range,
+                      [block_size, block_size, 16])
+    for z_bucket, slices in grid.z.items():
         print('iterating over z slices: {}:{} (inclusive)'.format(
             slices[0], slices[-1]))
         data = np.zeros((len(slices), ingest_job.y_extent[1], ingest_job.x_extent[1]),
@@ -121,20 +123,15 @@ def main():
 
         x_rng = ingest_job.x_extent
         y_rng = ingest_job.y_extent
-        z_rng = [slices[0], slices[-1] + 1]
 
-        block_size = 1024  # evenly divisible into x/y widths
         pool_args = []
-        for yy in range(y_rng[0], y_rng[1], block_size):
-            yy_rng = [yy, yy + block_size]
-            for xx in range(x_rng[0], x_rng[1], block_size):
-                xx_rng = [xx, xx + block_size]
-                sub_data = data[:,
-                                yy_rng[0] - y_rng[0]:yy_rng[1] - y_rng[0],
-                                xx_rng[0] - x_rng[0]:xx_rng[1] - x_rng[0]]
-                sub_data = np.asarray(sub_data, order='C')
-                pool_args.append((boss_res_params, ingest_job,
-                                  xx_rng, yy_rng, z_rng, sub_data))
+        for xx_rng, yy_rng, z_rng in grid.slab_blocks(z_bucket):
+            sub_data = data[:,
+                            yy_rng[0] - y_rng[0]:yy_rng[1] - y_rng[0],
+                            xx_rng[0] - x_rng[0]:xx_rng[1] - x_rng[0]]
+            sub_data = np.asarray(sub_data, order='C')
+            pool_args.append((boss_res_params, ingest_job,
+                              xx_rng, yy_rng, z_rng, sub_data))
 
         # print(pool_args)
         threads = 8
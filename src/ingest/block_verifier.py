@@ -0,0 +1,119 @@
+'''
+Sampled verification of the blocks POSTed to the BOSS while the ingest goes on
+A fraction of the POSTed blocks are GET back in a small background pool and compared against their
+compressed payload (kept until the block is checked), instead of re-reading the images at the end
+'''
+
+import random
+import threading
+import time
+from multiprocessing.dummy import Pool as ThreadPool
+
+import numpy as np
+
+try:
+    from compression import decompress_block
+except ImportError:
+    from .compression import decompress_block
+
+
+class BlockVerifier:
+    def __init__(self, get_cutout, fraction, threads=1, max_pending=32, log=None, report_interval=300):
+        # get_cutout(x_rng, y_rng, z_rng) GETs a block from the BOSS, log(msg, send_slack) reports mismatches
+        # at most max_pending blocks wait to be checked, more are left unchecked so the ingest never waits on us
+        self.get_cutout = get_cutout
+        self.fraction = fraction
+        self.max_pending = max_pending
+        self.pool = ThreadPool(threads)
+
+        self.pending = 0
+        self.cond = threading.Condition()
+
+        self.num_verified = 0
+        self.num_mismatches = 0
+        self.num_errors = 0
+        self.num_skipped = 0
+
+        self.log = log
+        self.report_interval = report_interval
+        self.last_report = time.time()
+
+    def submit(self, block):
+        # verifies a sample of the POSTed (compressed) blocks
+        if sample_block(self.fraction):
+            self.check(block)
+
+    def check(self, block):
+        # queues the block to be GET back and compared
+        with self.cond:
+            if self.pending >= self.max_pending:
+                self.num_skipped += 1
+                return
+            self.pending += 1
+        self.pool.apply_async(self.verify, (block,))
+
+    def verify(self, block):
+        try:
+            expected = decompress_block(block)
+            try:
+                actual = self.get_cutout(block.x_rng, block.y_rng, block.z_rng)
+            except Exception as e:
+                with self.cond:
+                    self.num_errors += 1
+                self.send_msg('Verify GET failed for x: {}, y: {}, z: {}: {}'.format(
+                    block.x_rng, block.y_rng, block.z_rng, e))
+                return
+
+            matches = np.array_equal(np.asarray(actual), expected)
+            with self.cond:
+                self.num_verified += 1
+                if not matches:
+                    self.num_mismatches += 1
+            if not matches:
+                self.send_msg('Verify *MISMATCH*: block x: {}, y: {}, z: {} in the Boss does not match what was POSTed'.format(
+                    block.x_rng, block.y_rng, block.z_rng), send_slack=True)
+        finally:
+            with self.cond:
+                self.pending -= 1
+                self.cond.notify_all()
+            self.report()
+
+    def join(self):
+        # waits for the queued blocks to be checked
+        with self.cond:
+            while self.pending:
+                self.cond.wait()
+
+    def close(self):
+        self.join()
+        self.pool.close()
+        self.pool.join()
+
+    def stats(self):
+        with self.cond:
+            return {'verified': self.num_verified,
+                    'mismatches': self.num_mismatches,
+                    'errors': self.num_errors,
+                    'skipped': self.num_skipped}
+
+    def status_msg(self):
+        return 'Verified {verified} sampled blocks: {mismatches} mismatches, {errors} GET failures, {skipped} left unchecked (verifier busy)'.format(
+            **self.stats())
+
+    def send_msg(self, msg, send_slack=False):
+        if self.log is not None:
+            self.log(msg, send_slack)
+
+    def report(self):
+        # logs the counts every report_interval seconds
+        now = time.time()
+        with self.cond:
+            if now - self.last_report < self.report_interval:
+                return
+            self.last_report = now
+        self.send_msg(self.status_msg())
+
+
+def sample_block(fraction):
+    # whether a POSTed block is picked for verification
+    return random.random() < fraction
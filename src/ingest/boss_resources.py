@@ -12,6 +12,11 @@ from intern.remote.boss import BossRemote
 from intern.resource.boss.resource import *
 from intern.service.boss.httperrorlist import HTTPErrorList
 
+try:
+    from boss_sessions import BossSessions
+except ImportError:
+    from .boss_sessions import BossSessions
+
 
 class BossResParams:
     def __init__(self, ingest_job, get_only=True):
@@ -21,6 +26,8 @@ class BossResParams:
             (ingest_job.coll_name, ingest_job.exp_name))
 
         self.rmt = BossRemote(self.ingest_job.boss_config_file)
+        # cutouts are POSTed on per thread keep-alive sessions
+        self.sessions = BossSessions(self.rmt)
 
         self.coll_resource = self.setup_boss_collection(get_only=get_only)
 
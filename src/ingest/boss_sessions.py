@@ -0,0 +1,97 @@
+'''
+Keep-alive HTTP sessions for POSTing cutouts to the BOSS
+Each POST thread gets its own session holding one pooled connection, reused across slabs,
+instead of every thread sharing the remote's session (and its default sized connection pool)
+'''
+
+import threading
+
+from requests import HTTPError, Session
+from requests.adapters import HTTPAdapter
+
+
+class BossSessions:
+    def __init__(self, rmt, pool_maxsize=1):
+        # rmt is the BossRemote the sessions POST for (same host, token and send options)
+        self.volume = rmt._volume
+        self.pool_maxsize = pool_maxsize
+        self.local = threading.local()
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    def get_session(self):
+        # the session of the calling thread, created on first use
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = Session()
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=self.pool_maxsize)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            with self.lock:
+                self.sessions.append(session)
+            self.local.session = session
+        return session
+
+    def create_cutout(self, resource, resolution, x_rng, y_rng, z_rng, data):
+        # same as BossRemote.create_cutout, but on the calling thread's session
+        return self.volume.service.create_cutout(resource, resolution, x_rng, y_rng, z_rng, None, data,
+                                                 self.volume.url_prefix, self.volume.auth,
+                                                 self.get_session(), self.volume.session_send_opts)
+
+    def create_compressed_cutout(self, resource, resolution, x_rng, y_rng, z_rng, payload):
+        # POSTs a cutout already compressed with blosc
+        service = self.volume.service
+        req = service.get_cutout_request(resource, 'POST', 'application/blosc',
+                                         self.volume.url_prefix, self.volume.auth,
+                                         resolution, x_rng, y_rng, z_rng, None, numpyVolume=payload)
+        session = self.get_session()
+        resp = session.send(session.prepare_request(req),
+                            **self.volume.session_send_opts)
+        if resp.status_code == 201:
+            return
+        msg = 'Create cutout failed on {}, got HTTP response: ({}) - {}'.format(
+            resource.name, resp.status_code, resp.text)
+        raise HTTPError(msg, request=req, response=resp)
+
+    def stats(self):
+        # requests sent and connections opened (a request not needing a new connection reused one)
+        with self.lock:
+            sessions = list(self.sessions)
+        num_requests = 0
+        num_connections = 0
+        for session in sessions:
+            for pool in get_connection_pools(session):
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+        return {'sessions': len(sessions),
+                'requests': num_requests,
+                'connections': num_connections,
+                'reused': max(0, num_requests - num_connections)}
+
+    def status_msg(self):
+        stats = self.stats()
+        reuse = stats['reused'] / stats['requests'] * 100 if stats['requests'] else 0
+        return '{sessions} POST sessions sent {requests} requests over {connections} connections ({0:.1f}% reused)'.format(
+            reuse, **stats)
+
+    def close(self):
+        with self.lock:
+            sessions = self.sessions
+            self.sessions = []
+        for session in sessions:
+            session.close()
+        self.local = threading.local()
+
+
+def get_connection_pools(session):
+    pools = []
+    for adapter in set(session.adapters.values()):
+        pool_manager = getattr(adapter, 'poolmanager', None)
+        if pool_manager is None:
+            continue
+        for key in pool_manager.pools.keys():
+            pool = pool_manager.pools.get(key)
+            if pool is not None:
+                pools.append(pool)
+    return pools
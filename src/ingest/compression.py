@@ -0,0 +1,135 @@
+'''
+Blosc compression of blocks before they are POSTed to the BOSS
+The codec, level and shuffle are set per datatype (e.g. "uint16:lz4:5:shuffle")
+'''
+
+import threading
+import time
+
+import blosc
+import numpy as np
+
+try:
+    from manifest import block_digest
+except ImportError:
+    from .manifest import block_digest
+
+SHUFFLES = {'noshuffle': blosc.NOSHUFFLE,
+            'shuffle': blosc.SHUFFLE,
+            'bitshuffle': blosc.BITSHUFFLE}
+
+# what intern's create_cutout uses, unless set with --compression
+DEFAULT_CODEC = ('blosclz', 9, 'shuffle')
+
+
+class BlockCodec:
+    def __init__(self, cname='blosclz', clevel=9, shuffle='shuffle'):
+        if cname not in blosc.cnames:
+            raise ValueError('Compressor must be one of {}'.format(
+                ', '.join(blosc.cnames)))
+        if not 0 <= clevel <= 9:
+            raise ValueError('Compression level must be between 0 and 9')
+        if shuffle not in SHUFFLES:
+            raise ValueError('Shuffle must be one of {}'.format(
+                ', '.join(SHUFFLES)))
+        self.cname = cname
+        self.clevel = clevel
+        self.shuffle = shuffle
+
+    def __repr__(self):
+        return '{} level {} {}'.format(self.cname, self.clevel, self.shuffle)
+
+    def compress(self, data):
+        # data is a C contiguous array, the shuffle works on the bytes of each voxel
+        return blosc.compress(data, typesize=data.dtype.itemsize, clevel=self.clevel,
+                              shuffle=SHUFFLES[self.shuffle], cname=self.cname)
+
+
+class CompressedBlock:
+    # blosc compressed block, ready to POST
+    def __init__(self, x_rng, y_rng, z_rng, payload, raw_nbytes, compress_time, dtype=None):
+        self.x_rng = x_rng
+        self.y_rng = y_rng
+        self.z_rng = z_rng
+        self.payload = payload
+        self.raw_nbytes = raw_nbytes
+        self.compress_time = compress_time
+        # datatype of the voxels (e.g. '<u2'), to decompress the payload back into the block
+        self.dtype = dtype
+        # hash and number of nonzero voxels of the block, for the manifest (if computed)
+        self.digest = None
+        self.nonzero = None
+        # ranges of the block in the ingest (journal and log), the POSTed ranges differ when the block is padded
+        self.block_rngs = (x_rng, y_rng, z_rng)
+
+    @property
+    def nbytes(self):
+        return len(self.payload)
+
+
+class SlabCompression:
+    # totals of the compressed blocks of one slab
+    def __init__(self, z_slices, codec):
+        self.z_slices = z_slices
+        self.codec = codec
+        self.raw_nbytes = 0
+        self.nbytes = 0
+        self.compress_time = 0
+        self.lock = threading.Lock()
+
+    def add(self, raw_nbytes, nbytes, compress_time):
+        with self.lock:
+            self.raw_nbytes += raw_nbytes
+            self.nbytes += nbytes
+            self.compress_time += compress_time
+
+    def status_msg(self):
+        ratio = self.raw_nbytes / self.nbytes if self.nbytes else 0
+        return 'Compressed z range {}:{} from {:.1f} MB to {:.1f} MB (ratio {:.2f}) in {:.2f} sec with {}'.format(
+            self.z_slices[0], self.z_slices[-1] + 1, self.raw_nbytes / 1024**2, self.nbytes / 1024**2,
+            ratio, self.compress_time, self.codec)
+
+
+def parse_codecs(specs):
+    # specs like ['uint16:lz4:5:shuffle', 'uint64:zstd:3:bitshuffle'] -> {datatype: BlockCodec}
+    codecs = {}
+    for spec in specs or []:
+        parts = spec.split(':')
+        if len(parts) != 4:
+            raise ValueError(
+                'Compression must be given as datatype:compressor:level:shuffle, got {}'.format(spec))
+        datatype, cname, clevel, shuffle = parts
+        codecs[datatype] = BlockCodec(cname, int(clevel), shuffle)
+    return codecs
+
+
+def get_codec(codecs, datatype):
+    if datatype in codecs:
+        return codecs[datatype]
+    return BlockCodec(*DEFAULT_CODEC)
+
+
+def compress_block(codec, x_rng, y_rng, z_rng, data, dtype=None, digest=False):
+    # the block is copied only if it isn't C contiguous or has to be cast to dtype (e.g. uint64 annotations)
+    # with digest, the block is also hashed (and its nonzero voxels counted) for the manifest
+    start_time = time.time()
+    data = np.ascontiguousarray(data, dtype=dtype)
+    payload = codec.compress(data)
+    block = CompressedBlock(x_rng, y_rng, z_rng, payload, data.nbytes, time.time() - start_time, data.dtype.str)
+    if digest:
+        block.digest = block_digest(data)
+        block.nonzero = int(np.count_nonzero(data))
+    return block
+
+
+def decompress_block(block):
+    # the (z, y, x) array the BOSS decompresses the payload to
+    shape = (block.z_rng[1] - block.z_rng[0], block.y_rng[1] - block.y_rng[0], block.x_rng[1] - block.x_rng[0])
+    return np.frombuffer(blosc.decompress(block.payload), dtype=block.dtype).reshape(shape)
+
+
+def init_compress_threads():
+    # blocks are compressed by a pool of threads: release the GIL while compressing,
+    # with each call single threaded (blosc would otherwise start its own threads for every call)
+    blosc.set_releasegil(True)
+    blosc.set_nthreads(1)
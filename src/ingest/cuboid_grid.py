@@ -0,0 +1,89 @@
+'''
+Grid of stride aligned blocks (e.g. Boss cuboids) over an extent
+The ranges of the blocks are computed from the stride when they are used, instead of listing every coordinate
+'''
+
+from collections.abc import Mapping
+
+
+class GridAxis(Mapping):
+    # {bucket: range of coordinates} of the stride aligned buckets covering rng ([start, stop))
+    # bucket b covers [origin + b * stride, origin + (b + 1) * stride), clipped to rng at the first and last bucket
+    # origin is where the coordinates of rng have 0 in the frame the buckets are aligned to (e.g. the Boss)
+    def __init__(self, rng, stride, origin=0):
+        if stride <= 0:
+            raise ValueError('stride must be positive')
+        self.start = rng[0]
+        self.stop = max(rng[0], rng[1])
+        self.stride = stride
+        self.origin = origin
+        self.first = (self.start - origin) // stride
+        self.last = -(-(self.stop - origin) // stride) if self.stop > self.start else self.first
+
+    def __getitem__(self, bucket):
+        if not self.first <= bucket < self.last:
+            raise KeyError(bucket)
+        return range(max(self.start, self.origin + bucket * self.stride),
+                     min(self.stop, self.origin + (bucket + 1) * self.stride))
+
+    def __iter__(self):
+        return iter(range(self.first, self.last))
+
+    def __len__(self):
+        return self.last - self.first
+
+    def __repr__(self):
+        return 'GridAxis([{}, {}], {}, {})'.format(self.start, self.stop, self.stride, self.origin)
+
+    def bucket(self, coord):
+        # the bucket holding coord
+        if not self.start <= coord < self.stop:
+            raise KeyError(coord)
+        return (coord - self.origin) // self.stride
+
+    def ranges(self):
+        # [start, stop] of each bucket
+        for bucket in self:
+            rng = self[bucket]
+            yield [rng.start, rng.stop]
+
+    def overlapping(self, rng):
+        # the buckets with any coordinate in rng
+        start = max(self.start, rng[0])
+        stop = min(self.stop, rng[1])
+        if stop <= start:
+            return range(0)
+        return range((start - self.origin) // self.stride, -(-(stop - self.origin) // self.stride))
+
+
+class CuboidGrid:
+    # grid of (x_rng, y_rng, z_rng) blocks of shape (x, y, z) over an extent, aligned to multiples of the shape
+    # (offset by origin (x, y, z), see GridAxis)
+    def __init__(self, x_rng, y_rng, z_rng, shape, origin=(0, 0, 0)):
+        self.x = GridAxis(x_rng, shape[0], origin[0])
+        self.y = GridAxis(y_rng, shape[1], origin[1])
+        self.z = GridAxis(z_rng, shape[2], origin[2])
+
+    def __len__(self):
+        return len(self.x) * len(self.y) * len(self.z)
+
+    def __iter__(self):
+        return self.blocks(self.z, self.y, self.x)
+
+    def blocks(self, z_buckets, y_buckets, x_buckets):
+        # blocks in z, y, x order (the order slabs are read and POSTed in)
+        for z_bucket in z_buckets:
+            z_rng = self.z[z_bucket]
+            for y_bucket in y_buckets:
+                y_rng = self.y[y_bucket]
+                for x_bucket in x_buckets:
+                    x_rng = self.x[x_bucket]
+                    yield ([x_rng.start, x_rng.stop], [y_rng.start, y_rng.stop], [z_rng.start, z_rng.stop])
+
+    def slab_blocks(self, z_bucket):
+        # the blocks of one slab
+        return self.blocks([z_bucket], self.y, self.x)
+
+    def intersecting(self, x_rng, y_rng, z_rng):
+        # the blocks with any voxel in the region of interest (whole blocks, not clipped to the region)
+        return self.blocks(self.z.overlapping(z_rng), self.y.overlapping(y_rng), self.x.overlapping(x_rng))
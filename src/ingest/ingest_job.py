@@ -3,12 +3,14 @@ Class for each ingest job (per channel)
 Stores all the info for each ingest job
 '''
 
-import io
 import os
 import re
 import time
 from datetime import datetime
+from functools import partial
+from multiprocessing.dummy import Pool as ThreadPool
 
+import blosc
 import boto3
 import numpy as np
 import tailer
@@ -17,9 +19,22 @@ from PIL import Image
 from slacker import Slacker
 
 try:
+    from compression import get_codec, parse_codecs
     from render_resource import renderResource
+    from s3_reader import BufferFile, S3Reader, create_s3_client
+    from slabs import BlockSlab, mmap_array, parse_slab_backing
 except ImportError:
+    from .compression import get_codec, parse_codecs
     from .render_resource import renderResource
+    from .s3_reader import BufferFile, S3Reader, create_s3_client
+    from .slabs import BlockSlab, mmap_array, parse_slab_backing
+
+
+# blocks are POSTed in multiples of the BOSS cuboid (x, y, z)
+BOSS_CUBOID = (512, 512, 16)
+
+# compressed blocks are POSTed whole, without intern splitting cutouts larger than this (in voxels) into several POSTs
+MAX_BLOCK_VOXELS = 1024 * 1024 * 64
 
 
 class IngestJob:
@@ -122,14 +137,129 @@ class IngestJob:
         self.slack_obj = self.create_slack_session(
             args.get('slack_token_file'))
 
-        if self.datasource == 's3':
-            self.s3_res = self.create_s3_res(
-                aws_profile=args.get('aws_profile'))
-        else:
-            self.s3_res = None
-
         self.boss_config_file = args.get('boss_config_file')
 
+        # adapt the number of POSTs in flight to latency and errors (AIMDController set by the ingest)
+        self.adaptive_threads = args.get('adaptive_threads')
+        self.post_controller = None
+
+        # limits on upload bandwidth and POST rate, the limits file can change them while running
+        # (RateLimiter set by the ingest)
+        self.max_mb_per_sec = args.get('max_mb_per_sec')
+        self.max_posts_per_sec = args.get('max_posts_per_sec')
+        self.limits_file = args.get('limits_file')
+        self.rate_limiter = None
+
+        # number of worker processes ingesting z shards, and the size of the shards (in slabs of 16)
+        self.workers = args.get('workers')
+        if self.workers is None:
+            self.workers = 1
+        self.shard_slabs = args.get('shard_slabs')
+        if self.shard_slabs is None:
+            self.shard_slabs = 4
+
+        # decode and POST workers are either threads or processes (sharing slabs through shared memory)
+        self.executor = args.get('executor')
+        if self.executor is None:
+            self.executor = 'thread'
+        if self.executor not in ('thread', 'process'):
+            raise ValueError('executor must be either "thread" or "process"')
+        if self.executor == 'process' and self.workers > 1:
+            # worker processes can't start their own process pools
+            raise ValueError('the process executor can not be used with multiple workers')
+        if self.executor == 'process' and self.adaptive_threads:
+            # the POSTs run in the worker processes, where the supervisor's controller can't limit them
+            raise ValueError('adaptive threads can not be used with the process executor')
+
+        # number of threads decoding the images of a slab
+        self.read_threads = args.get('read_threads')
+        if self.read_threads is None:
+            self.read_threads = 4
+
+        # images are read from S3 with one client shared by the read threads, and the images of the next slab are
+        # prefetched up to s3_prefetch_mb (0 turns prefetching off)
+        self.s3_prefetch_mb = args.get('s3_prefetch_mb')
+        if self.s3_prefetch_mb is None:
+            self.s3_prefetch_mb = 512
+        if self.s3_prefetch_mb < 0:
+            raise ValueError('s3 prefetch budget can not be negative')
+        # images larger than s3_range_mb are downloaded with s3_range_threads concurrent ranged GETs
+        # (0 gets each image with a single GET)
+        self.s3_range_mb = args.get('s3_range_mb')
+        if self.s3_range_mb is None:
+            self.s3_range_mb = 64
+        self.s3_range_threads = args.get('s3_range_threads')
+        if self.s3_range_threads is None:
+            self.s3_range_threads = 8
+        if self.s3_range_mb < 0 or self.s3_range_threads < 1:
+            raise ValueError('s3 ranges must be at least 0 MB, with at least 1 thread')
+        self.s3_reader = self.create_s3_reader(
+            aws_profile=args.get('aws_profile'))
+
+        # slabs are stored row by row ('row', a (z, y, x) array) or block by block ('block', see BlockSlab)
+        self.slab_layout = args.get('slab_layout')
+        if self.slab_layout is None:
+            self.slab_layout = 'row'
+        if self.slab_layout not in ('row', 'block'):
+            raise ValueError('slab layout must be either "row" or "block"')
+
+        # slabs are held in memory ('memory') or backed by files in a scratch directory ('mmap:<directory>')
+        self.slab_backing, self.slab_dir = parse_slab_backing(
+            args.get('slab_backing'))
+
+        # free slab buffers are reused by the next slabs (SlabPool set by the ingest, possibly shared by channels)
+        self.slab_pool = None
+
+        # shape (x, y, z) of the blocks POSTed to the Boss, slabs are one block deep
+        # set by the ingest after trying candidate shapes on a sample with tune_blocks
+        self.block_shape = args.get('block_shape')
+        if self.block_shape is None:
+            self.block_shape = [1024, 1024, 16]
+        self.block_shape = list(self.block_shape)
+        validate_block_shape(self.block_shape, self.get_post_datatype())
+        self.tune_blocks = args.get('tune_blocks')
+
+        # blocks at the edges of the data that only partly fill Boss cuboids are logged ('warn'),
+        # or padded with zeros to whole cuboids, within the coordinate frame ('pad')
+        self.edge_cuboids = args.get('edge_cuboids')
+        if self.edge_cuboids is None:
+            self.edge_cuboids = 'warn'
+        if self.edge_cuboids not in ('warn', 'pad'):
+            raise ValueError('edge cuboids must be either "warn" or "pad"')
+
+        # number of z slabs to read ahead of the slab being POSTed
+        self.prefetch_slabs = args.get('prefetch_slabs')
+        if self.prefetch_slabs is None:
+            self.prefetch_slabs = 1
+
+        # blocks are compressed by their own pool of threads, with a blosc codec per datatype
+        self.compress_threads = args.get('compress_threads')
+        if self.compress_threads is None:
+            self.compress_threads = 4
+        self.codec = get_codec(parse_codecs(
+            args.get('compression')), self.boss_datatype)
+
+        # blocks are journaled as they finish (BlockJournal set by the ingest), resume skips the finished blocks
+        self.resume = args.get('resume')
+        self.journal = None
+
+        # blocks are recorded with a hash of their voxels in a manifest (BlockManifest set by the ingest),
+        # to check the Boss against later (verify_ingest.py)
+        self.write_manifest = args.get('manifest')
+        self.manifest = None
+
+        # a fraction of the POSTed blocks are GET back and checked while the ingest goes on
+        # (BlockVerifier set by the ingest), by a pool of verify_threads threads
+        self.verify_fraction = args.get('verify_fraction')
+        if self.verify_fraction is None:
+            self.verify_fraction = 0
+        if not 0 <= self.verify_fraction <= 1:
+            raise ValueError('verify fraction must be between 0 and 1')
+        self.verify_threads = args.get('verify_threads')
+        if self.verify_threads is None:
+            self.verify_threads = 1
+        self.verifier = None
+
         self.num_READ_failures = 0
         self.num_POST_failures = 0
 
@@ -185,26 +315,42 @@ class IngestJob:
                 slack_token_file))
             return None
 
-    def create_s3_res(self, aws_profile='default'):
-        # initiating the S3 resource:
+    def create_s3_reader(self, aws_profile='default'):
+        # initiating the S3 client, its connection pool has room for the read, prefetch and range threads
         if self.datasource == 's3':
             if self.s3_bucket_name is None:
                 raise ValueError(
                     's3 bucket not defined but s3 datasource chosen')
             try:
                 s3_session = boto3.session.Session(profile_name=aws_profile)
-                s3_res = s3_session.resource('s3')
+                s3_client = create_s3_client(s3_session, 2 * self.read_threads + self.s3_range_threads)
             except ValueError:
                 raise ValueError('AWS credentials not set up?')
+            s3_reader = S3Reader(s3_client, self.s3_bucket_name, int(self.s3_prefetch_mb * 1024**2),
+                                 prefetch_threads=self.read_threads, range_bytes=int(self.s3_range_mb * 1024**2),
+                                 range_threads=self.s3_range_threads)
         else:
             if self.s3_bucket_name is not None:
                 self.send_msg('s3 bucket name input but source is local')
-            s3_res = None
-        return s3_res
+            s3_reader = None
+        return s3_reader
+
+    def prefetch_slices(self, z_slices):
+        # starts getting the images of z_slices from S3 in the background (the slab after the one being read)
+        # with the process executor the images are read by the worker processes, so they aren't prefetched here
+        if self.s3_reader is not None and self.executor == 'thread':
+            self.s3_reader.prefetch([self.get_img_fname(z_slice) for z_slice in z_slices])
 
     def get_log_fname(self):
         return '_'.join(('ingest_log', self.coll_name, self.exp_name, self.ch_name)) + '.txt'
 
+    def get_journal_fname(self):
+        return '_'.join(('ingest_journal', self.coll_name, self.exp_name, self.ch_name,
+                         'z{}-{}'.format(*self.z_range))) + '.txt'
+
+    def get_manifest_fname(self):
+        return '_'.join(('ingest_manifest', self.coll_name, self.exp_name, self.ch_name)) + '.txt'
+
     def send_msg(self, msg, send_slack=False):
         logfile = self.get_log_fname()
 
@@ -230,6 +376,10 @@ class IngestJob:
             offsets.append(offset)
         return offsets
 
+    def get_boss_z(self, z_slice):
+        # z of an image slice in the Boss (the extents are offset, the slices are not)
+        return z_slice + self.offsets[2]
+
     def offset_extents(self):
         self.x_extent, self.y_extent, self.z_extent = [
             [ext[0] + off, ext[1] + off] for ext, off in zip([self.x_extent, self.y_extent, self.z_extent], self.offsets)]
@@ -279,16 +429,13 @@ class IngestJob:
                 raise IOError(msg)
         return img_fname
 
-    def load_s3_obj(self, img_fname, attempts=3):
-        for attempt in range(attempts):
-            try:
-                obj = self.s3_res.Object(self.s3_bucket_name, img_fname)
-                return io.BytesIO(obj.get()['Body'].read())
-            except Exception as err:
-                msg = '{} Exception {} occurred when getting image {} from s3'.format(
-                    get_formatted_datetime(), err, img_fname)
-                if attempt != attempts - 1:
-                    time.sleep(2**(attempt + 1))
+    def load_s3_obj(self, img_fname):
+        # failed requests are retried by the S3 client, the image is decoded from the downloaded buffer
+        try:
+            return BufferFile(self.s3_reader.read(img_fname))
+        except Exception as err:
+            msg = '{} Exception {} occurred when getting image {} from s3'.format(
+                get_formatted_datetime(), err, img_fname)
 
         self.send_msg(msg, send_slack=True)
         self.num_READ_failures += 1
@@ -333,12 +480,14 @@ class IngestJob:
                 im = np.array(Image.open(im_obj), dtype=self.datatype)
             
             # if it is ome, load with appropriate kwarg
-            elif extension.lower() == '.ome':
-                im = tifffile.imread(im_obj, is_ome=True)
             # if it's not ome, avoid loading ome metadata
             # bug fix sometimes for .ome.tif files
+            # uncompressed images are mapped instead of decoded into a new array
             else:
-                im = tifffile.imread(im_obj, is_ome=False)
+                is_ome = extension.lower() == '.ome'
+                im = map_tif_page(im_obj, is_ome=is_ome)
+                if im is None:
+                    im = tifffile.imread(im_obj, is_ome=is_ome)
 
             return im
 
@@ -394,22 +543,70 @@ class IngestJob:
         # prepend root, append extension
         return os.path.join(base_path, "{}.{}".format(base_fname, self.extension))
 
-    def read_img_stack(self, z_slices):
+    def new_slab_buffer(self, shape, dtype):
+        # zero filled buffer for a slab, in memory or backed by a file in the scratch directory
+        if self.slab_backing == 'mmap':
+            return mmap_array(shape, dtype, self.slab_dir)
+        return np.zeros(shape, dtype=dtype)
+
+    def get_slab_key(self, shape, dtype):
+        # slab buffers are only reused for slabs with the same backing, shape and dtype
+        return (self.slab_backing, self.slab_dir, tuple(shape), np.dtype(dtype).str)
+
+    def create_slab_buffer(self, shape, dtype):
+        # buffer for a slab, from the slab pool if there is one (a reused buffer isn't zeroed)
+        if self.slab_pool is None:
+            return self.new_slab_buffer(shape, dtype)
+        return self.slab_pool.acquire(self.get_slab_key(shape, dtype),
+                                      partial(self.new_slab_buffer, shape, dtype))
+
+    def release_slab_buffer(self, im_array):
+        # hands the buffer of a slab back to the slab pool once the slab's blocks are done
+        if self.slab_pool is None:
+            return
+        if isinstance(im_array, BlockSlab):
+            im_array = im_array.buffer
+        self.slab_pool.release(self.get_slab_key(
+            im_array.shape, im_array.dtype), im_array)
+
+    def get_post_datatype(self):
+        # cast the data as uint64 for the BOSS annotations even if the data is something else
+        if self.datatype != 'uint64' and self.boss_datatype == 'uint64':
+            return 'uint64'
+        return self.datatype
+
+    def read_img_stack(self, z_slices, block_starts=None):
+        # with block_starts (y_starts, x_starts of the blocks in the slab) the slab is stored block by block
         self.send_msg('{} Reading image data (z range: {}:{})'.format(
             get_formatted_datetime(), z_slices[0], z_slices[-1] + 1))
 
         start_time = time.time()
-        im_array = np.zeros(
-            (len(z_slices), self.img_size[1], self.img_size[0]), dtype=self.datatype, order='C')
-        for idx, z_slice in enumerate(z_slices):
+        shape = (len(z_slices), self.img_size[1], self.img_size[0])
+        # the slab is kept in the datatype of the images, annotation blocks are cast to uint64 as they are POSTed
+        if block_starts is None:
+            im_array = self.create_slab_buffer(shape, self.datatype)
+        else:
+            im_array = BlockSlab(shape, self.datatype, block_starts[0], block_starts[1],
+                                 self.create_slab_buffer((int(np.prod(shape)),), self.datatype))
+
+        def read_slice(idx_z_slice):
+            # decodes one image straight into its row of the slab
+            # a missing image is zeroed, as the slab's buffer may be reused from an earlier slab
+            idx, z_slice = idx_z_slice
             img = self.load_img(z_slice)
             if img is None and self.warn_missing_files:
-                continue
-            im_array[idx, :, :] = img
-
-        # cast the data as uint64 for the BOSS annotations even if the data is something else
-        if self.datatype != 'uint64' and self.boss_datatype == 'uint64':
-            im_array = im_array.astype('uint64')
+                im_array[idx] = 0
+                return
+            im_array[idx] = img
+
+        # decoding (tifffile/PIL) releases the GIL, so slices are read concurrently
+        threads = max(1, min(self.read_threads, len(z_slices)))
+        if threads == 1:
+            for idx_z_slice in enumerate(z_slices):
+                read_slice(idx_z_slice)
+        else:
+            with ThreadPool(threads) as pool:
+                pool.map(read_slice, enumerate(z_slices), chunksize=1)
 
         end_time = time.time()
         read_time = end_time - start_time
@@ -418,10 +615,51 @@ class IngestJob:
         return im_array
 
 
+def map_tif_page(im_obj, is_ome=False):
+    # the image of a single page TIFF stored uncompressed (contiguous, in the native byte order) as a read only
+    # view of the file (np.memmap) or of the buffer it was downloaded to, so rows are copied into the slab straight
+    # from the page cache. returns None for images that have to be decoded
+    # (and with versions of tifffile older than is_final and dataoffsets)
+    try:
+        with tifffile.TiffFile(im_obj, is_ome=is_ome) as tif:
+            if len(tif.pages) != 1:
+                return None
+            page = tif.pages[0]
+            if page.dtype is None or len(page.shape) != 2 or not page.is_final:
+                return None
+            dtype = page.dtype.newbyteorder(tif.byteorder)
+            offset = page.dataoffsets[0]
+            if not dtype.isnative or offset % dtype.itemsize:
+                return None
+            shape = page.shape
+    except (AttributeError, TypeError):
+        return None
+    finally:
+        if isinstance(im_obj, BufferFile):
+            im_obj.seek(0)
+
+    if isinstance(im_obj, BufferFile):
+        return np.frombuffer(im_obj.buffer, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+    return np.memmap(im_obj, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
 def get_formatted_datetime():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
+def validate_block_shape(block_shape, datatype=None):
+    if len(block_shape) != 3 or any(size <= 0 or size % cuboid for size, cuboid in zip(block_shape, BOSS_CUBOID)):
+        raise ValueError('block shape {} must be a multiple of the Boss cuboid ({}, {}, {})'.format(
+            block_shape, *BOSS_CUBOID))
+    if int(np.prod(block_shape)) > MAX_BLOCK_VOXELS:
+        raise ValueError('block shape {} is larger than the {} voxels of one POST to the Boss'.format(
+            block_shape, MAX_BLOCK_VOXELS))
+    # blocks are compressed whole with blosc
+    if datatype is not None and int(np.prod(block_shape)) * np.dtype(datatype).itemsize > blosc.MAX_BUFFERSIZE:
+        raise ValueError('block shape {} is too large to compress as {}'.format(
+            block_shape, datatype))
+
+
 def validate_limit(data_rng, limit):
     if data_rng is not None and limit is not None:
         if limit[0] < data_rng[0] or limit[1] > data_rng[1]:
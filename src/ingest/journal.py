@@ -0,0 +1,68 @@
+'''
+Checkpoint journal of the blocks ingested for a channel
+Each block is appended (and fsync'd) as it finishes: done (POSTed), empty (skipped) or failed
+Resuming skips the blocks already done or empty, failed blocks are tried again
+'''
+
+import os
+import threading
+
+FINISHED = ('done', 'empty')
+
+
+class BlockJournal:
+    def __init__(self, path, resume=False):
+        # several worker processes can append to the same journal (each line is a single append)
+        self.path = path
+        self.finished = set()
+        if resume:
+            self.finished = read_finished_blocks(path)
+        self.lock = threading.Lock()
+        self.f = open(path, 'a')
+
+    def record(self, status, x_rng, y_rng, z_rng):
+        line = '{} {}\n'.format(status, ' '.join(
+            str(v) for v in block_key(x_rng, y_rng, z_rng)))
+        with self.lock:
+            self.f.write(line)
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def is_finished(self, x_rng, y_rng, z_rng):
+        return block_key(x_rng, y_rng, z_rng) in self.finished
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+def block_key(x_rng, y_rng, z_rng):
+    return (x_rng[0], x_rng[1], y_rng[0], y_rng[1], z_rng[0], z_rng[1])
+
+
+def read_journal(path):
+    # {block key: last status}, ignoring a partly written last line
+    statuses = {}
+    if not os.path.isfile(path):
+        return statuses
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if not line.endswith('\n') or len(parts) != 7:
+                continue
+            try:
+                statuses[tuple(int(v) for v in parts[1:])] = parts[0]
+            except ValueError:
+                continue
+    return statuses
+
+
+def read_finished_blocks(path):
+    return set(key for key, status in read_journal(path).items() if status in FINISHED)
+
+
+def count_statuses(path):
+    counts = {'done': 0, 'empty': 0, 'failed': 0}
+    for status in read_journal(path).values():
+        counts[status] = counts.get(status, 0) + 1
+    return counts
@@ -0,0 +1,54 @@
+'''
+Digest manifest of the blocks ingested for a channel
+Each POSTed block is appended with its ranges in the Boss, a hash of its voxels and its number of nonzero voxels,
+blocks skipped as empty are recorded too, so the Boss can be checked (verify_ingest.py) without the images
+'''
+
+import hashlib
+import threading
+
+import numpy as np
+
+# the digest of a block that wasn't POSTed (skipped as empty)
+NO_DIGEST = '-'
+
+
+class BlockManifest:
+    def __init__(self, path):
+        # several worker processes can append to the same manifest (each line is a single append)
+        self.path = path
+        self.lock = threading.Lock()
+        self.f = open(path, 'a')
+
+    def record(self, status, x_rng, y_rng, z_rng, digest=NO_DIGEST, nonzero=0):
+        line = '{} {} {} {}\n'.format(status, ' '.join(str(v) for v in (x_rng[0], x_rng[1], y_rng[0], y_rng[1],
+                                                                     z_rng[0], z_rng[1])), digest, nonzero)
+        with self.lock:
+            self.f.write(line)
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+def block_digest(data):
+    # fast hash of the voxels of a (C contiguous) block, as the Boss returns them for a cutout
+    return hashlib.blake2b(np.ascontiguousarray(data), digest_size=16).hexdigest()
+
+
+def read_manifest(path):
+    # {(x_start, x_stop, y_start, y_stop, z_start, z_stop): (status, digest, nonzero)} of the last record of each block,
+    # ignoring a partly written last line
+    blocks = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if not line.endswith('\n') or len(parts) != 9:
+                continue
+            try:
+                key = tuple(int(v) for v in parts[1:7])
+                blocks[key] = (parts[0], parts[7], int(parts[8]))
+            except ValueError:
+                continue
+    return blocks
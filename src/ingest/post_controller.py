@@ -0,0 +1,139 @@
+'''
+Adaptive limit on the number of POSTs in flight to the BOSS
+Additive increase while latency and errors stay flat, multiplicative decrease on 5xx errors, timeouts or rising latency
+'''
+
+import threading
+import time
+from collections import deque
+
+import numpy as np
+from requests import HTTPError
+from requests.exceptions import ConnectionError, Timeout
+
+
+class AIMDController:
+    def __init__(self, max_concurrency, min_concurrency=1, initial=None, increase=1, decrease=0.5,
+                 latency_tolerance=2.0, num_recent=20, window=1000, log=None, report_interval=300):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        if initial is None:
+            initial = max(self.min_concurrency, max_concurrency // 4)
+        self.limit = float(min(max(initial, self.min_concurrency), max_concurrency))
+
+        self.increase = increase
+        self.decrease = decrease
+
+        # latency is "flat" while the median of the recent POSTs stays within latency_tolerance of the baseline
+        self.latency_tolerance = latency_tolerance
+        self.num_recent = num_recent
+        self.baseline = None
+
+        self.in_flight = 0
+        self.cond = threading.Condition()
+
+        # completions since the last change of the limit, decreases wait a full round of requests
+        self.since_increase = 0
+        self.since_decrease = float('inf')
+
+        self.latencies = deque(maxlen=window)
+        self.num_requests = 0
+        self.num_errors = 0
+
+        self.log = log
+        self.report_interval = report_interval
+        self.last_report = time.time()
+
+    @property
+    def concurrency(self):
+        return int(self.limit)
+
+    def acquire(self):
+        # blocks until another POST is allowed in flight
+        with self.cond:
+            while self.in_flight >= self.concurrency:
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency, error=None):
+        # called when a POST finishes, with the exception raised if it failed
+        with self.cond:
+            self.in_flight -= 1
+            self.num_requests += 1
+            self.since_decrease += 1
+
+            if error is None:
+                self.latencies.append(latency)
+                self.on_success()
+            elif is_overload_error(error):
+                self.num_errors += 1
+                self.decrease_limit()
+
+            self.cond.notify_all()
+
+        self.report()
+
+    def on_success(self):
+        if len(self.latencies) >= self.num_recent:
+            recent = list(self.latencies)[-self.num_recent:]
+            median = float(np.median(recent))
+            # the baseline follows the lowest latency seen, slowly drifting up so a busier server
+            # doesn't pin us at the minimum forever
+            if self.baseline is None or median < self.baseline:
+                self.baseline = median
+            else:
+                self.baseline *= 1.001
+            if median > self.baseline * self.latency_tolerance:
+                self.decrease_limit()
+                return
+
+        self.since_increase += 1
+        if self.since_increase >= self.limit:
+            self.limit = min(self.max_concurrency, self.limit + self.increase)
+            self.since_increase = 0
+
+    def decrease_limit(self):
+        # only one decrease per round of requests in flight
+        if self.since_decrease < self.limit:
+            return
+        self.limit = max(self.min_concurrency, self.limit * self.decrease)
+        self.since_decrease = 0
+        self.since_increase = 0
+
+    def stats(self):
+        with self.cond:
+            latencies = list(self.latencies)
+            stats = {'concurrency': self.concurrency,
+                     'in_flight': self.in_flight,
+                     'requests': self.num_requests,
+                     'errors': self.num_errors}
+        if latencies:
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        else:
+            p50 = p90 = p99 = 0
+        stats.update({'p50': p50, 'p90': p90, 'p99': p99})
+        return stats
+
+    def status_msg(self):
+        return 'POST concurrency {concurrency} ({in_flight} in flight), latency p50/p90/p99: {p50:.2f}/{p90:.2f}/{p99:.2f} sec, {errors} overload errors in {requests} POSTs'.format(
+            **self.stats())
+
+    def report(self):
+        # periodically logs the current concurrency and latency percentiles
+        if self.log is None:
+            return
+        now = time.time()
+        if now - self.last_report < self.report_interval:
+            return
+        self.last_report = now
+        self.log(self.status_msg())
+
+
+def is_overload_error(error):
+    # 5xx responses, timeouts and dropped connections mean the BOSS is overloaded
+    if isinstance(error, (Timeout, ConnectionError)):
+        return True
+    if isinstance(error, HTTPError):
+        response = error.response
+        return response is not None and response.status_code >= 500
+    return False
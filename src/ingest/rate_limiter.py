@@ -0,0 +1,185 @@
+'''
+Token bucket limits on the bandwidth and request rate of uploads to the BOSS
+Limits can be changed while running by editing a limits file (ini format):
+
+[Limits]
+mb_per_sec = 50
+posts_per_sec = 20
+
+A value of 0 (or none) removes the limit. The file is checked every few seconds, SIGHUP re-reads it right away
+'''
+
+import configparser
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate=None, burst=1.0):
+        # rate is in tokens per second (None for no limit), the bucket holds up to burst seconds of tokens
+        self.burst = burst
+        self.rate = None
+        self.capacity = 0
+        self.tokens = 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate if rate else None
+            self.capacity = self.rate * self.burst if self.rate else 0
+            self.tokens = min(self.tokens, self.capacity)
+            self.last = time.monotonic()
+
+    def consume(self, num_tokens):
+        # blocks until num_tokens are available
+        # requests larger than the bucket are let through when it is full, leaving it in debt
+        while True:
+            with self.lock:
+                if self.rate is None:
+                    return
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.last) * self.rate)
+                self.last = now
+
+                needed = min(num_tokens, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= num_tokens
+                    return
+                wait = (needed - self.tokens) / self.rate
+
+            # wake up at least every second in case the rate was changed
+            time.sleep(min(wait, 1))
+
+
+class RateLimiter:
+    def __init__(self, mb_per_sec=None, posts_per_sec=None, limits_file=None, share=1,
+                 log=None, check_interval=10):
+        # share is the fraction of the limits used by this process (e.g. 1 / number of worker processes)
+        self.share = share
+        self.log = log
+
+        self.mb_per_sec = None
+        self.posts_per_sec = None
+        self.bytes_bucket = TokenBucket()
+        self.posts_bucket = TokenBucket()
+        self.set_limits(mb_per_sec, posts_per_sec)
+        # limits missing from the limits file keep these values
+        self.default_limits = (mb_per_sec, posts_per_sec)
+
+        self.limits_file = limits_file
+        self.limits_mtime = None
+        self.check_interval = check_interval
+        self.last_check = time.monotonic()
+        self.reload_requested = False
+        self.reload()
+
+    def set_limits(self, mb_per_sec, posts_per_sec):
+        changed = (mb_per_sec, posts_per_sec) != (
+            self.mb_per_sec, self.posts_per_sec)
+        self.mb_per_sec = mb_per_sec
+        self.posts_per_sec = posts_per_sec
+
+        self.bytes_bucket.set_rate(
+            mb_per_sec * 1024**2 * self.share if mb_per_sec else None)
+        self.posts_bucket.set_rate(
+            posts_per_sec * self.share if posts_per_sec else None)
+
+        if changed and self.log is not None:
+            self.log(self.status_msg())
+
+    def status_msg(self):
+        return 'Upload limits set to {} MB/sec and {} POSTs/sec'.format(
+            self.mb_per_sec or 'unlimited', self.posts_per_sec or 'unlimited')
+
+    def reload(self, force=False):
+        # re-reads the limits file if it changed since we last read it
+        if self.limits_file is None:
+            return
+        try:
+            mtime = os.path.getmtime(self.limits_file)
+        except OSError:
+            return
+        if not force and mtime == self.limits_mtime:
+            return
+        self.limits_mtime = mtime
+
+        config = configparser.ConfigParser()
+        try:
+            config.read(self.limits_file)
+            limits = config['Limits']
+            self.set_limits(parse_limit(limits.get('mb_per_sec'), self.default_limits[0]),
+                            parse_limit(limits.get('posts_per_sec'), self.default_limits[1]))
+        except (configparser.Error, KeyError, ValueError) as e:
+            if self.log is not None:
+                self.log('Could not read limits file {}: {}'.format(
+                    self.limits_file, e))
+
+    def request_reload(self):
+        # safe to call from a signal handler, the file is re-read by the next POST
+        self.reload_requested = True
+
+    def acquire(self, nbytes):
+        # blocks until a POST of nbytes fits in the limits
+        now = time.monotonic()
+        if self.reload_requested or now - self.last_check > self.check_interval:
+            force = self.reload_requested
+            self.reload_requested = False
+            self.last_check = now
+            self.reload(force)
+
+        self.posts_bucket.consume(1)
+        self.bytes_bucket.consume(nbytes)
+
+
+def parse_limit(value, default=None):
+    if value is None:
+        return default
+    if value.strip().lower() in ('', 'none'):
+        return None
+    value = float(value)
+    return value if value > 0 else None
+
+
+def create_rate_limiter(params, share=1, log=None):
+    # params is an ingest job or the command line args, returns None when no limits are set
+    if params.max_mb_per_sec is None and params.max_posts_per_sec is None and params.limits_file is None:
+        return None
+    return RateLimiter(params.max_mb_per_sec, params.max_posts_per_sec, params.limits_file,
+                       share=share, log=log)
+
+
+def set_reload_signal(rate_limiter):
+    # SIGHUP re-reads the limits file right away (posix only, and only from the main thread)
+    # returns the previous handler, or None if no handler was set
+    if rate_limiter is None or rate_limiter.limits_file is None or not hasattr(signal, 'SIGHUP'):
+        return None
+    if threading.current_thread() is not threading.main_thread():
+        return None
+    return signal.signal(signal.SIGHUP, lambda signum, frame: rate_limiter.request_reload())
+
+
+def set_supervisor_reload_signal(limits_file, rate_limiter=None):
+    # SIGHUP re-reads the limits file in the supervisor (if it has a rate limiter) and is forwarded to its worker
+    # processes, which re-read it for their own limiters, instead of ending the ingest
+    # returns the previous handler, or None if no handler was set
+    if limits_file is None or not hasattr(signal, 'SIGHUP'):
+        return None
+    if threading.current_thread() is not threading.main_thread():
+        return None
+
+    def reload(signum, frame):
+        if rate_limiter is not None:
+            rate_limiter.request_reload()
+        for child in multiprocessing.active_children():
+            try:
+                os.kill(child.pid, signal.SIGHUP)
+            except OSError:
+                pass
+
+    return signal.signal(signal.SIGHUP, reload)
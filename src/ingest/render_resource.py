@@ -1,13 +1,17 @@
 import io
 import random
 import time
-from collections import defaultdict
 from multiprocessing.dummy import Pool as ThreadPool
 
 import numpy as np
 import requests
 from PIL import Image
 
+try:
+    from cuboid_grid import GridAxis
+except ImportError:
+    from .cuboid_grid import GridAxis
+
 # render web service view
 # http://render-dev-eric.neurodata.io/render-ws/view/index.html?
 
@@ -214,14 +218,8 @@ def validate_limit(data_rng, limit):
 
 def get_supercubes(rng, stride=512):
     # boss is stored in 512x512x16 so slice the data first and get cutouts in those ranges
-    first = rng[0]    # inclusive
-    last = rng[1]     # exclusive
-
-    buckets = defaultdict(list)
-    for z in range(first, last):
-        buckets[(z // stride)].append(z)
-
-    return buckets
+    # {bucket: range of coordinates}, see GridAxis
+    return GridAxis(rng, stride)
 
 
 def benchmark_get_tile(renderObj, step_size):
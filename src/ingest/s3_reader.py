@@ -0,0 +1,229 @@
+'''
+Reads images from S3 with one thread-safe client shared by every thread reading a slab
+The client's connection pool is sized to the read concurrency (reading, prefetching and range threads),
+and the images of the next slab are prefetched while the current slab is decoded and POSTed, up to a byte budget
+Objects larger than a range (e.g. whole BigTIFF sections) are downloaded with concurrent ranged GETs into one buffer,
+which the decoder reads through BufferFile without copying it
+'''
+
+import io
+import threading
+from functools import partial
+from multiprocessing.dummy import Pool as ThreadPool
+
+from botocore.config import Config
+
+
+def create_s3_client(session, max_connections, attempts=3):
+    # requests that fail are retried by botocore (with backoff), instead of by us
+    return session.client('s3', config=Config(max_pool_connections=max_connections,
+                                               retries={'max_attempts': attempts, 'mode': 'standard'}))
+
+
+def get_object_size(resp):
+    # size of the whole object, a ranged GET has it in its content range ('bytes 0-99/1000')
+    content_range = resp.get('ContentRange')
+    if content_range is None:
+        return resp['ContentLength']
+    return int(content_range.rsplit('/', 1)[1])
+
+
+def read_body_into(body, view):
+    # reads a response body into a slice of the object's buffer
+    filled = 0
+    while filled < len(view):
+        num_read = body.readinto(view[filled:])
+        if not num_read:
+            raise IOError('S3 response ended after {} of {} bytes'.format(filled, len(view)))
+        filled += num_read
+
+
+class BufferFile(io.RawIOBase):
+    # read only file over a downloaded object, io.BytesIO would copy a bytearray
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        num_read = max(0, min(len(view), len(self.buffer) - self.pos))
+        view[:num_read] = self.buffer[self.pos:self.pos + num_read]
+        self.pos += num_read
+        return num_read
+
+    def read(self, size=-1):
+        stop = len(self.buffer) if size is None or size < 0 else min(len(self.buffer), self.pos + size)
+        data = self.buffer[self.pos:stop].tobytes()
+        self.pos = max(self.pos, stop)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self.buffer) + offset
+        else:
+            raise ValueError('invalid whence ({})'.format(whence))
+        if pos < 0:
+            raise ValueError('negative seek position {}'.format(pos))
+        self.pos = pos
+        return pos
+
+    def tell(self):
+        return self.pos
+
+
+class S3Reader:
+    def __init__(self, client, bucket, prefetch_bytes=512 * 1024**2, prefetch_threads=4,
+                 range_bytes=64 * 1024**2, range_threads=8, attempts=3):
+        self.client = client
+        self.bucket = bucket
+        self.attempts = attempts
+
+        # objects larger than range_bytes are downloaded range by range, range_threads at a time (0 for single GETs)
+        self.range_bytes = range_bytes
+        self.range_threads = range_threads
+        self.range_pool = None
+
+        # {key: AsyncResult of the object's bytes (None if it wasn't kept)} of the prefetched objects not yet read
+        self.prefetch_bytes = prefetch_bytes
+        self.prefetch_threads = prefetch_threads
+        self.prefetched = {}
+        self.held = 0
+        self.pool = None
+        self.lock = threading.Lock()
+
+        self.num_reads = 0
+        self.num_hits = 0
+        self.num_dropped = 0
+        self.num_ranged = 0
+
+    def read(self, key):
+        # the bytes of an object, taken from the prefetched objects if it was prefetched
+        with self.lock:
+            self.num_reads += 1
+            result = self.prefetched.pop(key, None)
+        if result is not None:
+            data = result.get()
+            if data is not None:
+                with self.lock:
+                    self.held -= len(data)
+                    self.num_hits += 1
+                return data
+        return self.get_object(key)
+
+    def get_object(self, key):
+        # reading the body can fail after the request succeeded, so the whole GET is tried again
+        for attempt in range(self.attempts):
+            try:
+                return self.download(key, *self.open(key))
+            except Exception as err:
+                if attempt == self.attempts - 1:
+                    raise err
+
+    def open(self, key):
+        # GETs the object (only its first range when objects are downloaded in ranges)
+        # returns the response and the size of the whole object
+        if self.range_bytes <= 0:
+            resp = self.client.get_object(Bucket=self.bucket, Key=key)
+            return resp, resp['ContentLength']
+        resp = self.client.get_object(Bucket=self.bucket, Key=key, Range='bytes=0-{}'.format(self.range_bytes - 1))
+        return resp, get_object_size(resp)
+
+    def download(self, key, resp, size):
+        # the rest of an object larger than the first range is GET concurrently straight into one buffer,
+        # the ranges must come from the same version of the object as the first one
+        if resp['ContentLength'] == size:
+            return resp['Body'].read()
+
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        ranges = [(start, min(start + self.range_bytes, size)) for start in range(self.range_bytes, size, self.range_bytes)]
+        with self.lock:
+            if self.range_pool is None:
+                self.range_pool = ThreadPool(self.range_threads)
+            self.num_ranged += 1
+        pending = self.range_pool.map_async(partial(self.download_range, key, resp['ETag'], view), ranges)
+        try:
+            read_body_into(resp['Body'], view[:self.range_bytes])
+        finally:
+            pending.wait()
+        pending.get()
+        return buffer
+
+    def download_range(self, key, etag, view, rng):
+        resp = self.client.get_object(Bucket=self.bucket, Key=key, IfMatch=etag,
+                                      Range='bytes={}-{}'.format(rng[0], rng[1] - 1))
+        read_body_into(resp['Body'], view[rng[0]:rng[1]])
+
+    def prefetch(self, keys):
+        # starts downloading the objects in the background, in order
+        if self.prefetch_bytes <= 0:
+            return
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.prefetch_threads)
+            for key in keys:
+                if key not in self.prefetched:
+                    self.prefetched[key] = self.pool.apply_async(self.fetch, (key,))
+
+    def fetch(self, key):
+        # an object that doesn't fit in the byte budget (or fails) is left for read to GET
+        try:
+            resp, size = self.open(key)
+        except Exception:
+            return None
+        with self.lock:
+            fits = self.held + size <= self.prefetch_bytes
+            if fits:
+                self.held += size
+            else:
+                self.num_dropped += 1
+        if not fits:
+            resp['Body'].close()
+            return None
+        try:
+            return self.download(key, resp, size)
+        except Exception:
+            with self.lock:
+                self.held -= size
+            return None
+
+    def clear(self):
+        # drops the prefetched objects not yet read
+        with self.lock:
+            prefetched = self.prefetched
+            self.prefetched = {}
+        for result in prefetched.values():
+            data = result.get()
+            if data is not None:
+                with self.lock:
+                    self.held -= len(data)
+
+    def close(self):
+        self.clear()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.range_pool is not None:
+            self.range_pool.close()
+            self.range_pool.join()
+            self.range_pool = None
+
+    def status_msg(self):
+        with self.lock:
+            return ('S3: {} images read, {} of them prefetched, {} prefetches dropped (over the {:.0f} MB budget), '
+                    '{} downloaded in ranges').format(
+                self.num_reads, self.num_hits, self.num_dropped, self.prefetch_bytes / 1024**2, self.num_ranged)
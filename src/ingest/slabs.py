@@ -0,0 +1,279 @@
+'''
+Buffers for slabs of z slices
+Shared memory slabs let decode and POST worker processes work on the same data without pickling it
+Slabs can also be backed by files in a scratch directory (--slab_backing mmap:<directory>) for volumes larger than RAM
+'''
+
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    # python < 3.8, only the thread executor is available
+    resource_tracker = None
+    shared_memory = None
+
+
+class SharedSlab:
+    def __init__(self, shape, dtype, name=None):
+        if shared_memory is None:
+            raise RuntimeError('Shared memory slabs require python 3.8 or greater')
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+        if name is None:
+            # new shared memory is zero filled, so missing slices stay empty
+            nbytes = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+
+        self.array = np.ndarray(self.shape, dtype=self.dtype,
+                                buffer=self.shm.buf)
+
+    @classmethod
+    def attach(cls, name, shape, dtype):
+        # attach to a slab created by another process
+        return cls(shape, dtype, name=name)
+
+    def close(self):
+        # views into the buffer have to be dropped before the shared memory can be closed
+        self.array = None
+        self.shm.close()
+
+    def release(self):
+        self.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class MmapSlab:
+    # same as SharedSlab, but backed by a file in a scratch directory (e.g. on local NVMe) instead of shared memory,
+    # so the OS pages the slab in and out instead of holding all of it in RAM
+    def __init__(self, shape, dtype, name=None, directory=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+        if name is None:
+            # new files are zero filled, so missing slices stay empty
+            fd, name = tempfile.mkstemp(prefix='ingest_slab_', suffix='.dat', dir=directory)
+            os.close(fd)
+            self.owner = True
+            mode = 'w+'
+        else:
+            self.owner = False
+            mode = 'r+'
+        self.name = name
+
+        self.array = np.memmap(self.name, dtype=self.dtype, mode=mode, shape=self.shape)
+
+    @classmethod
+    def attach(cls, name, shape, dtype):
+        # attach to a slab created by another process
+        return cls(shape, dtype, name=name)
+
+    def close(self):
+        # the file is unmapped once the array and every view into it are dropped
+        self.array = None
+
+    def release(self):
+        self.close()
+        if self.owner and os.path.isfile(self.name):
+            os.remove(self.name)
+
+
+class BlockSlab:
+    # slab of z slices stored block by block (block-major): each block is one C contiguous (z, y, x) run of the buffer,
+    # so it can be compressed and POSTed without first copying it out of the slab
+    # blocks start at y_starts/x_starts (offsets into the slab) and run to the next start or the end of the slab
+    def __init__(self, shape, dtype, y_starts, x_starts, buffer=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.y_starts = list(y_starts)
+        self.x_starts = list(x_starts)
+
+        size = int(np.prod(self.shape))
+        if buffer is None:
+            buffer = np.zeros(size, dtype=self.dtype)
+        if buffer.size != size:
+            raise ValueError('Buffer of {} voxels does not fit a slab of shape {}'.format(
+                buffer.size, self.shape))
+        self.buffer = buffer
+
+        self.blocks = {}
+        offset = 0
+        for y_start, y_stop in zip(self.y_starts, self.y_starts[1:] + [self.shape[1]]):
+            for x_start, x_stop in zip(self.x_starts, self.x_starts[1:] + [self.shape[2]]):
+                block_shape = (self.shape[0], y_stop - y_start, x_stop - x_start)
+                block_size = int(np.prod(block_shape))
+                self.blocks[(y_start, x_start)] = buffer[offset:offset +
+                                                         block_size].reshape(block_shape)
+                offset += block_size
+
+    @property
+    def nbytes(self):
+        return self.buffer.nbytes
+
+    def __setitem__(self, idx, img):
+        # slab[idx] = img writes z slice idx into every block (slab[idx] = 0 zeroes it)
+        if np.isscalar(img):
+            for block in self.blocks.values():
+                block[idx] = img
+            return
+        for (y_start, x_start), block in self.blocks.items():
+            block[idx] = img[y_start:y_start + block.shape[1],
+                             x_start:x_start + block.shape[2]]
+
+    def get_block(self, y_start, x_start):
+        return self.blocks[(y_start, x_start)]
+
+    def nonzero_map(self):
+        # same as get_block_nonzero_map for the slab's block grid
+        nonzero_map = np.zeros(
+            (len(self.y_starts), len(self.x_starts)), dtype=bool)
+        for y_idx, y_start in enumerate(self.y_starts):
+            for x_idx, x_start in enumerate(self.x_starts):
+                nonzero_map[y_idx, x_idx] = self.blocks[(
+                    y_start, x_start)].any()
+        return nonzero_map
+
+    def to_array(self):
+        # (z, y, x) copy of the slab
+        im_array = np.empty(self.shape, dtype=self.dtype)
+        for (y_start, x_start), block in self.blocks.items():
+            im_array[:, y_start:y_start + block.shape[1],
+                     x_start:x_start + block.shape[2]] = block
+        return im_array
+
+    def astype(self, dtype):
+        return BlockSlab(self.shape, dtype, self.y_starts, self.x_starts, self.buffer.astype(dtype))
+
+
+def block_slab_view(array, block_starts):
+    # reads a (z, y, x) buffer (e.g. a shared slab) as a block-major slab when block_starts (y_starts, x_starts) are given
+    if block_starts is None:
+        return array
+    return BlockSlab(array.shape, array.dtype, block_starts[0], block_starts[1], array.reshape(-1))
+
+
+def mmap_array(shape, dtype, directory=None):
+    # zero filled array backed by an unnamed file in directory, the file is removed once the array is dropped
+    with tempfile.TemporaryFile(prefix='ingest_slab_', dir=directory) as f:
+        return np.memmap(f, dtype=dtype, mode='w+', shape=shape)
+
+
+def parse_slab_backing(slab_backing):
+    # 'memory' or 'mmap:<directory>' -> (backing, directory)
+    if slab_backing is None or slab_backing == 'memory':
+        return 'memory', None
+    backing, _, directory = slab_backing.partition(':')
+    if backing != 'mmap':
+        raise ValueError('slab backing must be either "memory" or "mmap:<directory>"')
+    if not directory:
+        directory = tempfile.gettempdir()
+    if not os.path.isdir(directory):
+        raise ValueError('slab backing directory {} does not exist'.format(directory))
+    return backing, directory
+
+
+class SlabPool:
+    # free slab buffers kept for the next slabs (of any channel) with the same key (backing, shape and dtype),
+    # so each slab doesn't allocate, zero and page fault a new buffer
+    # a reused buffer still holds the previous slab: every slice is overwritten, or zeroed if its file is missing
+    def __init__(self, max_free=3):
+        self.max_free = max_free
+        self.free = []
+        self.allocated = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, key, create):
+        # a free buffer for key, or a new one from create()
+        with self.lock:
+            for idx, (free_key, buffer, _) in enumerate(self.free):
+                if free_key == key:
+                    del self.free[idx]
+                    self.reused += 1
+                    return buffer
+            self.allocated += 1
+        return create()
+
+    def release(self, key, buffer, discard=None):
+        # keeps the buffer for reuse, discarding the oldest free buffers once more than max_free are kept
+        # discard(buffer) frees a buffer that isn't just garbage collected (e.g. SharedSlab.release)
+        with self.lock:
+            self.free.append((key, buffer, discard))
+            num_evicted = max(0, len(self.free) - self.max_free)
+            evicted = self.free[:num_evicted]
+            self.free = self.free[num_evicted:]
+        discard_buffers(evicted)
+
+    def clear(self):
+        with self.lock:
+            evicted = self.free
+            self.free = []
+        discard_buffers(evicted)
+
+    def status_msg(self):
+        return 'Slab pool: {} slabs read into reused buffers, {} buffers allocated'.format(
+            self.reused, self.allocated)
+
+
+def discard_buffers(free):
+    for _, buffer, discard in free:
+        if discard is not None:
+            discard(buffer)
+
+
+class MemoryBudget:
+    # limit on the bytes of slabs held in memory at once, shared by every channel being ingested
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        # blocks until nbytes fit in the budget
+        # a slab larger than the whole budget is let through once nothing else is held
+        with self.cond:
+            while self.used_bytes > 0 and self.used_bytes + nbytes > self.max_bytes:
+                self.cond.wait()
+            self.used_bytes += nbytes
+
+    def release(self, nbytes):
+        with self.cond:
+            self.used_bytes -= nbytes
+            self.cond.notify_all()
+
+
+def get_slab_nbytes(num_slices, img_size, dtype):
+    return num_slices * img_size[1] * img_size[0] * np.dtype(dtype).itemsize
+
+
+def start_resource_tracker():
+    # the tracker has to be running before worker processes start so they share it with us,
+    # otherwise a worker starts its own tracker which unlinks our slabs when the worker exits
+    if resource_tracker is not None and os.name == 'posix':
+        resource_tracker.ensure_running()
+
+
+def get_block_nonzero_map(slab, y_starts, x_starts):
+    # which blocks of a (z, y, x) slab have any nonzero voxel, for the block grid starting at y_starts/x_starts
+    # (offsets into the slab, the last blocks run to the end of the slab, partial edge blocks included)
+    # a single pass over the slab, one row of blocks at a time: the band's slices are OR'd into a plane the size of
+    # the band (not of a whole slice, which takes gigabytes for large sections), then its rows, then block by block
+    y_stops = list(y_starts[1:]) + [slab.shape[1]]
+    nonzero_map = np.zeros((len(y_starts), len(x_starts)), dtype=bool)
+    for y_idx, (y_start, y_stop) in enumerate(zip(y_starts, y_stops)):
+        band = np.bitwise_or.reduce(slab[:, y_start:y_stop], axis=0)
+        row = np.bitwise_or.reduce(band, axis=0)
+        nonzero_map[y_idx] = np.bitwise_or.reduceat(row, x_starts) != 0
+    return nonzero_map
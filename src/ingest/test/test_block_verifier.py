@@ -0,0 +1,59 @@
+import numpy as np
+
+from ..block_verifier import BlockVerifier
+from ..compression import BlockCodec, compress_block
+
+
+def make_block(x_start, value=1):
+    data = np.full((16, 8, 8), value, dtype=np.uint16)
+    return compress_block(BlockCodec(), [x_start, x_start + 8], [0, 8], [0, 16], data)
+
+
+class TestBlockVerifier:
+
+    def setup(self):
+        # what the "Boss" returns for each block, by x start
+        self.boss = {}
+        self.msgs = []
+
+    def get_cutout(self, x_rng, y_rng, z_rng):
+        if x_rng[0] not in self.boss:
+            raise IOError('GET failed')
+        return self.boss[x_rng[0]]
+
+    def log(self, msg, send_slack=False):
+        self.msgs.append((msg, send_slack))
+
+    def test_verify_match_and_mismatch(self):
+        verifier = BlockVerifier(self.get_cutout, 1.0, threads=2, log=self.log)
+        self.boss[0] = np.full((16, 8, 8), 1, dtype=np.uint16)
+        self.boss[8] = np.full((16, 8, 8), 2, dtype=np.uint16)
+        verifier.submit(make_block(0))
+        verifier.submit(make_block(8))
+        verifier.close()
+
+        assert verifier.stats() == {'verified': 2, 'mismatches': 1, 'errors': 0, 'skipped': 0}
+        mismatches = [msg for msg in self.msgs if 'MISMATCH' in msg[0]]
+        assert len(mismatches) == 1
+        assert '[8, 16]' in mismatches[0][0] and mismatches[0][1]
+
+    def test_verify_get_error(self):
+        verifier = BlockVerifier(self.get_cutout, 1.0, log=self.log)
+        verifier.submit(make_block(16))
+        verifier.close()
+        assert verifier.stats() == {'verified': 0, 'mismatches': 0, 'errors': 1, 'skipped': 0}
+
+    def test_verify_fraction(self):
+        self.boss[0] = np.full((16, 8, 8), 1, dtype=np.uint16)
+        verifier = BlockVerifier(self.get_cutout, 0)
+        for _ in range(20):
+            verifier.submit(make_block(0))
+        verifier.close()
+        assert verifier.stats()['verified'] == 0
+
+    def test_verify_busy_skips(self):
+        # blocks beyond max_pending are left unchecked rather than holding up the ingest
+        verifier = BlockVerifier(self.get_cutout, 1.0, max_pending=0)
+        verifier.check(make_block(0))
+        verifier.close()
+        assert verifier.stats() == {'verified': 0, 'mismatches': 0, 'errors': 0, 'skipped': 1}
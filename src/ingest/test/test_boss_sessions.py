@@ -0,0 +1,96 @@
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import blosc
+import numpy as np
+from intern.remote.boss import BossRemote
+from intern.resource.boss.resource import ChannelResource
+
+from ..boss_sessions import BossSessions
+from ..compression import BlockCodec, compress_block
+
+
+class CutoutHandler(BaseHTTPRequestHandler):
+    # keeps connections alive and accepts every cutout
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.server.bodies.append(self.rfile.read(
+            int(self.headers['Content-Length'])))
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestBossSessions:
+
+    def setup(self):
+        self.server = ThreadingServer(('127.0.0.1', 0), CutoutHandler)
+        self.server.bodies = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.rmt = BossRemote({'protocol': 'http',
+                               'host': '127.0.0.1:{}'.format(self.server.server_address[1]),
+                               'token': 'test_token'})
+        self.ch_resource = ChannelResource(
+            'ch', 'coll', 'exp', datatype='uint8')
+        self.data = np.ones((16, 64, 64), dtype=np.uint8)
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, sessions, num_posts):
+        for i in range(num_posts):
+            sessions.create_cutout(self.ch_resource, 0, [0, 64], [
+                                   0, 64], [i * 16, (i + 1) * 16], self.data)
+
+    def test_sessions_reuse_connections(self):
+        sessions = BossSessions(self.rmt)
+        self.post(sessions, 5)
+
+        stats = sessions.stats()
+        assert stats['sessions'] == 1
+        assert stats['requests'] == 5
+        assert stats['connections'] == 1
+        assert stats['reused'] == 4
+        sessions.close()
+
+    def test_session_per_thread(self):
+        sessions = BossSessions(self.rmt)
+        threads = [threading.Thread(target=self.post, args=(sessions, 3))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = sessions.stats()
+        assert stats['sessions'] == 4
+        assert stats['requests'] == 12
+        assert stats['connections'] == 4
+        assert '4 POST sessions sent 12 requests over 4 connections (66.7% reused)' == sessions.status_msg()
+
+        sessions.close()
+        assert sessions.stats()['sessions'] == 0
+
+    def test_compressed_cutout(self):
+        sessions = BossSessions(self.rmt)
+        block = compress_block(BlockCodec('lz4', 5, 'bitshuffle'),
+                               [0, 64], [0, 64], [0, 16], self.data)
+        sessions.create_compressed_cutout(self.ch_resource, 0, block.x_rng, block.y_rng, block.z_rng,
+                                          block.payload)
+
+        # the payload is POSTed as is
+        assert self.server.bodies == [block.payload]
+        assert np.array_equal(np.frombuffer(blosc.decompress(self.server.bodies[0]), dtype=np.uint8),
+                              self.data.ravel())
+        sessions.close()
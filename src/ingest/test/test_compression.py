@@ -0,0 +1,93 @@
+import blosc
+import numpy as np
+import pytest
+
+from ..compression import (BlockCodec, SlabCompression, compress_block,
+                           decompress_block, get_codec, parse_codecs)
+from ..manifest import block_digest
+
+
+class TestCompression:
+
+    def test_parse_codecs(self):
+        codecs = parse_codecs(
+            ['uint16:lz4:5:bitshuffle', 'uint64:zstd:3:shuffle'])
+        assert sorted(codecs) == ['uint16', 'uint64']
+        assert codecs['uint16'].cname == 'lz4'
+        assert codecs['uint16'].clevel == 5
+        assert codecs['uint16'].shuffle == 'bitshuffle'
+
+        assert parse_codecs(None) == {}
+
+    def test_parse_codecs_invalid(self):
+        with pytest.raises(ValueError):
+            parse_codecs(['uint16:lz4:5'])
+        with pytest.raises(ValueError):
+            parse_codecs(['uint16:gzip:5:shuffle'])
+        with pytest.raises(ValueError):
+            parse_codecs(['uint16:lz4:10:shuffle'])
+        with pytest.raises(ValueError):
+            parse_codecs(['uint16:lz4:5:byteshuffle'])
+
+    def test_get_codec(self):
+        codecs = parse_codecs(['uint64:zstd:3:bitshuffle'])
+        assert get_codec(codecs, 'uint64').cname == 'zstd'
+
+        # datatypes without a codec get the one intern uses
+        codec = get_codec(codecs, 'uint16')
+        assert (codec.cname, codec.clevel, codec.shuffle) == (
+            'blosclz', 9, 'shuffle')
+
+    def test_compress_block(self):
+        data = np.zeros((16, 64, 128), dtype=np.uint16)
+        data[:, 10:20, 30:60] = 300
+
+        # blocks are usually sliced (not contiguous) out of a slab
+        slab = np.zeros((16, 128, 256), dtype=np.uint16)
+        slab[:, 0:64, 0:128] = data
+        block = compress_block(BlockCodec('zstd', 3, 'bitshuffle'), [0, 128], [0, 64], [0, 16],
+                               slab[:, 0:64, 0:128])
+
+        assert block.raw_nbytes == data.nbytes
+        assert block.nbytes < data.nbytes
+        assert block.compress_time >= 0
+
+        # the BOSS decompresses the payload to the block
+        decompressed = np.frombuffer(blosc.decompress(
+            block.payload), dtype=np.uint16).reshape(data.shape)
+        assert np.array_equal(decompressed, data)
+
+    def test_compress_block_cast(self):
+        # annotations are cast to uint64 block by block
+        slab = np.zeros((16, 128, 256), dtype=np.uint16)
+        slab[:, 10:20, 30:60] = 300
+        block = compress_block(BlockCodec(), [0, 128], [0, 64], [0, 16],
+                               slab[:, 0:64, 0:128], 'uint64')
+
+        assert block.raw_nbytes == 16 * 64 * 128 * 8
+        decompressed = np.frombuffer(blosc.decompress(
+            block.payload), dtype=np.uint64).reshape((16, 64, 128))
+        assert np.array_equal(decompressed, slab[:, 0:64, 0:128])
+
+    def test_decompress_block(self):
+        data = np.random.randint(0, 2**16, size=(16, 20, 30), dtype=np.uint16)
+        block = compress_block(BlockCodec('lz4', 5, 'shuffle'), [0, 30], [0, 20], [16, 32], data, 'uint64')
+        decompressed = decompress_block(block)
+        assert decompressed.dtype == np.uint64
+        assert np.array_equal(decompressed, data)
+
+    def test_compress_block_digest(self):
+        data = np.random.randint(0, 3, size=(16, 20, 30), dtype=np.uint16)
+        block = compress_block(BlockCodec(), [0, 30], [0, 20], [0, 16], data[:, :, :], 'uint64', digest=True)
+        assert block.digest == block_digest(data.astype(np.uint64))
+        assert block.nonzero == np.count_nonzero(data)
+        assert compress_block(BlockCodec(), [0, 30], [0, 20], [0, 16], data).digest is None
+
+    def test_slab_compression(self):
+        slab_compression = SlabCompression(
+            list(range(16, 32)), BlockCodec('lz4', 5, 'shuffle'))
+        slab_compression.add(4 * 1024**2, 1024**2, 0.5)
+        slab_compression.add(4 * 1024**2, 1024**2, 0.25)
+
+        assert slab_compression.status_msg() == \
+            'Compressed z range 16:32 from 8.0 MB to 2.0 MB (ratio 4.00) in 0.75 sec with lz4 level 5 shuffle'
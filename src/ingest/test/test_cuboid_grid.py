@@ -0,0 +1,75 @@
+import pickle
+
+import pytest
+
+from ..cuboid_grid import CuboidGrid, GridAxis
+
+
+class TestCuboidGrid:
+
+    def test_grid_axis(self):
+        axis = GridAxis([100, 2500], 1024)
+        assert len(axis) == 3
+        assert list(axis) == [0, 1, 2]
+        assert axis[0] == range(100, 1024)
+        assert axis[2] == range(2048, 2500)
+        assert list(axis.ranges()) == [[100, 1024], [1024, 2048], [2048, 2500]]
+        assert axis.bucket(1024) == 1
+        with pytest.raises(KeyError):
+            axis[3]
+        with pytest.raises(KeyError):
+            axis.bucket(2500)
+
+    def test_grid_axis_matches_coordinate_buckets(self):
+        # same buckets as grouping every coordinate by coord // stride
+        for rng, stride in (([0, 40], 16), ([5, 100], 32), ([-20, 10], 16), ([3, 4], 512), ([7, 7], 16)):
+            buckets = {}
+            for coord in range(rng[0], rng[1]):
+                buckets.setdefault(coord // stride, []).append(coord)
+            axis = GridAxis(rng, stride)
+            assert {bucket: list(coords) for bucket, coords in axis.items()} == buckets
+
+    def test_grid_axis_large_extent(self):
+        # ranges are computed, not listed
+        axis = GridAxis([0, 10**12], 512)
+        assert len(axis) == 10**12 // 512
+        assert axis[10**9] == range(512 * 10**9, 512 * (10**9 + 1))
+
+    def test_grid_axis_pickle(self):
+        # z slices are handed to worker processes
+        axis = GridAxis([5, 100], 16)
+        assert pickle.loads(pickle.dumps(axis))[1] == range(16, 32)
+
+    def test_grid_axis_overlapping(self):
+        axis = GridAxis([100, 2500], 1024)
+        assert axis.overlapping([1000, 1100]) == range(0, 2)
+        assert axis.overlapping([2048, 3000]) == range(2, 3)
+        assert len(axis.overlapping([2500, 3000])) == 0
+
+    def test_grid_axis_origin(self):
+        # buckets aligned to a frame where coordinate 5 is 0 (e.g. image slices offset by -5 in the Boss)
+        axis = GridAxis([0, 40], 16, origin=5)
+        assert list(axis.ranges()) == [[0, 5], [5, 21], [21, 37], [37, 40]]
+        assert axis.bucket(4) == -1
+        assert axis.bucket(5) == 0
+        assert axis.overlapping([20, 22]) == range(0, 2)
+
+    def test_cuboid_grid(self):
+        grid = CuboidGrid([0, 1500], [0, 1024], [0, 20], [1024, 512, 16])
+        assert len(grid) == 8
+        blocks = list(grid)
+        assert blocks[0] == ([0, 1024], [0, 512], [0, 16])
+        assert blocks[1] == ([1024, 1500], [0, 512], [0, 16])
+        assert blocks[-1] == ([1024, 1500], [512, 1024], [16, 20])
+        assert list(grid.slab_blocks(1)) == blocks[4:]
+
+    def test_cuboid_grid_intersecting(self):
+        grid = CuboidGrid([0, 4096], [0, 4096], [0, 64], [1024, 1024, 16])
+        # whole blocks are returned, not clipped to the region
+        assert list(grid.intersecting([1000, 1100], [2048, 2049], [20, 21])) == [
+            ([0, 1024], [2048, 3072], [16, 32]), ([1024, 2048], [2048, 3072], [16, 32])]
+        assert list(grid.intersecting([5000, 6000], [0, 10], [0, 10])) == []
+
+    def test_cuboid_grid_origin(self):
+        grid = CuboidGrid([0, 1024], [0, 512], [0, 20], [1024, 512, 16], (0, 0, -10))
+        assert [z_rng for _, _, z_rng in grid] == [[0, 6], [6, 20]]
@@ -0,0 +1,88 @@
+import os
+import shutil
+from argparse import Namespace
+
+import numpy as np
+from PIL import Image
+
+from ....export_boss import NpyWriter, TiffStackWriter, export_region, get_export_journal_fname
+from ..ingest_job import IngestJob
+from ..journal import BlockJournal, read_journal
+
+
+class FakeRemote:
+    # cutouts of a volume in memory, failing the GETs of the blocks starting at fail_x
+    def __init__(self, volume, fail_x=None):
+        self.volume = volume
+        self.fail_x = fail_x
+        self.num_gets = 0
+
+    def get_cutout(self, resource, res, x_rng, y_rng, z_rng):
+        self.num_gets += 1
+        if x_rng[0] == self.fail_x:
+            raise IOError('GET failed')
+        return self.volume[z_rng[0]:z_rng[1], y_rng[0]:y_rng[1], x_rng[0]:x_rng[1]].copy()
+
+
+class TestExportBoss:
+
+    def setup(self):
+        self.output_dir = 'test_export'
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.args = Namespace(datasource='local',
+                              collection='ben_dev',
+                              experiment='dev_ingest_4',
+                              channel='def_files',
+                              datatype='uint16',
+                              x_extent=[0, 1500],
+                              y_extent=[0, 600],
+                              z_extent=[0, 40],
+                              z_range=[0, 40],
+                              res=0)
+        self.volume = np.random.randint(0, 2**16, size=(40, 600, 1500), dtype=np.uint16)
+
+    def teardown(self):
+        shutil.rmtree(self.output_dir)
+
+    def export(self, ingest_job, writer, rmt, resume=False):
+        journal = BlockJournal(get_export_journal_fname(self.output_dir, ingest_job), resume)
+        try:
+            return export_region(Namespace(rmt=rmt, ch_resource=None), ingest_job, writer, journal,
+                                 threads=4, block_shape=[1024, 512, 16], attempts=1)
+        finally:
+            writer.close()
+            journal.close()
+
+    def test_export_tif(self):
+        ingest_job = IngestJob(self.args)
+        writer = TiffStackWriter(self.output_dir, 'def_files')
+        assert self.export(ingest_job, writer, FakeRemote(self.volume)) == 0
+
+        for z_slice in (0, 17, 39):
+            img = np.array(Image.open(writer.get_fname(z_slice)))
+            assert np.array_equal(img, self.volume[z_slice])
+        assert not [fname for fname in os.listdir(self.output_dir) if fname.endswith('.part')]
+
+        os.remove(ingest_job.get_log_fname())
+
+    def test_export_npy_resume(self):
+        ingest_job = IngestJob(self.args)
+        path = os.path.join(self.output_dir, 'def_files.npy')
+
+        # blocks starting at x = 1024 fail: every slab is journaled as failed
+        writer = NpyWriter(path, self.volume.shape, 'uint16', 0)
+        assert self.export(ingest_job, writer, FakeRemote(self.volume, fail_x=1024)) == 2 * 3
+        statuses = read_journal(get_export_journal_fname(self.output_dir, ingest_job))
+        assert sorted(statuses.values()) == ['failed'] * 3
+
+        # resuming fetches them again, the slabs already done aren't
+        writer = NpyWriter(path, self.volume.shape, 'uint16', 0, resume=True)
+        assert self.export(ingest_job, writer, FakeRemote(self.volume), resume=True) == 0
+        rmt = FakeRemote(self.volume)
+        writer = NpyWriter(path, self.volume.shape, 'uint16', 0, resume=True)
+        assert self.export(ingest_job, writer, rmt, resume=True) == 0
+        assert rmt.num_gets == 0
+
+        assert np.array_equal(np.load(path), self.volume)
+
+        os.remove(ingest_job.get_log_fname())
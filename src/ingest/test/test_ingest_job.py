@@ -1,13 +1,18 @@
 import os
+import tempfile
 from argparse import Namespace
 from datetime import datetime
+from unittest import mock
 
 import boto3
 import numpy as np
 import pytest
+import tifffile
 from PIL import Image
 
+from .. import ingest_job as ingest_job_module
 from ..ingest_job import IngestJob
+from ..slabs import SlabPool
 from .create_images import create_img_file, del_test_images, gen_images
 
 
@@ -141,6 +146,52 @@ class TestIngestJob:
         with pytest.raises(ValueError):
             IngestJob(self.args)
 
+    def test_executor(self):
+        self.args.executor = 'process'
+        self.args.workers = 2
+        with pytest.raises(ValueError):
+            IngestJob(self.args)
+
+        # the POSTs would run in processes the controller can't limit
+        self.args.workers = 1
+        self.args.adaptive_threads = True
+        with pytest.raises(ValueError):
+            IngestJob(self.args)
+
+        self.args.executor = 'thread'
+        ingest_job = IngestJob(self.args)
+        assert ingest_job.adaptive_threads
+        os.remove(ingest_job.get_log_fname())
+
+    def test_block_shape(self):
+        ingest_job = IngestJob(self.args)
+        assert ingest_job.block_shape == [1024, 1024, 16]
+        os.remove(ingest_job.get_log_fname())
+
+        self.args.block_shape = [2048, 512, 64]
+        ingest_job = IngestJob(self.args)
+        assert ingest_job.block_shape == [2048, 512, 64]
+        os.remove(ingest_job.get_log_fname())
+
+    def test_block_shape_not_cuboid_multiple(self):
+        # blocks have to be whole Boss cuboids (512 x 512 x 16)
+        for block_shape in ([1000, 1024, 16], [1024, 1024, 24], [1024, 0, 16], [1024, 1024]):
+            self.args.block_shape = block_shape
+            with pytest.raises(ValueError):
+                IngestJob(self.args)
+
+    def test_block_shape_too_large(self):
+        # blocks are POSTed whole, so they can't be larger than one POST of intern (1024 x 1024 x 64 voxels)
+        for block_shape in ([2048, 2048, 32], [4096, 1024, 32], [1024, 1024, 128]):
+            self.args.block_shape = block_shape
+            with pytest.raises(ValueError):
+                IngestJob(self.args)
+
+        self.args.block_shape = [2048, 2048, 16]
+        ingest_job = IngestJob(self.args)
+        assert ingest_job.block_shape == [2048, 2048, 16]
+        os.remove(ingest_job.get_log_fname())
+
     def test_create_local_IngestJob_annotation(self):
         self.args.source_channel = 'def_files'
         self.args.datatype = 'uint64'
@@ -165,6 +216,22 @@ class TestIngestJob:
 
         os.remove(ingest_job.get_log_fname())
 
+    def test_read_img_stack_annotation_uint32(self):
+        # annotation slabs keep the datatype of the images, blocks are cast to uint64 as they are POSTed
+        self.args.source_channel = 'def_files'
+        self.args.datatype = 'uint32'
+        self.args.z_range = [0, 2]
+
+        ingest_job = IngestJob(self.args)
+        gen_images(ingest_job)
+
+        im_array = ingest_job.read_img_stack(range(0, 2))
+        assert im_array.dtype == np.uint32
+        assert ingest_job.get_post_datatype() == 'uint64'
+
+        del_test_images(ingest_job)
+        os.remove(ingest_job.get_log_fname())
+
     def test_create_local_IngestJob_annotation_uint32_no_source_channel(self):
         self.args.datatype = 'uint32'
 
@@ -340,6 +407,58 @@ class TestIngestJob:
         assert np.array_equal(im, img_local_test)
         os.remove(ingest_job.get_log_fname())
 
+    def test_load_img_local_memmap(self):
+        # uncompressed images are mapped from the file, the others decoded
+        ingest_job = IngestJob(self.args)
+
+        img_fname = ingest_job.get_img_fname(0)
+        create_img_file(ingest_job.img_size[0], ingest_job.img_size[1],
+                        self.args.datatype, self.args.extension, img_fname)
+        data = tifffile.imread(img_fname)
+
+        im = ingest_job.load_img(0)
+        assert isinstance(im, np.memmap)
+        assert np.array_equal(im, data)
+        del im
+
+        for kwargs in ({'compression': 'zlib'}, {'predictor': True, 'compression': 'zlib'}):
+            tifffile.imwrite(img_fname, data, **kwargs)
+            im = ingest_job.load_img(0)
+            assert not isinstance(im, np.memmap)
+            assert np.array_equal(im, data)
+
+        os.remove(img_fname)
+        os.remove(ingest_job.get_log_fname())
+
+    def test_load_img_local_memmap_old_tifffile(self):
+        # with a tifffile whose pages have no is_final, images are decoded instead of failing
+        ingest_job = IngestJob(self.args)
+
+        img_fname = ingest_job.get_img_fname(0)
+        create_img_file(ingest_job.img_size[0], ingest_job.img_size[1],
+                        self.args.datatype, self.args.extension, img_fname)
+
+        class OldTiffFile:
+            # pages without is_final and dataoffsets
+            def __init__(self, *args, **kwargs):
+                self.pages = [Namespace(dtype=np.dtype('uint16'), shape=(1024, 1000))]
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+        old_tifffile = Namespace(TiffFile=OldTiffFile, imread=tifffile.imread)
+        with mock.patch.object(ingest_job_module, 'tifffile', old_tifffile):
+            im = ingest_job.load_img(0)
+        assert not isinstance(im, np.memmap)
+        assert np.array_equal(im, tifffile.imread(img_fname))
+        assert ingest_job.num_READ_failures == 0
+
+        os.remove(img_fname)
+        os.remove(ingest_job.get_log_fname())
+
     def test_load_img_s3(self):
         # currently contained in the load_img_info_s3 test
         pass
@@ -543,3 +662,88 @@ class TestIngestJob:
 
         del_test_images(ingest_job)
         os.remove(ingest_job.get_log_fname())
+
+    def test_read_uint16_img_stack_threads(self):
+        self.args.z_range = [0, 16]
+
+        ingest_job = IngestJob(self.args)
+        gen_images(ingest_job)
+
+        z_slices = range(self.args.z_range[0], self.args.z_range[1])
+
+        ingest_job.read_threads = 1
+        im_array_serial = ingest_job.read_img_stack(z_slices)
+
+        ingest_job.read_threads = 8
+        im_array_threaded = ingest_job.read_img_stack(z_slices)
+
+        assert np.array_equal(im_array_serial, im_array_threaded)
+        for z in z_slices:
+            with Image.open(ingest_job.get_img_fname(z)) as im:
+                assert np.array_equal(im_array_threaded[z, :, :], im)
+
+        del_test_images(ingest_job)
+        os.remove(ingest_job.get_log_fname())
+
+    def test_read_img_stack_slab_pool(self):
+        self.args.z_range = [0, 16]
+
+        ingest_job = IngestJob(self.args)
+        ingest_job.slab_pool = SlabPool()
+        gen_images(ingest_job)
+        z_slices = range(self.args.z_range[0], self.args.z_range[1])
+
+        im_array = ingest_job.read_img_stack(z_slices)
+        expected = im_array.copy()
+        ingest_job.release_slab_buffer(im_array)
+
+        # the next slab reuses the buffer, the slice of a missing image is zeroed
+        os.remove(ingest_job.get_img_fname(3))
+        reused_array = ingest_job.read_img_stack(z_slices)
+        assert reused_array is im_array
+        assert ingest_job.slab_pool.reused == 1
+        assert not reused_array[3].any()
+        expected[3] = 0
+        assert np.array_equal(reused_array, expected)
+
+        gen_images(ingest_job)
+        del_test_images(ingest_job)
+        os.remove(ingest_job.get_log_fname())
+
+    def test_read_img_stack_mmap_backing(self):
+        self.args.z_range = [0, 16]
+
+        ingest_job = IngestJob(self.args)
+        gen_images(ingest_job)
+        z_slices = range(self.args.z_range[0], self.args.z_range[1])
+        im_array = ingest_job.read_img_stack(z_slices)
+
+        self.args.slab_backing = 'mmap:' + tempfile.gettempdir()
+        ingest_job = IngestJob(self.args)
+        assert ingest_job.slab_backing == 'mmap'
+        mmap_slab = ingest_job.read_img_stack(z_slices)
+        assert isinstance(mmap_slab, np.memmap)
+        assert np.array_equal(mmap_slab, im_array)
+
+        del_test_images(ingest_job)
+        os.remove(ingest_job.get_log_fname())
+
+    def test_read_img_stack_block_layout(self):
+        self.args.z_range = [0, 16]
+
+        ingest_job = IngestJob(self.args)
+        gen_images(ingest_job)
+
+        z_slices = range(self.args.z_range[0], self.args.z_range[1])
+        im_array = ingest_job.read_img_stack(z_slices)
+
+        y_starts = list(range(0, ingest_job.img_size[1], 512))
+        x_starts = list(range(0, ingest_job.img_size[0], 512))
+        block_slab = ingest_job.read_img_stack(z_slices, block_starts=(y_starts, x_starts))
+        assert np.array_equal(block_slab.to_array(), im_array)
+        block = block_slab.get_block(y_starts[-1], x_starts[-1])
+        assert block.flags['C_CONTIGUOUS']
+        assert np.array_equal(block, im_array[:, y_starts[-1]:, x_starts[-1]:])
+
+        del_test_images(ingest_job)
+        os.remove(ingest_job.get_log_fname())
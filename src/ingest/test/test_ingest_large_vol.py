@@ -1,20 +1,46 @@
 import os
+import threading
 import time
 from argparse import Namespace
 from datetime import datetime
 from multiprocessing.dummy import Pool as ThreadPool
 from functools import partial
 
+import blosc
 import numpy as np
 import pytest
 
 from ....ingest_large_vol import (per_channel_ingest, post_cutout, read_channel_names,
-                                  assert_equal, ingest_block, get_supercube_lims, download_boss_slice)
+                                  assert_equal, ingest_block, get_supercube_lims, download_boss_slice,
+                                  read_slabs, create_process_pool, read_shared_img_stack,
+                                  get_z_shards, BlockQueue, get_block_rngs, SlabBlocks,
+                                  get_nonempty_blocks, get_tune_candidates, get_tune_region, read_tune_sample,
+                                  get_slab_z_rng, get_z_origin, get_partial_cuboid_edges, get_padded_rngs,
+                                  compress_slab_block, open_block_records, ingest_z_range)
+from .... import ingest_large_vol
 from ..boss_resources import BossResParams
 from ..ingest_job import IngestJob
+from ..journal import read_journal
+from ..manifest import read_manifest
 from .create_images import del_test_images, gen_images
 
 
+class ThreadSessions:
+    # accepts every POST, recording the threads that POSTed (each would hold a session of its own)
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.threads = set()
+        self.lock = threading.Lock()
+
+    def create_compressed_cutout(self, resource, resolution, x_rng, y_rng, z_rng, payload):
+        time.sleep(self.delay)
+        with self.lock:
+            self.threads.add(threading.current_thread())
+
+    def stats(self):
+        return {'sessions': len(self.threads), 'requests': 0, 'connections': 0}
+
+
 class TestIngestLargeVol:
 
     def setup(self):
@@ -227,6 +253,283 @@ class TestIngestLargeVol:
         del_test_images(ingest_job)
         os.remove(ingest_job.get_log_fname())
 
+    def test_read_slabs_prefetch(self):
+        self.args.channel = 'def_files'
+        self.args.datatype = 'uint16'
+        self.args.extension = 'tif'
+        self.args.z_range = [0, 40]
+
+        ingest_job = IngestJob(self.args)
+        gen_images(ingest_job)
+
+        z_buckets = get_supercube_lims(ingest_job.z_range, 16)
+        for prefetch in [0, 1, 3]:
+            slabs = list(read_slabs(ingest_job, z_buckets, prefetch))
+
+            assert [z_slices for z_slices, _ in slabs] == list(z_buckets.values())
+            for z_slices, im_array in slabs:
+                assert np.array_equal(
+                    im_array, ingest_job.read_img_stack(z_slices))
+
+        del_test_images(ingest_job)
+        os.remove(ingest_job.get_log_fname())
+
+    def test_read_slabs_read_error(self):
+        self.args.channel = 'def_files'
+        self.args.datatype = 'uint16'
+        self.args.extension = 'tif'
+        self.args.z_range = [0, 32]
+        self.args.warn_missing_files = False
+
+        ingest_job = IngestJob(self.args)
+
+        # no images were generated, so the background read fails
+        z_buckets = get_supercube_lims(ingest_job.z_range, 16)
+        with pytest.raises(IOError):
+            list(read_slabs(ingest_job, z_buckets, 1))
+
+        os.remove(ingest_job.get_log_fname())
+
+    def test_read_shared_img_stack(self):
+        self.args.channel = 'def_files'
+        self.args.datatype = 'uint16'
+        self.args.extension = 'tif'
+        self.args.z_range = [0, 16]
+
+        ingest_job = IngestJob(self.args)
+        gen_images(ingest_job)
+
+        z_slices = list(range(self.args.z_range[0], self.args.z_range[1]))
+        with create_process_pool(4, self.args, False) as pool:
+            slab = read_shared_img_stack(pool, ingest_job, z_slices)
+
+        assert np.array_equal(
+            slab.array, ingest_job.read_img_stack(z_slices))
+        slab.release()
+
+        del_test_images(ingest_job)
+        os.remove(ingest_job.get_log_fname())
+
+    def test_get_z_shards(self):
+        assert get_z_shards([0, 100], 64) == [[0, 64], [64, 100]]
+        assert get_z_shards([5, 100], 32) == [[5, 32], [32, 64], [64, 96], [96, 100]]
+
+        # shards are always multiples of 16 slices
+        assert get_z_shards([0, 40], 20) == [[0, 16], [16, 32], [32, 40]]
+        assert get_z_shards([-20, 10], 16) == [[-20, -16], [-16, 0], [0, 10]]
+        assert get_z_shards([0, 0], 16) == []
+
+    def test_get_z_shards_origin(self):
+        # image slices offset by 5 in the Boss: shards start on Boss multiples of 16
+        assert get_z_shards([0, 40], 16, 16, -5) == [[0, 11], [11, 27], [27, 40]]
+
+    def test_get_z_shards_deep_blocks(self):
+        # shards of 64 slice deep blocks are multiples of 64 slices
+        assert get_z_shards([0, 300], 128, 64) == [[0, 128], [128, 256], [256, 300]]
+        assert get_z_shards([0, 100], 100, 64) == [[0, 64], [64, 100]]
+
+    def test_get_tune_candidates(self):
+        self.args.channel = 'def_files'
+        self.args.x_extent = [0, 1500]
+        self.args.y_extent = [0, 1024]
+        self.args.z_range = [0, 40]
+        self.args.block_shape = [512, 1024, 16]
+        ingest_job = IngestJob(self.args)
+
+        # --block_shape first, then the shapes no larger than the volume in whole cuboids (1536 x 1024 x 48)
+        candidates = get_tune_candidates(ingest_job)
+        assert candidates == [[512, 1024, 16], [512, 512, 16], [1024, 1024, 16], [512, 512, 32], [1024, 1024, 32]]
+        assert get_tune_region(ingest_job, candidates) == [[0, 1024], [0, 1024], [0, 32]]
+
+        os.remove(ingest_job.get_log_fname())
+
+    def test_get_tune_candidates_too_large(self):
+        # shapes larger than one POST of intern aren't tried
+        self.args.channel = 'def_files'
+        self.args.x_extent = [0, 4096]
+        self.args.y_extent = [0, 4096]
+        self.args.z_extent = [0, 128]
+        self.args.z_range = [0, 128]
+        ingest_job = IngestJob(self.args)
+
+        ingest_large_vol.TUNE_BLOCK_SHAPES.append([2048, 2048, 32])
+        try:
+            candidates = get_tune_candidates(ingest_job)
+        finally:
+            ingest_large_vol.TUNE_BLOCK_SHAPES.pop()
+        assert [2048, 2048, 16] in candidates
+        assert [2048, 2048, 32] not in candidates
+
+        os.remove(ingest_job.get_log_fname())
+
+    def test_read_tune_sample(self):
+        self.args.channel = 'def_files'
+        self.args.datatype = 'uint16'
+        self.args.extension = 'tif'
+        self.args.z_range = [0, 4]
+        ingest_job = IngestJob(self.args)
+        gen_images(ingest_job)
+
+        region = [[0, 512], [512, 1024], [1, 3]]
+        sample = read_tune_sample(ingest_job, region)
+        im_array = ingest_job.read_img_stack(range(0, 4))
+        assert np.array_equal(sample, im_array[1:3, 512:1024, 0:512])
+
+        del_test_images(ingest_job)
+        os.remove(ingest_job.get_log_fname())
+
+    def test_get_block_rngs(self):
+        x_buckets = get_supercube_lims([0, 2500], 1024)
+        y_buckets = get_supercube_lims([100, 1100], 1024)
+
+        assert get_block_rngs(x_buckets, y_buckets) == [
+            ([0, 1024], [100, 1024]), ([1024, 2048], [100, 1024]), ([2048, 2500], [100, 1024]),
+            ([0, 1024], [1024, 1100]), ([1024, 2048], [1024, 1100]), ([2048, 2500], [1024, 1100])]
+
+    def test_get_nonempty_blocks(self):
+        self.args.channel = 'def_files'
+        self.args.datatype = 'uint16'
+        self.args.x_extent = [100, 2500]
+        self.args.y_extent = [0, 1100]
+        ingest_job = IngestJob(self.args)
+
+        x_buckets = get_supercube_lims(ingest_job.x_extent, 1024)
+        y_buckets = get_supercube_lims(ingest_job.y_extent, 1024)
+        block_rngs = get_block_rngs(x_buckets, y_buckets)
+
+        im_array = np.zeros((2, 1100, 2400), dtype=np.uint16)
+        im_array[1, 50, 3] = 1        # block x 100:1024, y 0:1024
+        im_array[0, 1099, 2399] = 7   # partial edge block x 2048:2500, y 1024:1100
+        assert get_nonempty_blocks(ingest_job, x_buckets, y_buckets, [0, 2], block_rngs, im_array) == [
+            ([100, 1024], [0, 1024]), ([2048, 2500], [1024, 1100])]
+
+        # only blocks in block_rngs (e.g. not finished before a resume) are checked
+        assert get_nonempty_blocks(ingest_job, x_buckets, y_buckets, [0, 2], block_rngs[1:], im_array) == [
+            ([2048, 2500], [1024, 1100])]
+
+        os.remove(ingest_job.get_log_fname())
+
+    def test_offset_z_in_boss_frame(self):
+        self.args.channel = 'def_files'
+        self.args.z_extent = [-100, 100]
+        self.args.z_range = [-3, 20]
+        self.args.offset_extents = True
+        ingest_job = IngestJob(self.args)
+
+        # image slices are offset like the extents
+        assert ingest_job.z_extent == [0, 200]
+        assert get_slab_z_rng(ingest_job, range(-3, 12)) == [97, 112]
+
+        # z buckets start on Boss cuboid boundaries
+        z_buckets = get_supercube_lims(ingest_job.z_range, 16, get_z_origin(ingest_job))
+        assert list(z_buckets.ranges()) == [[-3, 12], [12, 20]]
+        assert [get_slab_z_rng(ingest_job, z_buckets[bucket]) for bucket in z_buckets] == [[97, 112], [112, 120]]
+
+        os.remove(ingest_job.get_log_fname())
+
+    def test_get_partial_cuboid_edges(self):
+        self.args.channel = 'def_files'
+        self.args.x_extent = [0, 1000]
+        self.args.y_extent = [0, 1024]
+        self.args.z_range = [0, 2]
+        ingest_job = IngestJob(self.args)
+
+        assert get_partial_cuboid_edges(ingest_job, ingest_job.z_range) == [('x', 1000), ('z', 2)]
+        assert get_partial_cuboid_edges(ingest_job, [16, 32]) == [('x', 1000)]
+
+        os.remove(ingest_job.get_log_fname())
+
+    def test_get_padded_rngs(self):
+        self.args.channel = 'def_files'
+        self.args.x_extent = [100, 1000]
+        self.args.y_extent = [0, 1024]
+        self.args.z_extent = [0, 30]
+        self.args.coord_frame_x_extent = [0, 1200]
+        ingest_job = IngestJob(self.args)
+
+        # only the edges of the data are padded, within the coordinate frame
+        assert get_padded_rngs(ingest_job, [100, 1000], [0, 1024], [0, 16]) == [[0, 1024], [0, 1024], [0, 16]]
+        assert get_padded_rngs(ingest_job, [100, 1000], [0, 1024], [16, 30]) == [[0, 1024], [0, 1024], [16, 30]]
+        ingest_job.coord_frame_x_extent = [100, 1000]
+        ingest_job.coord_frame_z_extent = [0, 100]
+        assert get_padded_rngs(ingest_job, [100, 1000], [0, 1024], [16, 30]) == [[100, 1000], [0, 1024], [16, 32]]
+
+        os.remove(ingest_job.get_log_fname())
+
+    def test_compress_slab_block_pad(self):
+        self.args.channel = 'def_files'
+        self.args.datatype = 'uint16'
+        self.args.x_extent = [0, 1000]
+        self.args.y_extent = [0, 512]
+        self.args.z_extent = [0, 2]
+        self.args.coord_frame_x_extent = [0, 1024]
+        self.args.coord_frame_z_extent = [0, 16]
+        self.args.edge_cuboids = 'pad'
+        ingest_job = IngestJob(self.args)
+
+        im_array = np.random.randint(1, 100, size=(2, 512, 1000), dtype=np.uint16)
+        block = compress_slab_block(ingest_job, [512, 1000], [0, 512], [0, 2], im_array)
+
+        # POSTed padded to whole cuboids, journaled at the block's own ranges
+        assert (block.x_rng, block.y_rng, block.z_rng) == ([512, 1024], [0, 512], [0, 16])
+        assert block.block_rngs == ([512, 1000], [0, 512], [0, 2])
+        data = np.frombuffer(blosc.decompress(block.payload), dtype=np.uint16).reshape(16, 512, 512)
+        assert np.array_equal(data[:2, :, :488], im_array[:, :, 512:])
+        assert not data[2:].any() and not data[:, :, 488:].any()
+
+        os.remove(ingest_job.get_log_fname())
+
+    def test_block_queue(self):
+        max_queued = 3
+        in_flight = []
+        results = []
+
+        def work(i):
+            in_flight.append(i)
+            time.sleep(0.01)
+            assert len(in_flight) <= max_queued
+            in_flight.remove(i)
+            return i
+
+        with ThreadPool(2) as pool:
+            block_queue = BlockQueue(pool, max_queued)
+            for i in range(20):
+                block_queue.submit(work, (i,), results.append)
+            block_queue.join()
+
+        assert sorted(results) == list(range(20))
+        assert not block_queue.errors
+
+    def test_block_queue_error(self):
+        def work(i):
+            if i == 5:
+                raise IOError('block failed')
+            return i
+
+        with ThreadPool(2) as pool:
+            block_queue = BlockQueue(pool, 4)
+            for i in range(10):
+                block_queue.submit(work, (i,))
+            with pytest.raises(IOError):
+                block_queue.join()
+
+    def test_slab_blocks(self):
+        slabs_done = []
+        results = []
+        slab_blocks = SlabBlocks(3, lambda: slabs_done.append(True), results.append)
+
+        slab_blocks.block_done(0)
+        slab_blocks.block_done(1)
+        assert not slabs_done
+
+        slab_blocks.block_done(0)
+        assert slabs_done == [True]
+        assert results == [0, 1, 0]
+
+        # a slab without any blocks is done right away
+        SlabBlocks(0, lambda: slabs_done.append(True))
+        assert slabs_done == [True, True]
+
     def test_read_channel_names(self):
         channels_path = 'channels.example.txt'
         channels = read_channel_names(channels_path)
@@ -469,3 +772,100 @@ class TestIngestLargeVol:
         boss_res_params.rmt.delete_project(boss_res_params.ch_resource)
         boss_res_params.rmt.delete_project(boss_res_params.exp_resource)
         os.remove(ingest_job.get_log_fname())
+
+    def test_ingest_shards_reuse_post_threads(self):
+        # a worker's shards are POSTed by the same threads, so their sessions aren't opened again for every shard
+        self.args.channel = 'def_files'
+        self.args.datatype = 'uint16'
+        self.args.extension = 'tif'
+        self.args.z_range = [0, 32]
+        self.args.block_shape = [512, 512, 16]
+
+        ingest_job = IngestJob(self.args)
+        gen_images(ingest_job)
+        sessions = ThreadSessions()
+        ingest_large_vol.worker_ingest_job = ingest_job
+        ingest_large_vol.worker_boss_res_params = Namespace(sessions=sessions, ch_resource=None)
+        try:
+            threads = 2
+            for z_range in ([0, 16], [16, 32]):
+                result = ingest_large_vol.ingest_shard(z_range, threads)
+                assert result['post_failures'] == 0
+            post_pool = ingest_large_vol.worker_post_pool
+            assert ingest_large_vol.get_worker_pools(threads)[0] is post_pool
+            assert len(sessions.threads) == threads
+        finally:
+            if ingest_large_vol.worker_post_pool is not None:
+                ingest_large_vol.worker_post_pool.close()
+                ingest_large_vol.worker_compress_pool.close()
+            ingest_large_vol.worker_post_pool = None
+            ingest_large_vol.worker_compress_pool = None
+            ingest_large_vol.worker_ingest_job = None
+            ingest_large_vol.worker_boss_res_params = None
+
+        del_test_images(ingest_job)
+        os.remove(ingest_job.get_log_fname())
+
+    def test_journal_z_ranges(self):
+        # runs on different z ranges of a channel (e.g. at the same time) don't empty each other's journals
+        self.args.channel = 'def_files'
+        self.args.datatype = 'uint16'
+        self.args.extension = 'tif'
+        self.args.z_range = [0, 32]
+        self.args.block_shape = [512, 512, 16]
+        gen_images(IngestJob(self.args))
+
+        boss_res_params = Namespace(sessions=ThreadSessions(delay=0), ch_resource=None)
+        ingest_jobs = []
+        for z_range in ([0, 16], [16, 32]):
+            self.args.z_range = z_range
+            ingest_job = IngestJob(self.args)
+            open_block_records(ingest_job)
+            ingest_jobs.append(ingest_job)
+        for ingest_job in ingest_jobs:
+            ingest_z_range(None, boss_res_params, ingest_job, ingest_job.z_range, 2)
+            ingest_job.journal.close()
+
+        journal_fnames = [ingest_job.get_journal_fname() for ingest_job in ingest_jobs]
+        assert journal_fnames[0] != journal_fnames[1]
+        for ingest_job, journal_fname in zip(ingest_jobs, journal_fnames):
+            statuses = read_journal(journal_fname)
+            assert len(statuses) == 4
+            assert set(key[4:] for key in statuses) == {tuple(ingest_job.z_range)}
+            assert set(statuses.values()) == {'done'}
+            os.remove(journal_fname)
+
+        del_test_images(ingest_jobs[0])
+        os.remove(ingest_jobs[0].get_log_fname())
+
+    def test_manifest_z_ranges(self):
+        # a channel ingested in several z ranges (without resuming) has all of them in its manifest
+        self.args.channel = 'def_files'
+        self.args.datatype = 'uint16'
+        self.args.extension = 'tif'
+        self.args.z_range = [0, 32]
+        self.args.block_shape = [512, 512, 16]
+        self.args.manifest = True
+        gen_images(IngestJob(self.args))
+        manifest_fname = IngestJob(self.args).get_manifest_fname()
+        if os.path.isfile(manifest_fname):
+            os.remove(manifest_fname)
+
+        boss_res_params = Namespace(sessions=ThreadSessions(delay=0), ch_resource=None)
+        for z_range in ([0, 16], [16, 32]):
+            self.args.z_range = z_range
+            ingest_job = IngestJob(self.args)
+            open_block_records(ingest_job)
+            ingest_z_range(None, boss_res_params, ingest_job, ingest_job.z_range, 2)
+            ingest_job.journal.close()
+            ingest_job.manifest.close()
+            os.remove(ingest_job.get_journal_fname())
+
+        blocks = read_manifest(manifest_fname)
+        assert len(blocks) == 8
+        assert set(key[4:] for key in blocks) == {(0, 16), (16, 32)}
+        assert set(status for status, _, _ in blocks.values()) == {'done'}
+        os.remove(manifest_fname)
+
+        del_test_images(ingest_job)
+        os.remove(ingest_job.get_log_fname())
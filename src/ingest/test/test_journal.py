@@ -0,0 +1,67 @@
+import os
+import tempfile
+
+from ..journal import BlockJournal, count_statuses, read_journal
+
+
+class TestJournal:
+
+    def setup(self):
+        self.journal_path = os.path.join(
+            tempfile.gettempdir(), 'ingest_journal_test.txt')
+        if os.path.isfile(self.journal_path):
+            os.remove(self.journal_path)
+
+    def teardown(self):
+        if os.path.isfile(self.journal_path):
+            os.remove(self.journal_path)
+
+    def test_record(self):
+        journal = BlockJournal(self.journal_path)
+        journal.record('done', [0, 1024], [0, 1024], [0, 16])
+        journal.record('empty', [1024, 2048], [0, 1024], [0, 16])
+        journal.close()
+
+        with open(self.journal_path) as f:
+            assert f.read() == 'done 0 1024 0 1024 0 16\nempty 1024 2048 0 1024 0 16\n'
+
+    def test_resume(self):
+        journal = BlockJournal(self.journal_path)
+        journal.record('done', [0, 1024], [0, 1024], [0, 16])
+        journal.record('empty', [1024, 2048], [0, 1024], [0, 16])
+        journal.record('failed', [0, 1024], [1024, 2048], [0, 16])
+        journal.record('failed', [1024, 2048], [1024, 2048], [0, 16])
+        # a failed block POSTed later is done
+        journal.record('done', [1024, 2048], [1024, 2048], [0, 16])
+        journal.close()
+
+        journal = BlockJournal(self.journal_path, resume=True)
+        assert journal.is_finished([0, 1024], [0, 1024], [0, 16])
+        assert journal.is_finished([1024, 2048], [0, 1024], [0, 16])
+        assert not journal.is_finished([0, 1024], [1024, 2048], [0, 16])
+        assert journal.is_finished([1024, 2048], [1024, 2048], [0, 16])
+        assert not journal.is_finished([0, 1024], [0, 1024], [16, 32])
+        journal.close()
+
+        assert count_statuses(self.journal_path) == {
+            'done': 2, 'empty': 1, 'failed': 1}
+
+    def test_partial_line(self):
+        # a crash can leave the last line partly written
+        with open(self.journal_path, 'w') as f:
+            f.write('done 0 1024 0 1024 0 16\ndone 0 1024 0 10')
+
+        assert list(read_journal(self.journal_path)) == [
+            (0, 1024, 0, 1024, 0, 16)]
+
+    def test_no_resume(self):
+        journal = BlockJournal(self.journal_path)
+        journal.record('done', [0, 1024], [0, 1024], [0, 16])
+        journal.close()
+
+        journal = BlockJournal(self.journal_path)
+        assert not journal.is_finished([0, 1024], [0, 1024], [0, 16])
+        journal.close()
+
+        assert read_journal(os.path.join(
+            tempfile.gettempdir(), 'missing_journal.txt')) == {}
@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+
+from ..manifest import NO_DIGEST, BlockManifest, block_digest, read_manifest
+
+
+class TestManifest:
+
+    def setup(self):
+        self.path = 'test_manifest.txt'
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def test_record_and_read(self):
+        data = np.arange(16 * 8 * 8, dtype=np.uint16).reshape(16, 8, 8)
+        manifest = BlockManifest(self.path)
+        manifest.record('done', [0, 8], [0, 8], [0, 16], block_digest(data), np.count_nonzero(data))
+        manifest.record('empty', [8, 16], [0, 8], [0, 16])
+        manifest.close()
+
+        blocks = read_manifest(self.path)
+        assert blocks[(0, 8, 0, 8, 0, 16)] == ('done', block_digest(data), 16 * 8 * 8 - 1)
+        assert blocks[(8, 16, 0, 8, 0, 16)] == ('empty', NO_DIGEST, 0)
+
+        os.remove(self.path)
+
+    def test_read_last_record_wins(self):
+        # a resumed ingest appends to the manifest, a partly written last line is ignored
+        manifest = BlockManifest(self.path)
+        manifest.record('empty', [0, 8], [0, 8], [0, 16])
+        manifest.record('done', [0, 8], [0, 8], [0, 16], 'abc', 3)
+        manifest.close()
+        with open(self.path, 'a') as f:
+            f.write('done 0 8 0 8 0 16 de')
+
+        assert read_manifest(self.path) == {(0, 8, 0, 8, 0, 16): ('done', 'abc', 3)}
+
+        os.remove(self.path)
+
+    def test_block_digest(self):
+        data = np.random.randint(0, 100, size=(16, 8, 8), dtype=np.uint16)
+        # same voxels, same digest (whether or not the block is a view)
+        assert block_digest(data) == block_digest(data.copy())
+        assert block_digest(np.pad(data, 1)[1:-1, 1:-1, 1:-1]) == block_digest(data)
+        changed = data.copy()
+        changed[3, 4, 5] += 1
+        assert block_digest(changed) != block_digest(data)
+        # the datatype is part of the voxels
+        assert block_digest(data.astype(np.uint64)) != block_digest(data)
@@ -0,0 +1,128 @@
+import threading
+import time
+
+from requests import HTTPError, Response
+from requests.exceptions import ConnectionError
+
+from ..post_controller import AIMDController, is_overload_error
+
+
+def http_error(status_code):
+    response = Response()
+    response.status_code = status_code
+    return HTTPError('POST failed', response=response)
+
+
+class TestPostController:
+
+    def test_initial_concurrency(self):
+        assert AIMDController(8).concurrency == 2
+        assert AIMDController(8, initial=6).concurrency == 6
+        assert AIMDController(8, initial=20).concurrency == 8
+        assert AIMDController(2).concurrency == 1
+
+    def test_additive_increase(self):
+        controller = AIMDController(8, initial=2)
+
+        # flat latency: the limit grows by one every round of requests
+        for _ in range(2):
+            controller.acquire()
+            controller.release(0.1)
+        assert controller.concurrency == 3
+
+        for _ in range(200):
+            controller.acquire()
+            controller.release(0.1)
+        assert controller.concurrency == 8
+
+    def test_multiplicative_decrease_on_5xx(self):
+        controller = AIMDController(16, initial=16)
+
+        controller.acquire()
+        controller.release(0.1, http_error(503))
+        assert controller.concurrency == 8
+
+        # only one decrease per round of requests in flight
+        controller.acquire()
+        controller.release(0.1, http_error(503))
+        assert controller.concurrency == 8
+
+        for _ in range(8):
+            controller.acquire()
+            controller.release(0.1, ConnectionError())
+        assert controller.concurrency == 4
+        assert controller.stats()['errors'] == 10
+
+    def test_client_errors_ignored(self):
+        controller = AIMDController(16, initial=16)
+
+        controller.acquire()
+        controller.release(0.1, http_error(403))
+        assert controller.concurrency == 16
+        assert controller.stats()['errors'] == 0
+
+    def test_decrease_on_rising_latency(self):
+        controller = AIMDController(16, initial=16, num_recent=10)
+
+        for _ in range(20):
+            controller.acquire()
+            controller.release(0.1)
+        assert controller.concurrency == 16
+
+        for _ in range(10):
+            controller.acquire()
+            controller.release(1.0)
+        assert controller.concurrency < 16
+
+    def test_min_concurrency(self):
+        controller = AIMDController(8, min_concurrency=2, initial=2)
+
+        controller.acquire()
+        controller.release(0.1, http_error(500))
+        assert controller.concurrency == 2
+
+    def test_acquire_blocks_at_limit(self):
+        controller = AIMDController(8, initial=1)
+        controller.acquire()
+
+        acquired = threading.Event()
+
+        def acquire():
+            controller.acquire()
+            acquired.set()
+
+        waiter = threading.Thread(target=acquire)
+        waiter.start()
+        time.sleep(0.05)
+        assert not acquired.is_set()
+
+        controller.release(0.1)
+        waiter.join(1)
+        assert acquired.is_set()
+        controller.release(0.1)
+
+    def test_stats(self):
+        controller = AIMDController(8)
+        for latency in [0.1, 0.2, 0.3, 0.4]:
+            controller.acquire()
+            controller.release(latency)
+
+        stats = controller.stats()
+        assert stats['requests'] == 4
+        assert stats['in_flight'] == 0
+        assert abs(stats['p50'] - 0.25) < 1e-9
+        assert 'POST concurrency' in controller.status_msg()
+
+    def test_report(self):
+        msgs = []
+        controller = AIMDController(8, log=msgs.append, report_interval=0)
+        controller.acquire()
+        controller.release(0.1)
+        assert len(msgs) == 1
+
+    def test_is_overload_error(self):
+        assert is_overload_error(http_error(500))
+        assert is_overload_error(http_error(504))
+        assert is_overload_error(ConnectionError())
+        assert not is_overload_error(http_error(404))
+        assert not is_overload_error(ValueError())
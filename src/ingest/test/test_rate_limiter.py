@@ -0,0 +1,145 @@
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+
+from ..rate_limiter import (RateLimiter, TokenBucket, parse_limit, set_reload_signal,
+                            set_supervisor_reload_signal)
+
+
+def write_limits(limits_path, mb_per_sec, posts_per_sec):
+    with open(limits_path, 'w') as f:
+        f.write('[Limits]\nmb_per_sec = {}\nposts_per_sec = {}\n'.format(
+            mb_per_sec, posts_per_sec))
+
+
+def wait_for_reload(limits_path, ready):
+    # worker process with its own rate limiter, exits with 0 once SIGHUP asked it to reload its limits
+    rate_limiter = RateLimiter(limits_file=limits_path)
+    set_reload_signal(rate_limiter)
+    ready.set()
+    deadline = time.monotonic() + 10
+    while not rate_limiter.reload_requested and time.monotonic() < deadline:
+        time.sleep(0.01)
+    os._exit(0 if rate_limiter.reload_requested else 1)
+
+
+class TestRateLimiter:
+
+    def setup(self):
+        self.limits_path = os.path.join(tempfile.gettempdir(), 'ingest_limits_test.cfg')
+
+    def teardown(self):
+        if os.path.isfile(self.limits_path):
+            os.remove(self.limits_path)
+
+    def test_unlimited_bucket(self):
+        bucket = TokenBucket()
+        start = time.monotonic()
+        for _ in range(1000):
+            bucket.consume(1024**3)
+        assert time.monotonic() - start < 0.5
+
+    def test_bucket_rate(self):
+        # a full bucket (one second of tokens) lets the first 100 through, the next 50 wait half a second
+        bucket = TokenBucket(100)
+        time.sleep(0.05)
+        bucket.tokens = bucket.capacity
+        start = time.monotonic()
+        for _ in range(150):
+            bucket.consume(1)
+        elapsed = time.monotonic() - start
+        assert 0.4 < elapsed < 1.0
+
+    def test_bucket_larger_than_capacity(self):
+        # a request larger than the bucket goes through once it is full, and the debt is paid off after
+        bucket = TokenBucket(100)
+        bucket.tokens = bucket.capacity
+        start = time.monotonic()
+        bucket.consume(150)
+        assert time.monotonic() - start < 0.1
+        bucket.consume(1)
+        assert time.monotonic() - start > 0.4
+
+    def test_parse_limit(self):
+        assert parse_limit('50') == 50
+        assert parse_limit('0.5') == 0.5
+        assert parse_limit('0') is None
+        assert parse_limit('none') is None
+        assert parse_limit('') is None
+        assert parse_limit(None, 10) == 10
+
+    def test_limits_share(self):
+        rate_limiter = RateLimiter(mb_per_sec=8, posts_per_sec=20, share=0.25)
+        assert rate_limiter.bytes_bucket.rate == 2 * 1024**2
+        assert rate_limiter.posts_bucket.rate == 5
+
+    def test_limits_file(self):
+        msgs = []
+        write_limits(self.limits_path, 50, 0)
+        rate_limiter = RateLimiter(mb_per_sec=10, posts_per_sec=5, limits_file=self.limits_path,
+                                   log=msgs.append)
+        assert rate_limiter.mb_per_sec == 50
+        assert rate_limiter.posts_per_sec is None
+        assert rate_limiter.posts_bucket.rate is None
+
+        # the file is checked again once check_interval has passed
+        write_limits(self.limits_path, 1, 2)
+        os.utime(self.limits_path, (time.time() + 5, time.time() + 5))
+        rate_limiter.check_interval = 0
+        rate_limiter.acquire(1)
+        assert rate_limiter.mb_per_sec == 1
+        assert rate_limiter.posts_per_sec == 2
+        assert msgs[-1] == 'Upload limits set to 1.0 MB/sec and 2.0 POSTs/sec'
+
+    def test_limits_file_missing_keys(self):
+        # limits missing from the file keep the values from the command line
+        with open(self.limits_path, 'w') as f:
+            f.write('[Limits]\nposts_per_sec = 3\n')
+        rate_limiter = RateLimiter(
+            mb_per_sec=10, limits_file=self.limits_path)
+        assert rate_limiter.mb_per_sec == 10
+        assert rate_limiter.posts_per_sec == 3
+
+    def test_request_reload(self):
+        rate_limiter = RateLimiter(limits_file=self.limits_path)
+        assert rate_limiter.mb_per_sec is None
+
+        # a reload request (e.g. from SIGHUP) is picked up by the next acquire
+        write_limits(self.limits_path, 100, 0)
+        rate_limiter.request_reload()
+        rate_limiter.acquire(1)
+        assert rate_limiter.mb_per_sec == 100
+
+    def test_bad_limits_file(self):
+        msgs = []
+        with open(self.limits_path, 'w') as f:
+            f.write('[Limits]\nmb_per_sec = fast\n')
+        rate_limiter = RateLimiter(mb_per_sec=10, limits_file=self.limits_path,
+                                   log=msgs.append)
+        assert rate_limiter.mb_per_sec == 10
+        assert 'Could not read limits file' in msgs[-1]
+
+    def test_supervisor_reload_signal(self):
+        # with --workers the supervisor has no rate limiter, SIGHUP is forwarded to the workers instead of ending it
+        write_limits(self.limits_path, 10, 5)
+        workers = []
+        for _ in range(2):
+            ready = multiprocessing.Event()
+            worker = multiprocessing.Process(target=wait_for_reload, args=(self.limits_path, ready))
+            worker.start()
+            assert ready.wait(10)
+            workers.append(worker)
+
+        prev_handler = set_supervisor_reload_signal(self.limits_path)
+        try:
+            os.kill(os.getpid(), signal.SIGHUP)
+            for worker in workers:
+                worker.join(10)
+                assert worker.exitcode == 0
+        finally:
+            signal.signal(signal.SIGHUP, prev_handler)
+
+    def test_supervisor_reload_signal_no_limits_file(self):
+        assert set_supervisor_reload_signal(None) is None
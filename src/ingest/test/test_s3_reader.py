@@ -0,0 +1,199 @@
+import io
+import os
+from argparse import Namespace
+
+import boto3
+import numpy as np
+import pytest
+import tifffile
+from moto import mock_aws
+
+from ....ingest_large_vol import get_supercube_lims, read_slabs
+from ..ingest_job import IngestJob, map_tif_page
+from ..s3_reader import BufferFile, S3Reader
+from .create_images import del_test_images, gen_images
+
+
+class TestS3Reader:
+
+    def setup(self):
+        self.bucket = 'test-ingest-bucket'
+        self.args = Namespace(datasource='s3',
+                              s3_bucket_name=self.bucket,
+                              aws_profile=None,
+                              base_filename='img_<ch>_<p:4>',
+                              base_path='s3_img_test_data',
+                              boss_config_file='neurodata.cfg',
+                              collection='ben_dev',
+                              experiment='dev_ingest_4',
+                              channel='def_files',
+                              datatype='uint16',
+                              extension='tif',
+                              x_extent=[0, 100],
+                              y_extent=[0, 120],
+                              z_extent=[0, 100],
+                              z_range=[0, 40],
+                              res=0,
+                              warn_missing_files=False,
+                              z_step=1)
+
+    def create_bucket(self, objects):
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=self.bucket)
+        for key, data in objects.items():
+            client.put_object(Bucket=self.bucket, Key=key, Body=data)
+        return client
+
+    @mock_aws
+    def test_read(self):
+        client = self.create_bucket({'a': b'abc', 'b': b'de'})
+        reader = S3Reader(client, self.bucket)
+
+        assert reader.read('a') == b'abc'
+        assert reader.read('b') == b'de'
+        with pytest.raises(Exception):
+            reader.read('missing')
+        reader.close()
+
+    @mock_aws
+    def test_prefetch(self):
+        objects = {'img_{}'.format(idx): os.urandom(1000) for idx in range(8)}
+        client = self.create_bucket(objects)
+        reader = S3Reader(client, self.bucket, prefetch_threads=2)
+
+        reader.prefetch(list(objects))
+        for key, data in objects.items():
+            assert reader.read(key) == data
+        assert reader.num_hits == 8
+        assert reader.held == 0
+        assert reader.prefetched == {}
+        reader.close()
+
+    @mock_aws
+    def test_prefetch_budget(self):
+        # objects that don't fit in the budget are dropped and read when they're needed
+        objects = {'img_{}'.format(idx): os.urandom(1000) for idx in range(4)}
+        client = self.create_bucket(objects)
+        reader = S3Reader(client, self.bucket, prefetch_bytes=2500, prefetch_threads=1)
+
+        reader.prefetch(list(objects))
+        for result in list(reader.prefetched.values()):
+            result.wait()
+        for key, data in objects.items():
+            assert reader.read(key) == data
+        assert reader.num_hits == 2
+        assert reader.num_dropped == 2
+        assert reader.held == 0
+        reader.close()
+
+    @mock_aws
+    def test_prefetch_missing(self):
+        # a failed prefetch is left to read, which raises the error
+        client = self.create_bucket({})
+        reader = S3Reader(client, self.bucket)
+
+        reader.prefetch(['missing'])
+        with pytest.raises(Exception):
+            reader.read('missing')
+        reader.close()
+
+    @mock_aws
+    def test_clear(self):
+        client = self.create_bucket({'a': b'abc'})
+        reader = S3Reader(client, self.bucket)
+
+        reader.prefetch(['a'])
+        reader.clear()
+        assert reader.held == 0
+        assert reader.read('a') == b'abc'
+        assert reader.num_hits == 0
+        reader.close()
+
+    @mock_aws
+    def test_read_ranges(self):
+        # objects larger than a range are downloaded range by range into one buffer
+        objects = {'small': os.urandom(1000), 'exact': os.urandom(2000), 'large': os.urandom(4500)}
+        client = self.create_bucket(objects)
+        reader = S3Reader(client, self.bucket, range_bytes=1000, range_threads=2)
+
+        for key, data in objects.items():
+            assert reader.read(key) == data
+        assert reader.num_ranged == 2
+
+        reader.prefetch(['large'])
+        assert reader.read('large') == objects['large']
+        assert reader.num_hits == 1
+        reader.close()
+
+    @mock_aws
+    def test_read_single_get(self):
+        objects = {'large': os.urandom(4500)}
+        client = self.create_bucket(objects)
+        reader = S3Reader(client, self.bucket, range_bytes=0)
+
+        assert reader.read('large') == objects['large']
+        assert reader.num_ranged == 0
+        reader.close()
+
+    def test_buffer_file(self):
+        data = np.random.randint(0, 2**16, size=(60, 50), dtype=np.uint16)
+        stream = io.BytesIO()
+        tifffile.imwrite(stream, data)
+        buffer = bytearray(stream.getvalue())
+
+        buffer_file = BufferFile(buffer)
+        assert np.array_equal(tifffile.imread(buffer_file), data)
+
+        # an uncompressed image is a view of the downloaded buffer
+        buffer_file.seek(0)
+        im = map_tif_page(buffer_file)
+        assert np.array_equal(im, data)
+        assert np.shares_memory(im, np.frombuffer(buffer, dtype=np.uint8))
+        assert buffer_file.tell() == 0
+
+        buffer_file.seek(-4, io.SEEK_END)
+        assert buffer_file.read() == bytes(buffer[-4:])
+        assert buffer_file.read(10) == b''
+        buffer_file.seek(2)
+        assert buffer_file.read(3) == bytes(buffer[2:5])
+        assert buffer_file.tell() == 5
+
+    @mock_aws
+    def test_read_slabs_s3(self):
+        # the images of the next slab are prefetched while a slab is read
+        client = self.create_bucket({})
+        ingest_job = IngestJob(self.args)
+        gen_images(ingest_job)
+        for z_slice in range(*ingest_job.z_range):
+            img_fname = ingest_job.get_img_fname(z_slice)
+            client.upload_file(img_fname, self.bucket, img_fname)
+
+        local_ingest_job = IngestJob(Namespace(**dict(vars(self.args), datasource='local', s3_bucket_name=None)))
+
+        z_buckets = get_supercube_lims(ingest_job.z_range, 16)
+        for prefetch in [0, 1]:
+            for z_slices, im_array in read_slabs(ingest_job, z_buckets, prefetch):
+                assert np.array_equal(im_array, local_ingest_job.read_img_stack(z_slices))
+        # every slab but the first was prefetched
+        assert ingest_job.s3_reader.num_hits == 2 * (40 - 16)
+        ingest_job.s3_reader.close()
+
+        # images larger than a range
+        ingest_job.s3_reader.range_bytes = 5000
+        for z_slices, im_array in read_slabs(ingest_job, z_buckets, 1):
+            assert np.array_equal(im_array, local_ingest_job.read_img_stack(z_slices))
+        assert ingest_job.s3_reader.num_ranged == 40
+        ingest_job.s3_reader.close()
+
+        del_test_images(ingest_job)
+        os.remove(ingest_job.get_log_fname())
+
+    def test_s3_prefetch_mb(self):
+        self.args.s3_prefetch_mb = -1
+        with pytest.raises(ValueError):
+            IngestJob(self.args)
+
+    def test_s3_ranges(self):
+        self.args.s3_range_threads = 0
+        with pytest.raises(ValueError):
+            IngestJob(self.args)
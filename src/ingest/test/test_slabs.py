@@ -0,0 +1,198 @@
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from ..slabs import (BlockSlab, MemoryBudget, MmapSlab, SharedSlab, SlabPool, block_slab_view,
+                     get_block_nonzero_map, get_slab_nbytes, mmap_array, parse_slab_backing)
+
+
+class TestSlabs:
+
+    def test_shared_slab_zero_filled(self):
+        slab = SharedSlab((2, 64, 32), 'uint16')
+
+        assert slab.array.shape == (2, 64, 32)
+        assert slab.array.dtype == np.uint16
+        assert not slab.array.any()
+
+        slab.release()
+
+    def test_shared_slab_attach(self):
+        slab = SharedSlab((2, 64, 32), 'uint64')
+        slab.array[1, :, :] = 7
+
+        attached = SharedSlab.attach(slab.name, slab.shape, slab.dtype.str)
+        assert np.array_equal(attached.array, slab.array)
+
+        # blocks sliced out of an attached slab are views into the same memory
+        block = attached.array[:, 0:16, 0:16]
+        assert np.shares_memory(block, attached.array)
+        block[0, :, :] = 3
+        assert np.all(slab.array[0, 0:16, 0:16] == 3)
+
+        del block
+        attached.close()
+        slab.release()
+
+    def test_shared_slab_release(self):
+        slab = SharedSlab((1, 8, 8), 'uint8')
+        name = slab.name
+        slab.release()
+
+        with pytest.raises(FileNotFoundError):
+            SharedSlab.attach(name, (1, 8, 8), 'uint8')
+
+    def test_get_slab_nbytes(self):
+        assert get_slab_nbytes(16, [1000, 1024], 'uint16') == 16 * 1024 * 1000 * 2
+        assert get_slab_nbytes(16, [1000, 1024], 'uint64') == 16 * 1024 * 1000 * 8
+
+    def test_memory_budget(self):
+        budget = MemoryBudget(100)
+        budget.acquire(60)
+
+        acquired = threading.Event()
+
+        def acquire():
+            budget.acquire(60)
+            acquired.set()
+
+        waiter = threading.Thread(target=acquire)
+        waiter.start()
+
+        # doesn't fit until the first 60 bytes are released
+        time.sleep(0.05)
+        assert not acquired.is_set()
+
+        budget.release(60)
+        waiter.join(1)
+        assert acquired.is_set()
+        assert budget.used_bytes == 60
+
+    def test_memory_budget_larger_than_budget(self):
+        budget = MemoryBudget(100)
+
+        # a single slab larger than the budget still goes through when nothing else is held
+        budget.acquire(500)
+        assert budget.used_bytes == 500
+        budget.release(500)
+        assert budget.used_bytes == 0
+
+    def test_block_nonzero_map(self):
+        slab = np.zeros((16, 100, 250), dtype=np.uint64)
+        slab[15, 99, 249] = 2**63    # last (partial) block
+        slab[3, 10, 60] = 1
+
+        nonzero_map = get_block_nonzero_map(slab, [0, 64], [0, 50, 100, 200])
+        assert nonzero_map.tolist() == [[False, True, False, False],
+                                        [False, False, False, True]]
+
+        assert not get_block_nonzero_map(np.zeros((16, 100, 250), dtype=np.uint8), [0], [0, 128]).any()
+
+    def test_block_nonzero_map_bands(self):
+        # non square slab with several rows of blocks, checked block by block
+        slab = np.zeros((16, 300, 130), dtype=np.uint16)
+        y_starts, x_starts = [0, 64, 128, 192, 256], [0, 64, 128]
+        for z, y, x in ((0, 0, 0), (5, 70, 127), (15, 299, 129), (8, 200, 64), (2, 191, 10)):
+            slab[z, y, x] = 7
+
+        expected = [[slab[:, y_start:y_stop, x_start:x_stop].any()
+                     for x_start, x_stop in zip(x_starts, x_starts[1:] + [130])]
+                    for y_start, y_stop in zip(y_starts, y_starts[1:] + [300])]
+        nonzero_map = get_block_nonzero_map(slab, y_starts, x_starts)
+        assert nonzero_map.tolist() == expected
+        assert nonzero_map.sum() == 5
+
+    def test_block_slab(self):
+        im_array = np.random.randint(0, 100, size=(4, 100, 250), dtype=np.uint16)
+        block_slab = BlockSlab(im_array.shape, im_array.dtype, [0, 64], [0, 128])
+        for idx in range(im_array.shape[0]):
+            block_slab[idx] = im_array[idx]
+
+        # every block is contiguous in the slab's buffer
+        block = block_slab.get_block(64, 128)
+        assert block.flags['C_CONTIGUOUS']
+        assert np.shares_memory(block, block_slab.buffer)
+        assert np.array_equal(block, im_array[:, 64:100, 128:250])
+        assert np.array_equal(block_slab.to_array(), im_array)
+        assert block_slab.nbytes == im_array.nbytes
+
+        assert block_slab.astype('uint64').get_block(0, 128).dtype == np.uint64
+
+    def test_block_slab_nonzero_map(self):
+        im_array = np.zeros((16, 100, 250), dtype=np.uint8)
+        im_array[15, 99, 249] = 1
+        im_array[3, 10, 60] = 1
+        block_slab = block_slab_view(np.empty_like(im_array), ([0, 64], [0, 50, 100, 200]))
+        for idx in range(im_array.shape[0]):
+            block_slab[idx] = im_array[idx]
+
+        assert np.array_equal(block_slab.nonzero_map(),
+                              get_block_nonzero_map(im_array, [0, 64], [0, 50, 100, 200]))
+
+    def test_mmap_slab(self):
+        slab = MmapSlab((2, 3, 4), 'uint16', directory=tempfile.gettempdir())
+        assert os.path.dirname(slab.name) == tempfile.gettempdir()
+        assert not slab.array.any()
+
+        # another process attaches to the slab's file by name
+        other = MmapSlab.attach(slab.name, slab.shape, slab.dtype.str)
+        other.array[1] = 7
+        other.array.flush()
+        other.close()
+        assert np.all(slab.array[1] == 7)
+
+        slab.release()
+        assert not os.path.isfile(slab.name)
+
+    def test_mmap_array(self):
+        im_array = mmap_array((2, 3, 4), 'uint8', tempfile.gettempdir())
+        assert isinstance(im_array, np.memmap)
+        assert im_array.shape == (2, 3, 4)
+        assert not im_array.any()
+        im_array[0] = 1
+        assert im_array.sum() == 12
+
+    def test_parse_slab_backing(self):
+        assert parse_slab_backing(None) == ('memory', None)
+        assert parse_slab_backing('memory') == ('memory', None)
+        assert parse_slab_backing('mmap:' + tempfile.gettempdir()) == ('mmap', tempfile.gettempdir())
+        assert parse_slab_backing('mmap') == ('mmap', tempfile.gettempdir())
+        with pytest.raises(ValueError):
+            parse_slab_backing('disk:/scratch')
+        with pytest.raises(ValueError):
+            parse_slab_backing('mmap:/no/such/scratch/dir')
+
+    def test_slab_pool(self):
+        pool = SlabPool(max_free=2)
+        key = ('memory', None, (2, 3, 4), '<u2')
+        buffer = pool.acquire(key, lambda: np.zeros((2, 3, 4), dtype=np.uint16))
+        pool.release(key, buffer)
+
+        # only a buffer with the same key is reused
+        assert pool.acquire(('memory', None, (1, 3, 4), '<u2'), lambda: None) is None
+        assert pool.acquire(key, lambda: None) is buffer
+        assert pool.allocated == 2
+        assert pool.reused == 1
+
+    def test_slab_pool_discard(self):
+        discarded = []
+        pool = SlabPool(max_free=2)
+        for idx in range(3):
+            pool.release(('key', idx), idx, discarded.append)
+        # the oldest free buffer is discarded once more than max_free are kept
+        assert discarded == [0]
+        pool.clear()
+        assert discarded == [0, 1, 2]
+        assert pool.free == []
+
+    def test_block_slab_zero_slice(self):
+        block_slab = BlockSlab((2, 10, 10), np.uint8, [0, 5], [0, 5])
+        block_slab.buffer[:] = 1
+        block_slab[1] = 0
+        im_array = block_slab.to_array()
+        assert im_array[0].all()
+        assert not im_array[1].any()
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+
+from ....verify_ingest import get_manifest_blocks, verify_manifest
+from ..manifest import BlockManifest, block_digest
+
+
+class TestVerifyIngest:
+
+    def setup(self):
+        self.path = 'test_verify_manifest.txt'
+        # what the "Boss" returns for each block, by x start
+        self.boss = {}
+        self.msgs = []
+
+        data = np.full((16, 8, 8), 5, dtype=np.uint16)
+        manifest = BlockManifest(self.path)
+        for x_start in (0, 8, 16):
+            manifest.record('done', [x_start, x_start + 8], [0, 8], [0, 16],
+                            block_digest(data), np.count_nonzero(data))
+            self.boss[x_start] = data
+        manifest.record('empty', [24, 32], [0, 8], [0, 16])
+        manifest.close()
+
+    def get_cutout(self, x_rng, y_rng, z_rng):
+        if x_rng[0] not in self.boss:
+            raise IOError('GET failed')
+        return self.boss[x_rng[0]]
+
+    def test_get_manifest_blocks(self):
+        assert len(get_manifest_blocks(self.path)) == 3
+        assert len(get_manifest_blocks(self.path, check_empty=True)) == 4
+        os.remove(self.path)
+
+    def test_verify_manifest(self):
+        assert verify_manifest(self.get_cutout, self.path, threads=2, log=self.msgs.append) == {
+            'ok': 3, 'mismatch': 0, 'error': 0}
+        os.remove(self.path)
+
+    def test_verify_manifest_mismatch(self):
+        corrupt = self.boss[8].copy()
+        corrupt[0, 0, 0] = 0
+        self.boss[8] = corrupt
+        # empty blocks should have nothing in the Boss
+        self.boss[24] = np.ones((16, 8, 8), dtype=np.uint16)
+
+        counts = verify_manifest(self.get_cutout, self.path, threads=2, check_empty=True, log=self.msgs.append)
+        assert counts == {'ok': 2, 'mismatch': 2, 'error': 0}
+        assert sum('MISMATCH' in msg for msg in self.msgs) == 2
+        os.remove(self.path)
@@ -0,0 +1,110 @@
+'''
+Checks the Boss against the manifest of an ingest (ingest_large_vol.py --manifest)
+Every block in the manifest is GET from the Boss in parallel and its hash compared with the one recorded when it
+was POSTed, without reading the images again
+'''
+
+import argparse
+import sys
+import time
+from functools import partial
+from multiprocessing.dummy import Pool as ThreadPool
+
+import numpy as np
+from intern.remote.boss import BossRemote
+
+try:
+    from src.ingest.manifest import NO_DIGEST, block_digest, read_manifest
+    from ingest_large_vol import get_formatted_datetime
+except ImportError:
+    from .src.ingest.manifest import NO_DIGEST, block_digest, read_manifest
+    from .ingest_large_vol import get_formatted_datetime
+
+
+def get_manifest_blocks(path, check_empty=False):
+    # (key, digest, nonzero) of the blocks to check: the POSTed ones, and the empty ones with check_empty
+    # in z order, so the GETs go through the volume slab by slab
+    blocks = []
+    for key, (status, digest, nonzero) in sorted(read_manifest(path).items(), key=lambda item: item[0][4:] + item[0][:4]):
+        if status == 'done' or (check_empty and status == 'empty'):
+            blocks.append((key, digest, nonzero))
+    return blocks
+
+
+def check_block(get_cutout, block, attempts=3):
+    # GETs the block from the Boss, returns (key, result) where result is 'ok', 'mismatch' or 'error'
+    key, digest, nonzero = block
+    x_rng, y_rng, z_rng = [key[0], key[1]], [key[2], key[3]], [key[4], key[5]]
+    for attempt in range(attempts):
+        try:
+            data = np.asarray(get_cutout(x_rng, y_rng, z_rng))
+        except Exception:
+            if attempt != attempts - 1:
+                time.sleep(2**(attempt + 1))
+        else:
+            break
+    else:
+        return key, 'error'
+
+    # empty blocks weren't POSTed, the Boss should have nothing there
+    if digest == NO_DIGEST:
+        matches = not data.any()
+    else:
+        matches = block_digest(data) == digest and int(np.count_nonzero(data)) == nonzero
+    return key, 'ok' if matches else 'mismatch'
+
+
+def verify_manifest(get_cutout, path, threads=8, check_empty=False, log=print):
+    # checks every block of the manifest, returns the number of blocks with each result
+    blocks = get_manifest_blocks(path, check_empty)
+    log('{} Verifying {} blocks of manifest {} with {} threads'.format(
+        get_formatted_datetime(), len(blocks), path, threads))
+
+    counts = {'ok': 0, 'mismatch': 0, 'error': 0}
+    with ThreadPool(threads) as pool:
+        for key, result in pool.imap_unordered(partial(check_block, get_cutout), blocks):
+            counts[result] += 1
+            if result != 'ok':
+                log('{} Block {} x: {}, y: {}, z: {}'.format(
+                    get_formatted_datetime(), '*MISMATCH*' if result == 'mismatch' else 'GET failed',
+                    [key[0], key[1]], [key[2], key[3]], [key[4], key[5]]))
+
+    log('{} Verified {} blocks: {ok} match, {mismatch} mismatches, {error} GET failures'.format(
+        get_formatted_datetime(), len(blocks), **counts))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check the data in the Boss against the manifest of an ingest, without reading the images')
+    parser.add_argument('manifest', type=str,
+                        help='Manifest written by ingest_large_vol.py --manifest (ingest_manifest_<coll>_<exp>_<ch>.txt)')
+    parser.add_argument('--collection', type=str, required=True,
+                        help='Collection')
+    parser.add_argument('--experiment', type=str, required=True,
+                        help='Experiment')
+    parser.add_argument('--channel', type=str, required=True,
+                        help='Channel')
+    parser.add_argument('--res', type=int, default=0,
+                        help='Resolution of the ingest (default = 0)')
+    parser.add_argument('--boss_config_file', type=str, default='neurodata.cfg',
+                        help='Path and filename for Boss config (config file w/ server and API Key)')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Number of blocks GET from the Boss at a time (default = 8)')
+    parser.add_argument('--check_empty', action='store_true',
+                        help='Also check that the blocks skipped as empty have no data in the Boss')
+    args = parser.parse_args()
+
+    rmt = BossRemote(args.boss_config_file)
+    ch_resource = rmt.get_channel(args.channel, args.collection, args.experiment)
+
+    def get_cutout(x_rng, y_rng, z_rng):
+        return rmt.get_cutout(ch_resource, args.res, x_rng, y_rng, z_rng)
+
+    counts = verify_manifest(get_cutout, args.manifest, args.threads, args.check_empty)
+    if counts['mismatch'] or counts['error']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()